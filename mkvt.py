@@ -6,50 +6,222 @@ import shutil
 import getpass
 from pathlib import Path
 import argparse
-from tqdm import tqdm
-import yaml
 import json
-from time import sleep
+import threading
+import hashlib
+import errno
+import queue
+import struct
+import atexit
+from contextlib import contextmanager
+from time import sleep, perf_counter, monotonic
+from collections import deque
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor
 
 ################################################### CONFIG ###################################################
 
 # Directory in which the script will look for additional needed files
 script_directory = Path(__file__).parent
 
-with open(os.path.join(script_directory, "mkvt_config.yaml"), "r", encoding="utf8") as f:
-    config = yaml.safe_load(f)
+class Config:
+    # The settings of mkvt_config.yaml, every setting that is missing from values keeps its default
+    # Programs that import mkvt can create their own, e.g. Config({"remux_jobs": 2}), instead of reading a config file
+    def __init__(self, values=None):
+        config = values or {}
 
-# Directories that will not be scanned for .mkv files
-ignore_dirs = config["ignore_dirs"]
+        # Directories that will not be scanned for .mkv files
+        self.ignore_dirs = config.get("ignore_dirs", ["behind the scenes", "deleted scenes", "interviews", "scenes", "samples", "shorts",
+                                                      "featurettes", "clips", "other", "extras", "trailers"])
 
-# Regex to match and ignore unwanted .mkv files like trailers, samples..
-pattern_unwanted = re.compile(config["pattern_unwanted"]) if config["pattern_unwanted"] != "" else re.compile(r'^.*-trailer.mkv$|^.*-sample.mkv$')
+        # Regex to match and ignore unwanted .mkv files like trailers, samples..
+        self.pattern_unwanted = re.compile(config.get("pattern_unwanted") or r'^.*-trailer.mkv$|^.*-sample.mkv$')
 
-# Subformat codecs to display in the program and append to subtitle track names
-sub_codec_replacements = config["sub_codec_replacements"]
+        # Subformat codecs to display in the program and append to subtitle track names
+        self.sub_codec_replacements = config.get("sub_codec_replacements", {"SubStationAlpha": "ASS", "SubRip/SRT": "SRT", "HDMV PGS": "PGS", "VobSub": "VOB"})
 
-# Remove all attachments (embedded fonts, covers, nfos...) during remuxing
-remove_attachments_cfg = config["remove_attachments"]
+        # Remove all attachments (embedded fonts, covers, nfos...) during remuxing
+        self.remove_attachments = config.get("remove_attachments", False)
 
-# Trim other tracks to the video length
-stop_after_video_ends_cfg = config["stop_after_video_ends"]
+        # Trim other tracks to the video length
+        self.stop_after_video_ends = config.get("stop_after_video_ends", False)
 
-# After remuxing, use mkvpropr on the same directory to set file title, track names, languages and flags, Default: True
-run_mkvp_cfg = config["run_mkvp"]
+        # After remuxing, use mkvpropr on the directories of the changed files to set file title, track names, languages and flags, Default: True
+        self.run_mkvp = config.get("run_mkvp", True)
 
-# Track order separated by spaces, at least 1 track id must be given
-pattern_input = re.compile(r'^\s*\d{1,3}(?:\s+\d{1,3})*\s*$')
+        # Number of files probed via mkvmerge -J at the same time, Default: number of CPU cores
+        self.probe_jobs = config.get("probe_jobs") or os.cpu_count() or 1
+
+        # Remember the track information of unchanged files between runs so they don't have to be probed again, Default: True
+        self.probe_cache = config.get("probe_cache", True)
+
+        # Location of the probe cache database, Default: mkvtrackr/probe_cache.sqlite3 in the user's cache directory
+        if config.get("probe_cache_file"):
+            self.probe_cache_file = config["probe_cache_file"]
+        elif sys.platform == "win32":
+            self.probe_cache_file = os.path.join(os.environ.get("LOCALAPPDATA", os.path.expanduser("~")), "mkvtrackr", "probe_cache.sqlite3")
+        else:
+            self.probe_cache_file = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "mkvtrackr", "probe_cache.sqlite3")
+
+        # Save the track order chosen for each group and offer it again for groups with the same tracks in later runs, Default: True
+        self.decisions = config.get("decisions", True)
+
+        # Directory for the files mkvtrackr keeps between runs
+        if sys.platform == "win32":
+            data_dir = os.path.join(os.environ.get("LOCALAPPDATA", os.path.expanduser("~")), "mkvtrackr")
+        else:
+            data_dir = os.path.join(os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share"), "mkvtrackr")
+
+        # Location of the saved track orders, Default: mkvtrackr/decisions.json in the user's data directory
+        self.decisions_file = config.get("decisions_file") or os.path.join(data_dir, "decisions.json")
+
+        # Journal of the running remux so an interrupted run can be continued via --resume, Default: mkvtrackr/journal.jsonl in the user's data directory
+        self.journal_file = config.get("journal_file") or os.path.join(data_dir, "journal.jsonl")
+
+        # Rules that choose the track order of each group without prompting when running with --auto, Default: no rules
+        self.rules = config.get("rules") or []
+
+        # Seconds the size and modification time of a new file must stay the same before --watch processes it, Default: 30
+        self.watch_settle = config.get("watch_settle_seconds") or 30
+
+        # Seconds between two scans of the library when --watch can't use inotify, Default: 60
+        self.watch_poll_interval = config.get("watch_poll_interval") or 60
+
+        # Start prompting for track orders while the scan is still running, Default: False
+        self.stream_scan = config.get("stream_scan", False)
+
+        # Start remuxing each group in the background as soon as it has been answered, Default: False
+        self.remux_early = config.get("remux_early", False)
+
+        # Maximum number of mkvmerge remuxes running at the same time, Default: 4
+        self.remux_jobs = config.get("remux_jobs") or 4
+
+        # Maximum number of mkvmerge remuxes running at the same time on one drive/filesystem, Default: 1
+        self.remux_jobs_per_device = config.get("remux_jobs_per_device") or 1
+
+        # Directory on another drive (e.g. an SSD) that mkvmerge writes to, the results are moved next to the source files afterwards, Default: empty
+        self.scratch_dir = config.get("scratch_dir") or None
+
+        # Space in GB that is always kept free on the drives of the remuxed files, Default: 5 (also when the key is empty), 0 keeps nothing free
+        free_space_reserve_gb = config.get("free_space_reserve_gb")
+        self.free_space_reserve = int(float(5 if free_space_reserve_gb is None else free_space_reserve_gb) * 1024**3)
+
+        # Replace each original file as soon as its remux has finished instead of after all remuxes, Default: False
+        self.rolling_replace = config.get("rolling_replace", False)
+
+        # Space in GB that is always kept free on the scratch drive, Default: 5 (also when the key is empty), 0 keeps nothing free
+        scratch_reserve_gb = config.get("scratch_reserve_gb")
+        self.scratch_reserve = int(float(5 if scratch_reserve_gb is None else scratch_reserve_gb) * 1024**3)
+
+        # File the timings of --stats are written to as JSON, Default: empty (only print them)
+        self.stats_file = config.get("stats_file") or None
+
+        # Only keep the full track info of the first file of each category, Default: False
+        self.low_memory = config.get("low_memory", False)
+
+        # Probe every remuxed file and only replace its original if the tracks and duration match the chosen track order, Default: True
+        self.verify_remux = config.get("verify_remux", True)
+
+        # Seconds the duration of a remuxed file may differ from its source, Default: 2
+        self.verify_tolerance = float(config.get("verify_duration_tolerance") or 2)
+
+        # Seconds after which the claim of a --worker that stopped sending heartbeats is taken over by another worker, Default: 300
+        self.worker_stale = float(config.get("worker_stale_seconds") or 300)
 
-# Default language codes used when filtering the track selection via "p" and then selecting "d"
-if config["default_filter_langs"]:
-    default_filter_langs = config["default_filter_langs"]
-else:
-    default_filter_langs = {
-        "audio": ["ja", "jpn" ,"de", "deu", "de-DE", "ger", "en", "eng", "en-GB", "en-CA", "en-US"],
-        "sub": ["de", "deu", "de-DE", "ger", "en", "eng", "en-GB", "en-CA", "en-US"]}
+        # What happens to the other hard links of a replaced file: "relink" them to the new file, "leave" them or "report" them, Default: report
+        self.hardlinks = config.get("hardlinks") or "report"
 
-# User friendly version printed as the Default
-default_langs_readable = f'{" ".join(default_filter_langs["audio"])}, {" ".join(default_filter_langs["sub"])}'
+        # Read the track information via "mkvmerge" -J or the "native" Matroska header parser, Default: mkvmerge
+        self.probe_backend = config.get("probe_backend") or "mkvmerge"
+
+        # Default language codes used when filtering the track selection via "p" and then selecting "d"
+        if config.get("default_filter_langs"):
+            self.default_filter_langs = config["default_filter_langs"]
+        else:
+            self.default_filter_langs = {
+                "audio": ["ja", "jpn" ,"de", "deu", "de-DE", "ger", "en", "eng", "en-GB", "en-CA", "en-US"],
+                "sub": ["de", "deu", "de-DE", "ger", "en", "eng", "en-GB", "en-CA", "en-US"]}
+
+        # User friendly version printed as the Default
+        self.default_langs_readable = f'{" ".join(self.default_filter_langs["audio"])}, {" ".join(self.default_filter_langs["sub"])}'
+
+def load_config(config_file):
+    # A missing config file leaves every setting at its default, e.g. when mkvt is imported by another program
+    import yaml
+    try:
+        with open(config_file, "r", encoding="utf8") as f:
+            return Config(yaml.safe_load(f))
+    except FileNotFoundError:
+        return Config()
+
+# Bump this whenever the cached JSON changes so old entries are discarded
+probe_cache_version = 2
+
+# The config file read by get_config, None until a setting is needed for the first time
+loaded_config = None
+
+def get_config():
+    # Another config file can be used via the MKVT_CONFIG environment variable
+    global loaded_config
+    if loaded_config is None:
+        loaded_config = load_config(os.environ.get("MKVT_CONFIG") or os.path.join(script_directory, "mkvt_config.yaml"))
+    return loaded_config
+
+class Session:
+    # The settings and state of one run, passed to every stage that depends on them instead of keeping them in globals
+    # The settings that aren't given come from config, which is read from mkvt_config.yaml if it is None
+    def __init__(self, config=None, remove_attachments=None, stop_after_video_ends=None, probe_backend=None, verify_remuxes=None, hardlink_policy=None):
+        self.config = config if config is not None else get_config()
+        # Settings that apply to every probe, plan and remux of the run
+        self.remove_attachments = self.config.remove_attachments if remove_attachments is None else remove_attachments
+        self.stop_after_video_ends = self.config.stop_after_video_ends if stop_after_video_ends is None else stop_after_video_ends
+        self.probe_backend = probe_backend or self.config.probe_backend
+        self.verify_remuxes = self.config.verify_remux if verify_remuxes is None else verify_remuxes
+        self.hardlink_policy = hardlink_policy or self.config.hardlinks
+        # Further hard links of the scanned files that were found in the scanned directories, path that was scanned -> paths of the other links
+        self.known_links = {}
+        # Replaced files whose other hard links still point to the original, path -> (known links, number of links outside the scanned directories)
+        self.stale_links = {}
+        # Hits and misses of the probe cache
+        self.probe_cache_stats = {"hits": 0, "misses": 0}
+        # Files read by the native header parser and files it left to mkvmerge -J
+        self.probe_backend_stats = {"native": 0, "mkvmerge": 0}
+        self.lock = threading.Lock()
+
+class MkvtError(Exception):
+    # Raised by the stages when a run can't continue, main prints the message and exits with code 1
+    pass
+# Codec names mkvmerge -J reports for the Matroska codec IDs, also looked up by the part before the first "/" (A_AAC/MPEG4/LC)
+# DTS and TrueHD are missing on purpose, mkvmerge names them after their bitstream (DTS-HD Master Audio, TrueHD Atmos), so those files are probed via mkvmerge
+matroska_codecs = {
+    "V_MPEG4/ISO/AVC": "AVC/H.264/MPEG-4p10", "V_MPEGH/ISO/HEVC": "HEVC/H.265/MPEG-H", "V_AV1": "AV1", "V_VP8": "VP8", "V_VP9": "VP9",
+    "V_MPEG1": "MPEG-1/2", "V_MPEG2": "MPEG-1/2", "V_MPEG4/ISO/ASP": "MPEG-4p2", "V_MPEG4/ISO/SP": "MPEG-4p2", "V_MPEG4/ISO/AP": "MPEG-4p2",
+    "V_THEORA": "Theora",
+    "A_AAC": "AAC", "A_AC3": "AC-3", "A_EAC3": "E-AC-3", "A_FLAC": "FLAC", "A_OPUS": "Opus", "A_VORBIS": "Vorbis",
+    "A_MPEG/L2": "MP2", "A_MPEG/L3": "MP3", "A_PCM": "PCM", "A_ALAC": "ALAC",
+    "S_TEXT/UTF8": "SubRip/SRT", "S_TEXT/ASCII": "SubRip/SRT", "S_TEXT/ASS": "SubStationAlpha", "S_TEXT/SSA": "SubStationAlpha",
+    "S_ASS": "SubStationAlpha", "S_SSA": "SubStationAlpha", "S_HDMV/PGS": "HDMV PGS", "S_VOBSUB": "VobSub", "S_TEXT/WEBVTT": "WebVTT",
+    "S_HDMV/TEXTST": "HDMV TextST", "S_DVBSUB": "DVBSUB"}
+
+# IETF codes mkvmerge -J reports for files that only have the legacy ISO 639-2 language, files with other languages are probed via mkvmerge
+legacy_langs = {
+    "und": "und", "mul": "mul", "zxx": "zxx", "mis": "mis", "eng": "en", "ger": "de", "deu": "de", "jpn": "ja", "fre": "fr", "fra": "fr",
+    "spa": "es", "ita": "it", "dut": "nl", "nld": "nl", "por": "pt", "rus": "ru", "chi": "zh", "zho": "zh", "kor": "ko", "pol": "pl",
+    "swe": "sv", "nor": "no", "nob": "nb", "nno": "nn", "dan": "da", "fin": "fi", "ice": "is", "isl": "is", "cze": "cs", "ces": "cs",
+    "slo": "sk", "slk": "sk", "slv": "sl", "hun": "hu", "rum": "ro", "ron": "ro", "bul": "bg", "hrv": "hr", "srp": "sr", "bos": "bs",
+    "ukr": "uk", "bel": "be", "gre": "el", "ell": "el", "tur": "tr", "ara": "ar", "heb": "he", "per": "fa", "fas": "fa", "hin": "hi",
+    "ben": "bn", "tam": "ta", "tel": "te", "urd": "ur", "tha": "th", "vie": "vi", "ind": "id", "may": "ms", "msa": "ms", "tgl": "tl",
+    "lit": "lt", "lav": "lv", "est": "et", "cat": "ca", "baq": "eu", "eus": "eu", "glg": "gl", "wel": "cy", "cym": "cy", "gle": "ga",
+    "lat": "la", "epo": "eo", "afr": "af", "alb": "sq", "sqi": "sq", "mac": "mk", "mkd": "mk", "geo": "ka", "kat": "ka", "arm": "hy",
+    "hye": "hy", "kaz": "kk", "mon": "mn", "khm": "km", "lao": "lo", "bur": "my", "mya": "my", "nep": "ne", "sin": "si", "kan": "kn",
+    "mal": "ml", "mar": "mr", "pan": "pa", "guj": "gu", "swa": "sw", "amh": "am", "som": "so", "yor": "yo", "zul": "zu", "xho": "xh"}
+
+# Timings of this run, printed and saved with --stats
+run_stats = {"enabled": False, "phases": {}, "probes": [], "remuxes": []}
+run_stats_lock = threading.Lock()
+
+# Track order separated by spaces, at least 1 track id must be given
+pattern_input = re.compile(r'^\s*\d{1,3}(?:\s+\d{1,3})*\s*$')
 
 # Audio codes are mandatory, subtitle codes optional, regional codes like en-US are supported as well as en or eng
 pattern_filter_langs = re.compile(r'^\s*\w{2,3}(?:-[\d\w]{2,4})?\s*?(?:\s\w{2,3}(?:-[\d\w]{2,4})?\s*?)*,(?:\s*\w{2,3}(?:-[\d\w]{2,4})?\s*?(?:\s\w{2,3}(?:-[\d\w]{2,4})?\s*)*)?$')
@@ -59,16 +231,27 @@ h_bar = "─"*100
 
 ################################################## FUNCTIONS ##################################################
 
+def tqdm(*args, **kwargs):
+    # tqdm takes longer to import than everything else, it is only imported once the first progress bar is shown
+    from tqdm import tqdm as progress_bar
+    return progress_bar(*args, **kwargs)
+
 def parse_arguments():
     def dir_path(path):
         if os.path.isdir(path) and path != None:
             return path
         else:
             raise argparse.ArgumentTypeError(f"readable_dir:{path} is not a valid path")
+
+    def positive_int(value):
+        if value.isdigit() and int(value) > 0:
+            return int(value)
+        else:
+            raise argparse.ArgumentTypeError(f"{value} is not a positive number")
     
     parser = argparse.ArgumentParser(description='Scan for .mkv files in subdirectories, choose a new track order and batch remux them.')
     parser.add_argument('-d', '--directory',
-                        help='The directory that will be recursively scanned for .mkv files.', type=dir_path, default=".", const=".", nargs="?")
+                        help='The directories that will be recursively scanned for .mkv files, hard links to the same file are only processed once.', type=dir_path, default=None, nargs="*", action="extend")
     parser.add_argument('-s', '--single_folder', action='store_true',
                         help='Only scan the current folder for .mkv files, no subdirectories.')
     parser.add_argument('--remove_attachments', action='store_true',
@@ -76,14 +259,68 @@ def parse_arguments():
     parser.add_argument('--stop_after_video_ends', action='store_true',
                         help='Trim other tracks to the video length.')
     parser.add_argument('--run_mkvp', action='store_true',
-                        help='After remuxing, use mkvpropr on the same directory to set file title, track names, languages and flags')
-    
+                        help='After remuxing, use mkvpropr on the directories of the changed files to set file title, track names, languages and flags')
+    parser.add_argument('--probe_jobs', type=positive_int, default=None,
+                        help='Number of files probed via mkvmerge -J at the same time. Default: number of CPU cores.')
+    parser.add_argument('--no_cache', action='store_true',
+                        help='Probe all files via mkvmerge -J without reading or updating the probe cache.')
+    parser.add_argument('--rebuild_cache', action='store_true',
+                        help='Discard the probe cache and probe all files again.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Start asking for track orders while the scan is still running, files found later are added to their group.')
+    parser.add_argument('--remux_early', action='store_true',
+                        help='Start remuxing each group in the background as soon as it has been answered.')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='Only show which files would be remuxed, edited in place or left alone after all groups have been answered.')
+    parser.add_argument('--scratch_dir', type=dir_path, default=None,
+                        help='Let mkvmerge write to this directory (e.g. on an SSD) and move the results next to the source files afterwards.')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print the time spent per phase, probe and remux latencies, throughput and the slowest files at the end.')
+    parser.add_argument('--stats_file', default=None,
+                        help='Also write the --stats timings including every single file to this JSON file.')
+    parser.add_argument('--remux_jobs', type=positive_int, default=None,
+                        help='Maximum number of files remuxed at the same time. Default: 4.')
+    parser.add_argument('--jobs_per_device', type=positive_int, default=None,
+                        help='Maximum number of files remuxed at the same time on one drive. Default: 1.')
+    parser.add_argument('--no_decisions', action='store_true',
+                        help='Neither offer nor save the track orders chosen for groups with the same tracks in earlier runs.')
+    parser.add_argument('--auto', action='store_true',
+                        help='Answer every group via saved track orders and the rules in the config without prompting, groups no rule matches are skipped and listed.')
+    parser.add_argument('--rules', default=None,
+                        help='YAML file with a "rules" list that replaces the rules in mkvt_config.yaml for --auto.')
+    parser.add_argument('-y', '--yes', action='store_true',
+                        help='Replace the original files without asking, e.g. for unattended runs with --auto.')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and process new .mkv files as soon as they are completely written, answered like --auto and replaced without asking.')
+    parser.add_argument('--poll', action='store_true',
+                        help='Let --watch scan the library periodically instead of using inotify.')
+    parser.add_argument('--rolling_replace', action='store_true',
+                        help='Replace each original file as soon as its remux has finished, so only the files being remuxed need extra space.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run without redoing the remuxes that already finished.')
+    parser.add_argument('--plan_out', metavar='PLAN_FILE',
+                        help='Write the remuxes and in place edits of the answered groups to this file instead of running them, for --execute.')
+    parser.add_argument('--execute', metavar='PLAN_FILE',
+                        help='Run the remuxes and in place edits of a --plan_out file without prompts, skipping files that changed since. -d replaces its directories.')
+    parser.add_argument('--worker', metavar='PLAN_FILE',
+                        help='Like --execute, but together with other --worker processes (on this or other hosts) that run the same plan on a shared filesystem.')
+    parser.add_argument('--no_verify', action='store_true',
+                        help='Replace the originals without first checking the tracks and duration of the remuxed files.')
+    parser.add_argument('--hardlinks', choices=["relink", "leave", "report"], default=None,
+                        help='What happens to the other hard links of a replaced file: relink them to the new file, leave them on the original or report them. Default: report.')
+    parser.add_argument('--probe_backend', choices=["mkvmerge", "native"], default=None,
+                        help='Read the track information via mkvmerge -J or the faster native Matroska header parser, which falls back to mkvmerge -J for unusual files. Default: mkvmerge.')
+    parser.add_argument('--validate_probe', action='store_true',
+                        help='Read all files via both probe backends, list the files whose track information differs and exit.')
+    parser.add_argument('--low_memory', action='store_true',
+                        help='Only keep the full track information of one file per group, for very large libraries.')
 
     args: argparse.Namespace = parser.parse_args()
 
     return args
 
 def mkv_tools_on_path():
+    # Returns False if mkvmerge or mkvpropedit is missing, main exits then
     if not shutil.which("mkvmerge") or not shutil.which("mkvpropedit") and sys.platform == "win32":
         choice = input("mkvmerge or mkvpropedit executable is not on PATH, open environment variable settings in Windows to add them? (y/n): ")
         if choice == "y":
@@ -111,19 +348,20 @@ def mkv_tools_on_path():
             except subprocess.CalledProcessError:
                 print(f"Error opening environment variable settings.")
                 sleep(1)
-            sys.exit()
+            return False
         else:
             print("Exiting in 1 second")
             sleep(1)
-            sys.exit()
+            return False
     elif not shutil.which("mkvmerge") or not shutil.which("mkvpropedit"):
         print("mkvmerge/mkvpropedit not on PATH, add them and try again.")
         sleep(1)
-        sys.exit()
+        return False
     else:
-        return
+        return True
 
 def mkvp_on_path():
+    # Returns the path of mkvp.py or False if it is missing
     if not shutil.which("mkvp.py") and sys.platform == "win32":
         choice = input("mkvp is not on PATH, open environment variable settings in Windows to add them? (y/n): ")
         if choice == "y":
@@ -146,27 +384,349 @@ def mkvp_on_path():
             except subprocess.CalledProcessError:
                 print(f"Error opening environment variable settings.")
                 sleep(1)
-            sys.exit()
+            return False
         else:
             print("Exiting in 1 second.")
             sleep(1)
-            sys.exit()
+            return False
     elif not shutil.which("mkvp.py"):
         print("mkvp not on PATH, add it and try again.")
         sleep(1)
-        sys.exit()
+        return False
     else:
         return shutil.which("mkvp.py")
 
-def fetch_json(file_path):
-    # Get all mkv info as JSON
+@contextmanager
+def stats_phase(name):
+    # Add the wall time of the block to the phase, phases that run more than once are summed up
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        with run_stats_lock:
+            run_stats["phases"][name] = run_stats["phases"].get(name, 0) + perf_counter() - start
+
+def record_stat(kind, entry):
+    if run_stats["enabled"]:
+        with run_stats_lock:
+            run_stats[kind].append(entry)
+
+def percentile(sorted_values, percent):
+    # Nearest rank percentile of an already sorted list
+    return sorted_values[min(len(sorted_values) - 1, round(percent / 100 * (len(sorted_values) - 1)))]
+
+def summarize_stats():
+    summary = {"phases": {name: round(seconds, 3) for name, seconds in run_stats["phases"].items()}}
+    probe_times = sorted(probe["seconds"] for probe in run_stats["probes"])
+    if probe_times:
+        summary["probe_seconds"] = {"count": len(probe_times), "p50": round(percentile(probe_times, 50), 4),
+                                    "p95": round(percentile(probe_times, 95), 4), "max": round(probe_times[-1], 4)}
+        summary["slowest_probes"] = sorted(run_stats["probes"], key=lambda probe: probe["seconds"], reverse=True)[:10]
+    remuxes = [remux for remux in run_stats["remuxes"] if remux["ok"]]
+    if remuxes:
+        remux_times = sorted(remux["seconds"] for remux in remuxes)
+        throughputs = sorted(remux["mb_per_s"] for remux in remuxes)
+        summary["remux_seconds"] = {"count": len(remux_times), "p50": round(percentile(remux_times, 50), 3),
+                                    "p95": round(percentile(remux_times, 95), 3), "max": round(remux_times[-1], 3)}
+        summary["remux_mb_per_s"] = {"p50": round(percentile(throughputs, 50), 1), "min": round(throughputs[0], 1),
+                                     "max": round(throughputs[-1], 1)}
+        # A drive that is much slower than the others shows up here
+        devices = {}
+        for remux in remuxes:
+            devices.setdefault(str(remux["device"]), []).append(remux["mb_per_s"])
+        summary["remux_mb_per_s_per_device"] = {device: round(percentile(sorted(values), 50), 1) for device, values in devices.items()}
+        summary["slowest_remuxes"] = sorted(remuxes, key=lambda remux: remux["mb_per_s"])[:10]
+    return summary
+
+def report_stats(stats_file=None):
+    summary = summarize_stats()
+    print(h_bar)
+    print("Time per phase:")
+    for name, seconds in summary["phases"].items():
+        print(f"  {name:20} {seconds:10.1f} s")
+    if "probe_seconds" in summary:
+        probe_seconds = summary["probe_seconds"]
+        print(f"mkvmerge -J: {probe_seconds['count']} files, p50 {probe_seconds['p50'] * 1000:.0f} ms, p95 {probe_seconds['p95'] * 1000:.0f} ms, max {probe_seconds['max'] * 1000:.0f} ms")
+        for probe in summary["slowest_probes"][:5]:
+            print(f"  {probe['seconds'] * 1000:8.0f} ms  {probe['file']}")
+    if "remux_seconds" in summary:
+        remux_seconds = summary["remux_seconds"]
+        remux_mb_per_s = summary["remux_mb_per_s"]
+        print(f"Remux: {remux_seconds['count']} files, p50 {remux_seconds['p50']:.1f} s, p95 {remux_seconds['p95']:.1f} s, max {remux_seconds['max']:.1f} s, "
+              f"p50 {remux_mb_per_s['p50']:.1f} MB/s, slowest {remux_mb_per_s['min']:.1f} MB/s")
+        for device, mb_per_s in summary["remux_mb_per_s_per_device"].items():
+            print(f"  device {device}: p50 {mb_per_s:.1f} MB/s")
+        for remux in summary["slowest_remuxes"][:5]:
+            print(f"  {remux['mb_per_s']:8.1f} MB/s  {remux['seconds']:8.1f} s  {remux['file']}")
+    print(h_bar)
+    if stats_file:
+        try:
+            with open(stats_file, "w", encoding="utf8") as f:
+                json.dump(dict(summary, probes=run_stats["probes"], remuxes=run_stats["remuxes"]), f, indent=2)
+            print(f"Stats written to {stats_file}")
+        except OSError:
+            print(f"Could not write stats to {stats_file}.")
+
+def fetch_json(session, file_path):
+    # Probe a file of the scan and record how long it took
+    start = perf_counter()
+    mkvmerge_json = identify(session, file_path)
+    record_stat("probes", {"file": file_path, "seconds": perf_counter() - start, "ok": mkvmerge_json is not None})
+    return mkvmerge_json
+
+def identify(session, file_path):
+    # Get the track info as JSON, via the native header parser first if it is the probe_backend, returns None if mkvmerge could not read the file
+    mkvmerge_json = None
+    if session.probe_backend == "native":
+        mkvmerge_json = read_mkv_header(file_path)
+        with session.lock:
+            session.probe_backend_stats["native" if mkvmerge_json is not None else "mkvmerge"] += 1
+    if mkvmerge_json is None:
+        mkvmerge_json = mkvmerge_identify(file_path)
+    return mkvmerge_json
+
+def mkvmerge_identify(file_path):
+    # Get all mkv info as JSON via mkvmerge -J, returns None if mkvmerge could not read the file
     mkvmerge_command = ["mkvmerge", "-J", file_path]
     try:
-        mkvmerge_json = json.loads((subprocess.check_output(mkvmerge_command)))
-    except subprocess.CalledProcessError:
-        print(f"Error while extracting track information for {file_path}")
+        mkvmerge_json = json.loads(subprocess.check_output(mkvmerge_command, stderr=subprocess.DEVNULL))
+    except (subprocess.CalledProcessError, OSError, ValueError):
+        mkvmerge_json = None
+    if mkvmerge_json is not None and (mkvmerge_json.get("errors") or "tracks" not in mkvmerge_json):
+        mkvmerge_json = None
     return mkvmerge_json
 
+def read_vint(data, pos, keep_marker=False):
+    # EBML variable length integer at pos, returns the value (None for an unknown size) and the position after it
+    length = 9 - data[pos].bit_length()
+    if length > 8 or pos + length > len(data):
+        raise ValueError("Invalid EBML variable length integer")
+    value = int.from_bytes(data[pos:pos + length], "big")
+    if keep_marker:
+        return value, pos + length
+    value &= (1 << 7 * length) - 1
+    return (None if value == (1 << 7 * length) - 1 else value), pos + length
+
+def read_element_header(data, pos):
+    # Element ID, data size and data position of the EBML element at pos
+    element_id, pos = read_vint(data, pos, keep_marker=True)
+    if element_id > 0xFFFFFFFF:
+        raise ValueError("Invalid EBML element ID")
+    size, pos = read_vint(data, pos)
+    return element_id, size, pos
+
+def iter_elements(data, start=0, end=None):
+    # Yield (element ID, data start, data end) of the child elements in data[start:end]
+    end = len(data) if end is None else end
+    pos = start
+    while pos < end:
+        element_id, size, pos = read_element_header(data, pos)
+        if size is None or pos + size > end:
+            raise ValueError("EBML element exceeds its parent")
+        yield element_id, pos, pos + size
+        pos += size
+
+def read_file_element(f, pos):
+    # Element ID, data size and data position of the EBML element at pos in the file
+    f.seek(pos)
+    element_id, size, data_pos = read_element_header(f.read(12), 0)
+    return element_id, size, pos + data_pos
+
+def read_file_data(f, pos, size, limit=1024**2):
+    # Data of a header element, header elements are small so anything big is treated as broken
+    if size is None or size > limit:
+        raise ValueError("EBML element too big")
+    f.seek(pos)
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("File ends within an EBML element")
+    return data
+
+def parse_track_entry(data, start, end, track_id):
+    # One TrackEntry as a track of the mkvmerge JSON
+    values = {element_id: data[data_start:data_end] for element_id, data_start, data_end in iter_elements(data, start, end)}
+    uint = lambda element_id, default: int.from_bytes(values[element_id], "big") if element_id in values else default
+    string = lambda element_id: values[element_id].rstrip(b"\0").decode("utf8")
+    track_type = {1: "video", 2: "audio", 17: "subtitles"}.get(uint(0x83, None))
+    codec_id = string(0x86) if 0x86 in values else ""
+    codec = matroska_codecs.get(codec_id) or matroska_codecs.get(codec_id.split("/")[0])
+    # Matroska's default language is English
+    language = string(0x22B59C) if 0x22B59C in values else "eng"
+    language_ietf = string(0x22B59D) if 0x22B59D in values else legacy_langs.get(language)
+    if track_type is None or codec is None or not language_ietf:
+        raise ValueError("Track that only mkvmerge can describe")
+    properties = {"language": language, "language_ietf": language_ietf,
+                  "default_track": bool(uint(0x88, 1)), "forced_track": bool(uint(0x55AA, 0))}
+    if 0x536E in values:
+        properties["track_name"] = string(0x536E)
+        if not properties["track_name"]:
+            raise ValueError("Empty track name")
+    if 0x55AB in values:
+        properties["flag_hearing_impaired"] = bool(uint(0x55AB, 0))
+    if 0x55AF in values:
+        properties["flag_commentary"] = bool(uint(0x55AF, 0))
+    return {"id": track_id, "type": track_type, "codec": codec, "properties": properties}
+
+def read_mkv_header(file_path):
+    # Read the tracks and attachments straight from the Matroska header in the shape of slim_json, without starting mkvmerge
+    # Only the EBML header, the SeekHead, Info, Tracks and the headers of the attachments are read, returns None for anything unusual so mkvmerge -J is used instead
+    try:
+        with open(file_path, "rb") as f:
+            element_id, size, pos = read_file_element(f, 0)
+            if element_id != 0x1A45DFA3:
+                return None
+            ebml_header = read_file_data(f, pos, size, limit=4096)
+            doc_type = next((ebml_header[start:end].rstrip(b"\0") for element_id, start, end in iter_elements(ebml_header) if element_id == 0x4282), b"matroska")
+            if doc_type not in (b"matroska", b"webm"):
+                return None
+            element_id, segment_size, segment_start = read_file_element(f, pos + size)
+            if element_id != 0x18538067:
+                return None
+            segment_end = os.fstat(f.fileno()).st_size if segment_size is None else segment_start + segment_size
+
+            # Level 1 elements in front of the first Cluster, SeekHead, Info, Tracks and Attachments -> (data position, size)
+            level1 = {}
+            pos = segment_start
+            while pos < segment_end:
+                element_id, size, data_pos = read_file_element(f, pos)
+                if element_id == 0x1F43B675 or size is None:
+                    break
+                if element_id in (0x114D9B74, 0x1549A966, 0x1654AE6B, 0x1941A469):
+                    level1.setdefault(element_id, (data_pos, size))
+                pos = data_pos + size
+            # Info, Tracks and Attachments behind the clusters are found via the SeekHead
+            if 0x114D9B74 in level1:
+                seek_head = read_file_data(f, *level1[0x114D9B74])
+                for element_id, start, end in iter_elements(seek_head):
+                    if element_id != 0x4DBB:
+                        continue
+                    seek = {child_id: seek_head[child_start:child_end] for child_id, child_start, child_end in iter_elements(seek_head, start, end)}
+                    target_id = int.from_bytes(seek.get(0x53AB, b""), "big")
+                    if target_id in (0x1549A966, 0x1654AE6B, 0x1941A469) and target_id not in level1 and 0x53AC in seek:
+                        found_id, size, data_pos = read_file_element(f, segment_start + int.from_bytes(seek[0x53AC], "big"))
+                        if found_id != target_id or size is None:
+                            return None
+                        level1[target_id] = (data_pos, size)
+            if 0x1654AE6B not in level1:
+                return None
+
+            # Duration in nanoseconds like mkvmerge reports it, stored in units of the TimestampScale
+            duration = None
+            if 0x1549A966 in level1:
+                info_data = read_file_data(f, *level1[0x1549A966])
+                info = {element_id: info_data[start:end] for element_id, start, end in iter_elements(info_data)}
+                if len(info.get(0x4489, b"")) in (4, 8):
+                    timestamp_scale = int.from_bytes(info[0x2AD7B1], "big") if 0x2AD7B1 in info else 1000000
+                    duration = int(struct.unpack(">f" if len(info[0x4489]) == 4 else ">d", info[0x4489])[0] * timestamp_scale)
+
+            tracks_data = read_file_data(f, *level1[0x1654AE6B])
+            tracks = [parse_track_entry(tracks_data, start, end, track_id)
+                      for track_id, (element_id, start, end) in enumerate(entry for entry in iter_elements(tracks_data) if entry[0] == 0xAE)]
+            # Attachments are only counted, mkvmerge numbers them from 1 in file order, the attached files themselves are skipped
+            attachment_count = 0
+            if 0x1941A469 in level1:
+                data_pos, size = level1[0x1941A469]
+                pos, end = data_pos, data_pos + size
+                while pos < end:
+                    element_id, size, data_pos = read_file_element(f, pos)
+                    if size is None:
+                        return None
+                    attachment_count += element_id == 0x61A7
+                    pos = data_pos + size
+    except (OSError, ValueError, IndexError, UnicodeDecodeError):
+        return None
+    return {"container": {"properties": {} if duration is None else {"duration": duration}},
+            "tracks": tracks, "attachments": [{"id": attachment_id} for attachment_id in range(1, attachment_count + 1)]}
+
+def slim_json(mkvmerge_json):
+    # Strip the mkvmerge JSON down to what is needed for sorting and selecting, so the cache stays small
+    slim_tracks = []
+    for track in mkvmerge_json["tracks"]:
+        properties = {prop: track["properties"][prop] for prop in ("language", "language_ietf", "track_name", "forced_track",
+                                                                    "default_track", "flag_hearing_impaired", "flag_commentary")
+                      if prop in track.get("properties", {})}
+        slim_tracks.append({"id": track["id"], "type": track["type"], "codec": track["codec"], "properties": properties})
+    slim_attachments = [{"id": attachment["id"]} for attachment in mkvmerge_json.get("attachments", [])]
+    return {"tracks": slim_tracks, "attachments": slim_attachments}
+
+def open_probe_cache(cache_file, rebuild=False):
+    # Open or create the probe cache, returns None if it can't be used so the scan continues without it
+    import sqlite3
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        connection = sqlite3.connect(cache_file, check_same_thread=False)
+        if rebuild or connection.execute("PRAGMA user_version").fetchone()[0] != probe_cache_version:
+            connection.execute("DROP TABLE IF EXISTS probes")
+        connection.execute("CREATE TABLE IF NOT EXISTS probes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, json TEXT)")
+        connection.execute(f"PRAGMA user_version = {probe_cache_version}")
+        connection.commit()
+    except (sqlite3.Error, OSError) as e:
+        print(f"Could not open probe cache {cache_file} ({e}), continuing without it.")
+        return None
+    return connection
+
+def cache_lookup(cache, file_path, file_stat):
+    # Return the cached JSON if the file is unchanged since it was probed, else None
+    row = cache.execute("SELECT size, mtime_ns, inode, json FROM probes WHERE path = ?", (os.path.abspath(file_path),)).fetchone()
+    if row and row[:3] == (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino):
+        return json.loads(row[3])
+    return None
+
+def cache_store(cache, file_path, file_stat, mkvmerge_json):
+    cache.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?)",
+                  (os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, json.dumps(slim_json(mkvmerge_json))))
+
+def cache_invalidate(cache, file_paths):
+    # Forget files that have been rewritten
+    cache.executemany("DELETE FROM probes WHERE path = ?", [(os.path.abspath(file_path),) for file_path in file_paths])
+    cache.commit()
+
+def probe_files(session, file_paths, probe_jobs, cache=None):
+    # Run fetch_json for up to probe_jobs files at the same time and yield (file_path, mkvmerge_json) in the order of file_paths
+    # Only a limited number of probes is queued ahead, so file_paths may also be a generator
+    # Files that are unchanged since they were last probed are answered from the cache without running mkvmerge
+    stored_count = 0
+
+    def finish(done_path, file_stat, future, cached_json):
+        nonlocal stored_count
+        if future is None:
+            return cached_json
+        mkvmerge_json = future.result()
+        if cache is not None and file_stat is not None and mkvmerge_json is not None:
+            cache_store(cache, done_path, file_stat, mkvmerge_json)
+            stored_count += 1
+            # Commit regularly so an interrupted scan doesn't lose everything probed so far
+            if stored_count % 1000 == 0:
+                cache.commit()
+        return mkvmerge_json
+
+    with ThreadPoolExecutor(max_workers=probe_jobs) as executor:
+        pending = deque()
+        for file_path in file_paths:
+            file_stat = None
+            cached_json = None
+            if cache is not None:
+                try:
+                    file_stat = os.stat(file_path)
+                    cached_json = cache_lookup(cache, file_path, file_stat)
+                except OSError:
+                    file_stat = None
+            if cached_json is not None:
+                session.probe_cache_stats["hits"] += 1
+                pending.append((file_path, file_stat, None, cached_json))
+            else:
+                if cache is not None:
+                    session.probe_cache_stats["misses"] += 1
+                pending.append((file_path, file_stat, executor.submit(fetch_json, session, file_path), None))
+            if len(pending) >= probe_jobs * 4:
+                done_path, *result = pending.popleft()
+                yield done_path, finish(done_path, *result)
+        while pending:
+            done_path, *result = pending.popleft()
+            yield done_path, finish(done_path, *result)
+    if cache is not None:
+        cache.commit()
+
 def track_exists(track, prop, alternative=None, fallback=False):
     # Check if the desired json element exists and return an alternative or a fallback if not
     if prop in track["properties"]:
@@ -176,23 +736,55 @@ def track_exists(track, prop, alternative=None, fallback=False):
     else:
         return fallback
 
-def get_track_info(mkvmerge_json):
-    track_info = {}
-    global sub_codec_replacements
+class VideoTrack(NamedTuple):
+    id: int
+    lang: str
+    name: str
+    codec: str
+
+class AudioTrack(NamedTuple):
+    id: int
+    lang: str
+    name: str
+    codec: str
+    default: bool
+    comm: bool
+
+class SubtitleTrack(NamedTuple):
+    id: int
+    lang: str
+    name: str
+    codec: str
+    forced: bool
+    default: bool
+    sdh: bool
+    comm: bool
+
+class TrackInfo(NamedTuple):
+    # Tuples of tracks per type in file order, kept as tuples instead of dicts to stay small for huge libraries
+    video: tuple = ()
+    audio: tuple = ()
+    subtitles: tuple = ()
+    attachments: tuple = () # attachment IDs, needed to remove attachments without remuxing
+
+def get_track_info(config, mkvmerge_json):
+    track_info = {"video": [], "audio": [], "subtitles": []}
+    sub_codec_replacements = config.sub_codec_replacements
 
     for track in mkvmerge_json["tracks"]:
         # Type
         track_type = track["type"]
-        # Codec
+        # Codec, the same few strings repeat in every file, so they are interned to be stored only once
         track_codec = track["codec"]
         if track_codec in sub_codec_replacements:
             track_codec = sub_codec_replacements[track_codec]
+        track_codec = sys.intern(track_codec)
         # ID
         track_id = track["id"]
         # Language, prefer newer ietf language code over legacy code
-        track_lang = track_exists(track, prop="language_ietf", alternative="language", fallback="und")
+        track_lang = sys.intern(track_exists(track, prop="language_ietf", alternative="language", fallback="und"))
         # Name
-        track_name = track_exists(track, prop="track_name", fallback="empty")
+        track_name = sys.intern(track_exists(track, prop="track_name", fallback="empty"))
         # Forced flag
         track_forced = track_exists(track, prop="forced_track")
         # Default flag
@@ -202,147 +794,283 @@ def get_track_info(mkvmerge_json):
         # Commentary flag
         track_comm = track_exists(track, prop="flag_commentary")
 
-        video_fields = {
-            "id": track_id,
-            "lang": track_lang,
-            "name": track_name,
-            "codec": track_codec
-        }
-        audio_fields = {
-            "id": track_id,
-            "lang": track_lang,
-            "name": track_name,
-            "codec": track_codec,
-            "default": track_default,
-            "comm": track_comm
-        }
-        subtitle_fields = {
-            "id": track_id,
-            "lang": track_lang,
-            "name": track_name,
-            "codec": track_codec,
-            "forced": track_forced,
-            "default": track_default,
-            "sdh": track_sdh,
-            "comm": track_comm
-        }
-        
-        # Sort track info by track type as key and a list of track dictionaries as value, which store the details as key:value pairs
-        if track_type == "video" and "video" in track_info:
-            track_info["video"].append(video_fields)
-        elif track_type == "video":
-            track_info["video"] = [video_fields]
-        elif track_type == "audio" and "audio" in track_info:
-            track_info["audio"].append(audio_fields)
+        # Sort track info by track type
+        if track_type == "video":
+            track_info["video"].append(VideoTrack(track_id, track_lang, track_name, track_codec))
         elif track_type == "audio":
-            track_info["audio"] = [audio_fields]
-        elif track_type == "subtitles" and  "subtitles" in track_info:
-            track_info["subtitles"].append(subtitle_fields)
+            track_info["audio"].append(AudioTrack(track_id, track_lang, track_name, track_codec, track_default, track_comm))
         elif track_type == "subtitles":
-            track_info["subtitles"] = [subtitle_fields]
+            track_info["subtitles"].append(SubtitleTrack(track_id, track_lang, track_name, track_codec, track_forced, track_default, track_sdh, track_comm))
         else:
             print("Parsing json failed.")
-    return track_info
+    attachment_ids = tuple(attachment["id"] for attachment in mkvmerge_json.get("attachments", []))
+    return TrackInfo(tuple(track_info["video"]), tuple(track_info["audio"]), tuple(track_info["subtitles"]), attachment_ids)
+
+def track_fingerprint(track_info):
+    # The track properties that decide which category a file belongs to, one tuple of fixed fields per track
+    return (tuple((track.id, track.lang) for track in track_info.video),
+            tuple((track.id, track.lang, track.name, track.default) for track in track_info.audio),
+            tuple((track.id, track.lang, track.name, track.codec, track.forced, track.default, track.sdh, track.comm) for track in track_info.subtitles))
+
+def fingerprint_digest(fingerprint):
+    # Short digest of a fingerprint, JSON keeps the field boundaries and is the same on every run and platform
+    return hashlib.blake2b(json.dumps(fingerprint, separators=(",", ":")).encode("utf8"), digest_size=8).hexdigest()
 
 def create_cat(track_info): # Create distinctive categories based on track information
-    cat = ""
-    for tracktype, tracks in track_info.items():
-        if tracktype == "video":
-            for track in tracks:
-                cat += f"{track["id"]}{track["lang"]}"
-        elif tracktype =="audio":
-            for track in tracks:
-                cat += f"{track["id"]}{track["lang"]}{track["name"]}{track["default"]}"
-        elif tracktype =="subtitles":
-            for track in tracks:
-                cat += f"{track["id"]}{track["lang"]}{track["name"]}{track["codec"]}{track["forced"]}{track["default"]}{track["sdh"]}{track["comm"]}"
-    return tuple((cat,))
+    return fingerprint_digest(track_fingerprint(track_info))
+
+class CategoryIndex:
+    # Maps fingerprints to their category so the digest is only computed once per category
+    # Digests are checked against the fingerprint they were created for, so two different fingerprints never share a category
+    def __init__(self):
+        self.categories = {} # fingerprint -> category
+        self.fingerprints = {} # category -> fingerprint
+
+    def lookup(self, track_info):
+        fingerprint = track_fingerprint(track_info)
+        cat = self.categories.get(fingerprint)
+        if cat is None:
+            cat = fingerprint_digest(fingerprint)
+            suffix = 1
+            while cat in self.fingerprints:
+                # Digest collision, practically impossible but resolved by numbering
+                suffix += 1
+                cat = f"{fingerprint_digest(fingerprint)}-{suffix}"
+            self.categories[fingerprint] = cat
+            self.fingerprints[cat] = fingerprint
+        return cat
+
+def scan_roots(directory):
+    # One directory or a list of directories (several -d)
+    return [directory] if isinstance(directory, (str, os.PathLike)) else list(directory)
+
+def iter_mkv_files(session, directory, single_folder=False):
+    # Walk the directory trees with os.scandir and lazily yield the paths of all wanted .mkv files, every directory is only listed once
+    # Subdirectories on ignore_dirs are not entered, the starting directories themselves are always scanned
+    # Every physical file (st_dev, st_ino) is only yielded once, further hard links to it are recorded in session.known_links instead
+    ignore_dirs, pattern_unwanted = session.config.ignore_dirs, session.config.pattern_unwanted
+    seen_dirs = set()
+    seen_files = {} # (st_dev, st_ino) -> path that was yielded
+    for root in scan_roots(directory):
+        # Only the roots are stat'ed, subdirectories take their (st_dev, st_ino) from the listing of their parent
+        try:
+            root_stat = os.stat(root)
+        except OSError:
+            print(f"Could not read {root}, skipping it.")
+            continue
+        pending_dirs = [(root, (root_stat.st_dev, root_stat.st_ino))]
+        while pending_dirs:
+            current_dir, dir_id = pending_dirs.pop()
+            # Nested or repeated roots are only walked once
+            if dir_id in seen_dirs:
+                continue
+            seen_dirs.add(dir_id)
+            try:
+                with os.scandir(current_dir) as dir_entries:
+                    entries = sorted(dir_entries, key=lambda entry: entry.name)
+            except OSError:
+                print(f"Could not read {current_dir}, skipping it.")
+                continue
+            subdirs = []
+            for entry in entries:
+                # The entry types come from the directory listing itself, no extra stat calls are needed
+                if entry.is_dir(follow_symlinks=False):
+                    if not single_folder and entry.name.lower() not in ignore_dirs: # ignore folders containing extras etc.
+                        try:
+                            # One lstat per subdirectory, its device can differ from the parent's when it is a mount point
+                            # Windows answers entry.stat from the listing but leaves st_dev and st_ino at zero, so it needs os.stat instead
+                            subdir_stat = entry.stat(follow_symlinks=False)
+                            if not subdir_stat.st_ino:
+                                subdir_stat = os.stat(entry.path)
+                        except OSError:
+                            print(f"Could not read {entry.path}, skipping it.")
+                            continue
+                        subdirs.append((entry.path, (subdir_stat.st_dev, subdir_stat.st_ino)))
+                elif entry.name.endswith(".mkv") and not re.match(pattern_unwanted, entry.name) and entry.is_file(): # Ignore trailers, samples
+                    # The inode is part of the directory listing on Linux and macOS, files share the device of their directory
+                    try:
+                        if entry.is_symlink():
+                            target_stat = os.stat(entry.path)
+                            file_id = (target_stat.st_dev, target_stat.st_ino)
+                        else:
+                            file_id = (dir_id[0], entry.inode())
+                    except OSError:
+                        continue
+                    if file_id in seen_files:
+                        session.known_links.setdefault(seen_files[file_id], set()).add(entry.path)
+                        continue
+                    seen_files[file_id] = entry.path
+                    yield entry.path
+            # Reversed so the subdirectories are visited in alphabetical order
+            pending_dirs.extend(reversed(subdirs))
+
+def sort_mkv_file(config, file_path, mkvmerge_json, category_dict, mkv_files, failed_probes, create_categories=True, low_memory=False, index=None):
+    # Store the track info of a probed file and sort it into its category, returns the category or None
+    if mkvmerge_json is None:
+        failed_probes.append(file_path)
+        return None
+    # Collect only the info needed for sorting and selecting
+    track_info = get_track_info(config, mkvmerge_json)
+    if not create_categories:
+        mkv_files[file_path] = track_info
+        return None
+    # Create a unique category based on track information
+    cat = index.lookup(track_info) if index is not None else create_cat(track_info)
+    # Sort file paths into groups
+    if cat in category_dict:
+        category_dict[cat].append(file_path)
+        if not low_memory:
+            mkv_files[file_path] = track_info
+        elif track_info.attachments:
+            # Only the attachment IDs differ from the representative, its track tuples are shared
+            representative = mkv_files[category_dict[cat][0]]
+            mkv_files[file_path] = representative._replace(attachments=track_info.attachments)
+    else:
+        # The first file of a category is its representative and always keeps its full track info
+        category_dict[cat] = [file_path]
+        mkv_files[file_path] = track_info
+    return cat
+
+def report_cache_stats(session):
+    probe_cache_stats = session.probe_cache_stats
+    print(f"Probe cache: {probe_cache_stats['hits']} " + ("hit, " if probe_cache_stats['hits'] == 1 else "hits, ") +
+          f"{probe_cache_stats['misses']} " + ("miss." if probe_cache_stats['misses'] == 1 else "misses."))
+
+def report_backend_stats(session):
+    probe_backend_stats = session.probe_backend_stats
+    print(f"Native header parser: {probe_backend_stats['native']} " + ("file" if probe_backend_stats['native'] == 1 else "files") +
+          f" read, {probe_backend_stats['mkvmerge']} left to mkvmerge -J.")
+
+def report_failed_probes(failed_probes):
+    if failed_probes:
+        print(f"Error while extracting track information for {len(failed_probes)} " + ("file, it" if len(failed_probes) == 1 else "files, they") + " will be ignored:")
+        for file_path in failed_probes:
+            print(file_path)
 
 # Fetch video, audio and subtitle information for mkv files and optionally sort them into categories
-def process_video_files(directory, single_folder, create_categories=True):
+def process_video_files(session, directory, single_folder, create_categories=True, probe_jobs=None, cache=None, low_memory=False):
+    probe_jobs = probe_jobs or session.config.probe_jobs
     category_dict = {}
     mkv_files = {}
-    if not single_folder:
-        with tqdm(desc="Sorting mkvs into categories", unit=" files", ncols=100) as pbar:
-            mkv_count = 0
-            pbar.set_postfix({"mkv files": mkv_count})
-            for filename in os.listdir(directory): # scan the root/base directory for .mkv files
-                pbar.update(1)
-                match_unwanted = re.match(pattern_unwanted, filename) # Ignore trailers, samples
-                if filename.endswith(".mkv") and not match_unwanted:
-                    mkv_count += 1
-                    pbar.set_postfix({"mkv files": mkv_count})
-                    file_path = os.path.join(directory, filename)
-                    # Get detailed mkv information as JSON
-                    mkvmerge_json = fetch_json(file_path)
-                    # Collect only the info needed for sorting and selecting
-                    track_info = get_track_info(mkvmerge_json)
-                    # Store track info for later use
-                    mkv_files[file_path] = track_info
-                    if create_categories:
-                        # Create a unique category based on track information
-                        cat = create_cat(track_info)
-                        # Sort file paths into groups
-                        if cat in category_dict:
-                            category_dict[cat].append(file_path)
-                        else:
-                            category_dict[cat] = [file_path]
-            for root, dirs, files in os.walk(directory): # scan subfolders recursively
-                dirs[:] = [d for d in dirs if d.lower() not in ignore_dirs] # ignore folders containing extras etc.
-                for dir in dirs:
-                    for filename in os.listdir(os.path.join(root, dir)):
-                        pbar.update(1)
-                        match_unwanted = re.match(pattern_unwanted, filename)
-                        if filename.endswith(".mkv") and not match_unwanted:
-                            mkv_count += 1
-                            pbar.set_postfix({"mkv files": mkv_count})
-                            file_path = os.path.join(root, dir, filename)
-                            # Get detailed mkv information as JSON
-                            mkvmerge_json = fetch_json(file_path)
-                            # Collect only the info needed for sorting and selecting
-                            track_info = get_track_info(mkvmerge_json)
-                            # Store track info for later use
-                            mkv_files[file_path] = track_info
-                            if create_categories:
-                                # Create a unique category based on track information
-                                cat = create_cat(track_info)
-                                # Sort file paths into groups
-                                if cat in category_dict:
-                                    category_dict[cat].append(file_path)
-                                else:
-                                    category_dict[cat] = [file_path]
-    else:
-        with tqdm(desc="searching", unit=" files", ncols=100) as pbar:
-            mkv_count = 0
-            pbar.set_postfix({"mkv files": mkv_count})
-            for filename in os.listdir(directory):
-                pbar.update(1)
-                match_unwanted = re.match(pattern_unwanted, filename)
-                if filename.endswith(".mkv") and not match_unwanted:
-                    mkv_count += 1
-                    pbar.set_postfix({"mkv files": mkv_count})
-                    file_path = os.path.join(directory, filename)
-                    # Get detailed mkv information as JSON
-                    mkvmerge_json = fetch_json(file_path)
-                    # Collect only the info needed for sorting and selecting
-                    track_info = get_track_info(mkvmerge_json)
-                    # Store track info for later use
-                    mkv_files[file_path] = track_info
-                    if create_categories:
-                        # Create a unique category based on track information
-                        cat = create_cat(track_info)
-                        # Sort file paths into groups
-                        if cat in category_dict:
-                            category_dict[cat].append(file_path)
-                        else:
-                            category_dict[cat] = [file_path]
-    if create_categories and category_dict == {}:
-        print(f"Found no .mkv files in {directory}, exiting.")
-        sys.exit(1)
-    elif not create_categories:
+    failed_probes = []
+    index = CategoryIndex()
+    with tqdm(desc="Sorting mkvs into categories", unit=" files", ncols=100) as pbar:
+        # Get detailed mkv information as JSON, several files at once while the directories are still being scanned
+        for file_path, mkvmerge_json in probe_files(session, iter_mkv_files(session, directory, single_folder), probe_jobs, cache=cache):
+            pbar.update(1)
+            sort_mkv_file(session.config, file_path, mkvmerge_json, category_dict, mkv_files, failed_probes, create_categories=create_categories, low_memory=low_memory, index=index)
+    report_failed_probes(failed_probes)
+    if not create_categories:
         return mkv_files
-    else:        
-        return category_dict, mkv_files
+    return category_dict, mkv_files
+
+def validate_probe_backends(session, directory, single_folder, probe_jobs=None):
+    # Read every file via the native header parser and via mkvmerge -J and list the files whose track info differs
+    # Returns the number of differing files
+    probe_jobs = probe_jobs or session.config.probe_jobs
+    def probe_both(file_path):
+        start = perf_counter()
+        native_json = read_mkv_header(file_path)
+        native_seconds = perf_counter() - start
+        start = perf_counter()
+        mkvmerge_json = mkvmerge_identify(file_path)
+        return native_json, native_seconds, mkvmerge_json, perf_counter() - start
+
+    file_paths = list(iter_mkv_files(session, directory, single_folder))
+    identical, differing, unsupported, unreadable = 0, [], 0, 0
+    native_seconds, mkvmerge_seconds = 0, 0
+    with ThreadPoolExecutor(max_workers=probe_jobs) as executor, tqdm(total=len(file_paths), desc="Comparing probe backends", unit=" files", ncols=100) as pbar:
+        for file_path, (native_json, native_time, mkvmerge_json, mkvmerge_time) in zip(file_paths, executor.map(probe_both, file_paths)):
+            pbar.update(1)
+            if mkvmerge_json is None:
+                unreadable += 1
+                continue
+            mkvmerge_seconds += mkvmerge_time
+            if native_json is None:
+                unsupported += 1
+                continue
+            native_seconds += native_time
+            native_info, mkvmerge_info = get_track_info(session.config, native_json), get_track_info(session.config, mkvmerge_json)
+            if native_info == mkvmerge_info:
+                identical += 1
+            else:
+                differing.append((file_path, native_info, mkvmerge_info))
+
+    for file_path, native_info, mkvmerge_info in differing:
+        print(h_bar)
+        print(file_path)
+        for field in TrackInfo._fields:
+            native_tracks, mkvmerge_tracks = getattr(native_info, field), getattr(mkvmerge_info, field)
+            if native_tracks != mkvmerge_tracks:
+                print(f"  {field} native:   {native_tracks}")
+                print(f"  {field} mkvmerge: {mkvmerge_tracks}")
+    print(h_bar)
+    print(f"Compared {len(file_paths)} files: {identical} identical, {len(differing)} different, "
+          f"{unsupported} left to mkvmerge -J by the native parser, {unreadable} not readable by mkvmerge.")
+    compared = identical + len(differing)
+    if compared:
+        print(f"Average per file: native {native_seconds / compared * 1000:.2f} ms, mkvmerge -J {mkvmerge_seconds / (compared + unsupported) * 1000:.2f} ms.")
+    return len(differing)
+
+class BackgroundScan:
+    # Probes and sorts the mkv files on a background thread so categories can be answered while the scan is still running
+    # category_dict and mkv_files fill up while the scan runs, files found later are simply appended to their category
+    def __init__(self, session, directory, single_folder, probe_jobs=None, cache=None, low_memory=False):
+        self.session = session
+        self.category_dict = {}
+        self.mkv_files = {}
+        self.failed_probes = []
+        self.index = CategoryIndex()
+        self.new_categories = deque() # categories that haven't been handed out via next_category yet
+        self.on_new_file = None # called with (cat, file_path) when a file is added to an existing category
+        self.file_count = 0
+        self.low_memory = low_memory
+        self.done = False
+        self.error = None # raised again by next_category and wait, a failed scan must not be mistaken for the whole library
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._scan, args=(directory, single_folder, probe_jobs or session.config.probe_jobs, cache), daemon=True)
+        self.thread.start()
+
+    def _scan(self, directory, single_folder, probe_jobs, cache):
+        with stats_phase("scan (background)"):
+            try:
+                for file_path, mkvmerge_json in probe_files(self.session, iter_mkv_files(self.session, directory, single_folder), probe_jobs, cache=cache):
+                    with self.condition:
+                        self.file_count += 1
+                        cat = sort_mkv_file(self.session.config, file_path, mkvmerge_json, self.category_dict, self.mkv_files, self.failed_probes, low_memory=self.low_memory, index=self.index)
+                        # The first file of a category makes it available for prompting
+                        if cat is not None and len(self.category_dict[cat]) == 1:
+                            self.new_categories.append(cat)
+                            self.condition.notify_all()
+                        elif cat is not None and self.on_new_file:
+                            self.on_new_file(cat, file_path)
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+            finally:
+                with self.condition:
+                    self.done = True
+                    self.condition.notify_all()
+
+    def next_category(self):
+        # Wait for the next new category, returns None once the scan is done and every category has been handed out
+        with self.condition:
+            while not self.new_categories and not self.done:
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+            return self.new_categories.popleft() if self.new_categories else None
+
+    def status(self):
+        with self.condition:
+            state = "Scan finished" if self.done else "Scan in progress"
+            return f"{state}: {self.file_count} files probed, {len(self.category_dict)} groups found, {len(self.new_categories)} waiting."
+
+    def wait(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.category_dict, self.mkv_files
 
 def split_inputs(user_input):
     # Divide the input into video, audio and subtitle parts
@@ -357,32 +1085,34 @@ def split_inputs(user_input):
         subtitle_tracks = None
     return video_track, audio_tracks, subtitle_tracks
 
-def print_track_info(track_info, filter_active=False, filter_langs=default_filter_langs):
+def print_track_info(config, track_info, filter_active=False, filter_langs=None):
+    default_filter_langs = config.default_filter_langs
+    filter_langs = filter_langs or default_filter_langs
     order = ["video", "audio", "subtitles"]  # Define the desired order
 
     for tracktype in order:
-        if tracktype not in track_info:
+        tracks = getattr(track_info, tracktype)
+        if not tracks:
             continue  # Skip if no tracks of this type exist
- 
-        tracks = track_info[tracktype]
+
         if tracktype == "video":
             # print("Video:")
             for track in tracks:
-                id = track["id"]
-                lang = track["lang"]
-                name = track["name"]
-                codec = track["codec"]
+                id = track.id
+                lang = track.lang
+                name = track.name
+                codec = track.codec
                 print(f"{id:2} | {lang:^5} | {name[:40]:40} | {codec:20}")
             print(h_bar)
         elif tracktype =="audio":
             # print("Audio:")
             for track in tracks:
-                id = track["id"]
-                lang = track["lang"]
-                name = track["name"]
-                codec = track["codec"]
-                default = "Default" if track["default"] else ""
-                comm = "Commentary" if track["comm"] else ""
+                id = track.id
+                lang = track.lang
+                name = track.name
+                codec = track.codec
+                default = "Default" if track.default else ""
+                comm = "Commentary" if track.comm else ""
                 if filter_active and lang not in filter_langs["audio"] and lang != "und":
                     continue
                 else:
@@ -391,14 +1121,14 @@ def print_track_info(track_info, filter_active=False, filter_langs=default_filte
         elif tracktype =="subtitles":
             # print("Subtitles:")
             for track in tracks:
-                id = track["id"]
-                lang = track["lang"]
-                name = track["name"]
-                codec = track["codec"]
-                forced = "Forced" if track["forced"] else ""
-                default = "Default" if track["default"] else ""
-                sdh = "SDH" if track["sdh"] else ""
-                comm = "Commentary" if track["comm"] else ""
+                id = track.id
+                lang = track.lang
+                name = track.name
+                codec = track.codec
+                forced = "Forced" if track.forced else ""
+                default = "Default" if track.default else ""
+                sdh = "SDH" if track.sdh else ""
+                comm = "Commentary" if track.comm else ""
                 if filter_active and lang not in filter_langs["sub"] and lang != "und":
                     continue
                 else:
@@ -409,25 +1139,36 @@ def print_track_info(track_info, filter_active=False, filter_langs=default_filte
     elif filter_active:
         print(f'{" "*17}CUSTOM FILTER ACTIVE, ENTER "t" TO TURN IT OFF or "p" TO EDIT IT!')
 
+def build_inputs_and_ids(track_info, inputs):
+    # Sort the chosen track IDs (strings) by type, the video tracks are always kept
+    audio_ids = [track.id for track in track_info.audio]
+    subtitle_ids = [track.id for track in track_info.subtitles]
+    return {"inputs": inputs,
+            "video_ids": [str(track.id) for track in track_info.video],
+            "audio_ids": [str(int(tid)) for tid in inputs if int(tid) in audio_ids],
+            "subtitle_ids": [str(int(tid)) for tid in inputs if int(tid) in subtitle_ids]}
+
 # Get the audio, subtitle and default-track info from the user
-def getInput(mkv_files, movies_in_cat, category_count, filter_active=False, filter_langs={}, last_input=""):
+def getInput(config, mkv_files, movies_in_cat, category_count, filter_active=False, filter_langs={}, last_input="", status=None, saved_input=None):
     # Validate inputs and requery in case of mistakes
+    default_filter_langs = config.default_filter_langs
     testmovie = movies_in_cat[0]
     track_info = mkv_files[testmovie]
     group_filecount = len(movies_in_cat)
-    # Create lists of the video, audio and subtitle track IDs that exist in the file for input validation
-    video_ids = [str(track["id"]) for track in track_info.get("video", [])] # video IDs are not used for validation, hence the direct string conversion
-    audio_ids = [track["id"] for track in track_info.get("audio", [])]
-    subtitle_ids = [track["id"] for track in track_info.get("subtitles", [])]
+    # Create lists of the audio and subtitle track IDs that exist in the file for input validation
+    audio_ids = [track.id for track in track_info.audio]
+    subtitle_ids = [track.id for track in track_info.subtitles]
 
     while True:
         print()
         print(h_bar)
         print(os.path.basename(testmovie)[:100])
         print(h_bar)
-        print_track_info(track_info=track_info, filter_active=filter_active, filter_langs=filter_langs)
+        print_track_info(config, track_info=track_info, filter_active=filter_active, filter_langs=filter_langs)
         print(h_bar)
         print('Audio and subtitle track order example: 2 1 4 3 5' if not last_input else f'Last input: {last_input}. Use "i" to reuse it')
+        if saved_input is not None:
+            print(f'Saved input from an earlier run: {"skip" if saved_input == "s" else saved_input or "no tracks"}. Press Enter to apply it')
         if filter_active:
             print(f'"s" skip, "p" edit filter, "t" deactivate filter, "n" apply selection "f" filenames, "ff" filepaths')
         elif filter_langs != dict(default_filter_langs):
@@ -435,10 +1176,19 @@ def getInput(mkv_files, movies_in_cat, category_count, filter_active=False, filt
         else:
             print(f'"s" skip group, "p" filter by language, "t" activate default filter, "f" filenames, "ff" filepaths')
         print(h_bar)
+        # Progress of work that is running in the background while the user is prompted
+        if status:
+            print(status())
+            print(h_bar)
         user_input = input(f"Group {category_count + 1} contains {group_filecount} " + ("files." if group_filecount > 1 else "file.") + " \nCodes please:\n")
 
+        # Apply the input saved for this group in an earlier run
+        if user_input == "" and saved_input is not None:
+            if saved_input == "s":
+                return saved_input, filter_active, last_input
+            return build_inputs_and_ids(track_info, saved_input.split()), filter_active, last_input
         # Skip the current group
-        if user_input == "s":
+        elif user_input == "s":
             return user_input, filter_active, last_input
         # Filter the displayed tracks via language codes
         elif user_input == "p":
@@ -448,7 +1198,7 @@ def getInput(mkv_files, movies_in_cat, category_count, filter_active=False, filt
 Enter audio and subtitle language codes to filter the selection.
 Enter 'd' to use the default.
 Default:
-{default_langs_readable}
+{config.default_langs_readable}
 Codes please:\n""")
                 if user_input == "d":
                     filter_active = True
@@ -470,13 +1220,10 @@ Codes please:\n""")
             continue
         # Add all tracks that pass the filters as inputs if you don't want to change their order, should be a quick way to only remove unwanted tracks
         elif user_input == "n" and filter_active:
-            filtered_audio_ids = [track["id"] for track in track_info.get("audio", [])if track["lang"] in filter_langs["audio"]]
-            filtered_subtitle_ids = [track["id"] for track in track_info.get("subtitles", [])if track["lang"] in filter_langs["sub"]]
+            filtered_audio_ids = [track.id for track in track_info.audio if track.lang in filter_langs["audio"]]
+            filtered_subtitle_ids = [track.id for track in track_info.subtitles if track.lang in filter_langs["sub"]]
             filtered_inputs = filtered_audio_ids + filtered_subtitle_ids
-            inputs_and_ids = {"inputs": [str(tid) for tid in filtered_inputs],
-                              "video_ids": video_ids,
-                              "audio_ids": [str(tid) for tid in filtered_inputs if tid in audio_ids],
-                              "subtitle_ids": [str(tid) for tid in filtered_inputs if tid in subtitle_ids]}
+            inputs_and_ids = build_inputs_and_ids(track_info, [str(tid) for tid in filtered_inputs])
             return inputs_and_ids, filter_active, last_input
         # List the filenames of all files in the current group
         elif user_input == "f":
@@ -514,10 +1261,7 @@ Codes please:\n""")
             continue
         # Check if all inputs correspond to either an audio track ID or a subtitle track ID
         if match_order and all(num in audio_ids or num in subtitle_ids for num in inputs_int):
-            inputs_and_ids = {"inputs": inputs,
-                              "video_ids": video_ids,
-                              "audio_ids": [str(tid) for tid in inputs_int if tid in audio_ids],
-                              "subtitle_ids": [str(tid) for tid in inputs_int if tid in subtitle_ids]}
+            inputs_and_ids = build_inputs_and_ids(track_info, inputs)
             last_input = user_input
             return inputs_and_ids, filter_active, last_input
         else:
@@ -525,69 +1269,970 @@ Codes please:\n""")
             sleep(1)
             continue
 
-def remux_files(category_inputs, category_dict):
-    mkvs_to_remux = 0
-    remuxed_files = []
-    failed_files = 0
-    for cat, inputs_ids in category_inputs.items():
-        mkvs_to_remux += len(category_dict[cat])
-    with tqdm(total = mkvs_to_remux, position=0, desc="Remuxing ", unit="mkv files", ncols=100) as pbar:
-        for cat, inputs_ids in category_inputs.items():
-            for mkv in category_dict[cat]:
-                # Construct the output file path by adding '_new' before the extension
-                output_path = mkv.replace('.mkv', '.new.mkv')
-
-                # Convert the track order from ["1", "2", "3", "4", "5"] to 0:0,0:1,0:2 etc. First add all video tracks as those are always kept
-                new_order = f'0:{inputs_ids["video_ids"][0]}'
-                if len(inputs_ids["video_ids"]) > 1:
-                    for video_id in inputs_ids["video_ids"][1:]:
-                        new_order = f'{new_order},0:{video_id}'
-                # Add the audio and video inputs to the track order
-                for track_id in inputs_ids["inputs"]:
-                    new_order = f'{new_order},0:{track_id}'
-                
-                # Construct the mkvmerge command
-                mkvmerge_cmd = [
-                    'mkvmerge', '-o', output_path,  # Specify output file
-                    "--track-order", new_order
-                ]
-                
-                # Remove all attachments from the files
-                if remove_attachments: mkvmerge_cmd.append("-M")
-                # Trim other tracks to the video length
-                if stop_after_video_ends: mkvmerge_cmd.append("--stop-after-video-ends")
-                # Only keep audio tracks chosen via input
-                if inputs_ids["audio_ids"]: mkvmerge_cmd.extend(["--audio-tracks", ",".join(inputs_ids["audio_ids"])])
-                # Only keep subtitle tracks chosen via input, if none are chosen, don't copy existing subtitles
-                mkvmerge_cmd.extend(["--subtitle-tracks", ",".join(inputs_ids["subtitle_ids"])]) if inputs_ids["subtitle_ids"] else mkvmerge_cmd.append("--no-subtitles")
-                # Input mkv file
-                mkvmerge_cmd.append(mkv)
+def load_decisions(decisions_file):
+    # Track orders chosen in earlier runs, keyed by the digest of their decision_fingerprint
+    try:
+        with open(decisions_file, "r", encoding="utf8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"Could not read saved track orders from {decisions_file} ({e}), starting without them.")
+        return {}
+
+def save_decisions(decisions_file, decisions):
+    # Written to a temporary file first so an interrupted run can't leave a truncated file behind
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(decisions_file)), exist_ok=True)
+        temp_file = decisions_file + ".tmp"
+        with open(temp_file, "w", encoding="utf8") as f:
+            json.dump(decisions, f)
+        os.replace(temp_file, decisions_file)
+    except OSError as e:
+        print(f"Could not save track orders to {decisions_file} ({e}).")
+
+def decision_fingerprint(track_info):
+    # The category fingerprint without the track names, release groups rename tracks ("English" -> "English 5.1") without changing which IDs to keep
+    return (tuple((track.id, track.lang) for track in track_info.video),
+            tuple((track.id, track.lang, track.default) for track in track_info.audio),
+            tuple((track.id, track.lang, track.codec, track.forced, track.default, track.sdh, track.comm) for track in track_info.subtitles))
+
+def lookup_decision(decisions, track_info):
+    # Return the saved input ("s" for skipped groups) for files with these tracks, or None
+    fingerprint = decision_fingerprint(track_info)
+    decision = decisions.get(fingerprint_digest(fingerprint))
+    # The full fingerprint is stored as well, a digest collision must not apply the wrong track order
+    if decision and json.loads(json.dumps(fingerprint)) == decision["fingerprint"]:
+        return decision["input"]
+    return None
+
+def record_decision(decisions, track_info, inputs_and_ids):
+    fingerprint = decision_fingerprint(track_info)
+    saved_input = inputs_and_ids if inputs_and_ids == "s" else " ".join(inputs_and_ids["inputs"])
+    # Stored as it is read back from the JSON file, so lookups in the same run compare lists with lists
+    decisions[fingerprint_digest(fingerprint)] = {"fingerprint": json.loads(json.dumps(fingerprint)), "input": saved_input}
+
+def confirm_decisions(known_categories, category_dict):
+    # Summary of the groups that have a saved track order, returns "y" (apply all), "r" (review each) or "n" (ask again)
+    print(h_bar)
+    print(f"{len(known_categories)} " + ("group has" if len(known_categories) == 1 else "groups have") + " a track order saved from an earlier run:")
+    for cat, saved_input in known_categories.items():
+        file_count = len(category_dict[cat])
+        print(f"{file_count:5} " + ("file " if file_count == 1 else "files") + f" | {'skip' if saved_input == 's' else saved_input or 'no tracks':20} | {os.path.basename(category_dict[cat][0])[:60]}")
+    print(h_bar)
+    while True:
+        user_input = input("Apply the saved track orders? y: apply all, r: review each group, n: ask for every group again\n(y/r/n): ")
+        if user_input in ("y", "r", "n"):
+            return user_input
+
+def compile_rules(config, raw_rules):
+    # Turn the rules from the config into lookup tables once, so evaluating them per group is cheap
+    # Returns None if a rule is invalid
+    default_filter_langs = config.default_filter_langs
+    compiled_rules = []
+    for number, raw_rule in enumerate(raw_rules or [], start=1):
+        try:
+            name = raw_rule.get("name") or f"rule {number}"
+            match = raw_rule.get("match") or {}
+            rule = {"name": name,
+                    "path": re.compile(match["path"]) if match.get("path") else None,
+                    "audio_langs": set(match.get("audio_langs") or []),
+                    "subtitle_langs": set(match.get("subtitle_langs") or []),
+                    "default": {"audio": "keep", "subtitles": "keep"}}
+            for tracktype, default_key in (("audio", "audio"), ("subtitles", "sub")):
+                selection = raw_rule.get(tracktype) or {}
+                # "default" reuses the languages of default_filter_langs
+                langs = default_filter_langs[default_key] if selection.get("langs") == "default" else selection.get("langs") or []
+                rule[tracktype] = {"langs": {lang: rank for rank, lang in reversed(list(enumerate(langs)))},
+                                   "codecs": {codec.lower(): rank for rank, codec in reversed(list(enumerate(selection.get("codecs") or [])))},
+                                   "max_per_lang": selection.get("max_per_lang"),
+                                   "commentary": selection.get("commentary", False),
+                                   "forced": selection.get("forced", True),
+                                   "sdh": selection.get("sdh", True)}
+            rule["default"].update(raw_rule.get("default") or {})
+            if rule["default"]["audio"] not in ("first", "none", "keep") or rule["default"]["subtitles"] not in ("first", "forced", "none", "keep"):
+                raise ValueError("unknown default track rule")
+        except (AttributeError, TypeError, ValueError, KeyError, re.error) as e:
+            print(f"Invalid rule {number} ({e}).")
+            return None
+        compiled_rules.append(rule)
+    return compiled_rules
+
+def select_tracks(tracks, selection):
+    # Keep the tracks whose language is listed, ordered by language priority, then codec priority, then file order
+    chosen = []
+    for track in tracks:
+        if track.lang not in selection["langs"] or (track.comm and not selection["commentary"]):
+            continue
+        if getattr(track, "forced", False) and not selection["forced"] or getattr(track, "sdh", False) and not selection["sdh"]:
+            continue
+        chosen.append(track)
+    # Regular tracks first, forced, SDH and commentary tracks of a language after them
+    chosen.sort(key=lambda track: (selection["langs"][track.lang], track.comm, getattr(track, "forced", False), getattr(track, "sdh", False),
+                                   selection["codecs"].get(track.codec.lower(), len(selection["codecs"])), track.id))
+    if selection["max_per_lang"]:
+        kept_per_lang = {}
+        limited = []
+        for track in chosen:
+            if not (track.comm or getattr(track, "forced", False) or getattr(track, "sdh", False)):
+                kept_per_lang[track.lang] = kept_per_lang.get(track.lang, 0) + 1
+                if kept_per_lang[track.lang] > selection["max_per_lang"]:
+                    continue
+            limited.append(track)
+        chosen = limited
+    return chosen
+
+def default_flags(tracks, mode):
+    # Default flag per kept track ID for one track type, empty if the flags are kept as they are
+    if mode == "keep":
+        return {}
+    if mode == "forced":
+        default_track = next((track for track in tracks if track.forced), None)
+    elif mode == "first" and tracks:
+        default_track = tracks[0]
+    else:
+        default_track = None
+    return {str(track.id): track is default_track for track in tracks}
+
+def apply_rules(rules, track_info, file_path):
+    # Return the name of the first matching rule and the inputs it selects, or (None, None) if no rule matches
+    audio_langs = {track.lang for track in track_info.audio}
+    subtitle_langs = {track.lang for track in track_info.subtitles}
+    for rule in rules:
+        if rule["path"] and not rule["path"].search(file_path):
+            continue
+        if rule["audio_langs"] and not rule["audio_langs"] & audio_langs or rule["subtitle_langs"] and not rule["subtitle_langs"] & subtitle_langs:
+            continue
+        audio_tracks = select_tracks(track_info.audio, rule["audio"])
+        # A rule that would remove every audio track doesn't match
+        if track_info.audio and not audio_tracks:
+            continue
+        subtitle_tracks = select_tracks(track_info.subtitles, rule["subtitles"])
+        inputs_and_ids = build_inputs_and_ids(track_info, [str(track.id) for track in audio_tracks + subtitle_tracks])
+        flags = default_flags(audio_tracks, rule["default"]["audio"]) | default_flags(subtitle_tracks, rule["default"]["subtitles"])
+        if flags:
+            inputs_and_ids["default_flags"] = flags
+        return rule["name"], inputs_and_ids
+    return None, None
+
+def auto_answer(track_info, file_path, rules, decisions=None):
+    # Answer a group without prompting, a saved input wins over the rules
+    # Returns where the answer came from and the inputs ("s" to skip), or (None, None) if nothing matches
+    saved_input = lookup_decision(decisions, track_info) if decisions is not None else None
+    if saved_input == "s":
+        return "saved track order", saved_input
+    elif saved_input is not None:
+        return "saved track order", build_inputs_and_ids(track_info, saved_input.split())
+    return apply_rules(rules, track_info, file_path)
+
+def load_rules(rules_file):
+    # Rules from a separate YAML file with a "rules" list, same format as in mkvt_config.yaml
+    import yaml
+    try:
+        with open(rules_file, "r", encoding="utf8") as f:
+            return (yaml.safe_load(f) or {}).get("rules") or []
+    except (OSError, yaml.YAMLError) as e:
+        print(f"Could not read rules from {rules_file} ({e}).")
+        return None
+
+def header_edits(session, track_info, inputs_ids):
+    # mkvpropedit arguments for the changes that don't need a remux, empty if there are none
+    edits = []
+    flags = inputs_ids.get("default_flags", {})
+    for track in track_info.audio + track_info.subtitles:
+        if str(track.id) in flags and flags[str(track.id)] != bool(track.default):
+            # mkvpropedit counts tracks from 1 in file order, mkvmerge IDs from 0
+            edits.extend(["--edit", f"track:{track.id + 1}", "--set", f"flag-default={int(flags[str(track.id)])}"])
+    if session.remove_attachments:
+        for attachment_id in track_info.attachments:
+            edits.extend(["--delete-attachment", str(attachment_id)])
+    return edits
+
+def plan_file(session, track_info, inputs_ids):
+    # Decide how a file has to be changed to match the chosen inputs:
+    # "skip" if nothing would change, "propedit" if only attachments or default flags change (done in place by mkvpropedit),
+    # "remux" if tracks are removed or reordered, which requires mkvmerge to rewrite the whole file
+    if session.stop_after_video_ends:
+        # Whether trimming changes anything is only known after remuxing
+        return "remux"
+    current_ids = sorted(track.id for track in track_info.video + track_info.audio + track_info.subtitles)
+    new_ids = [int(track_id) for track_id in inputs_ids["video_ids"] + inputs_ids["inputs"]]
+    if new_ids != current_ids:
+        return "remux"
+    elif header_edits(session, track_info, inputs_ids):
+        return "propedit"
+    else:
+        return "skip"
+
+def link_count(mkv):
+    try:
+        return os.stat(mkv).st_nlink
+    except OSError:
+        return 1
+
+def plan_files(session, mkv_paths, inputs_ids, mkv_files, plan, edits, layout=None, journal=None):
+    # Add the planned action of every file to plan, the mkvpropedit arguments of in place edits to edits
+    # and return the files that need a full remux
+    # The edits are journaled as soon as they are planned, they are only applied after the remuxes and a resumed run has to know about them
+    # With --low_memory files without attachments aren't stored, they have the same tracks as the first file of their category
+    layout = layout or mkv_files[mkv_paths[0]]
+    to_remux = []
+    for mkv in mkv_paths:
+        track_info = mkv_files.get(mkv) or layout._replace(attachments=())
+        plan[mkv] = plan_file(session, track_info, inputs_ids)
+        if plan[mkv] == "propedit" and session.hardlink_policy != "relink" and link_count(mkv) > 1:
+            # mkvpropedit would change every hard link of the file, a remux only changes this path
+            plan[mkv] = "remux"
+        if plan[mkv] == "remux":
+            to_remux.append(mkv)
+        elif plan[mkv] == "propedit":
+            edits[mkv] = header_edits(session, track_info, inputs_ids)
+            if journal is not None:
+                journal.record("edit", mkv=mkv, args=edits[mkv])
+    return to_remux
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+def report_plan(plan):
+    counts = {"remux": 0, "propedit": 0, "skip": 0}
+    sizes = {"remux": 0, "propedit": 0, "skip": 0}
+    for mkv, action in plan.items():
+        counts[action] += 1
+        try:
+            sizes[action] += os.path.getsize(mkv)
+        except OSError:
+            pass
+    print(h_bar)
+    print(f"{counts['remux']} " + ("file needs" if counts['remux'] == 1 else "files need") + f" a full remux ({format_size(sizes['remux'])} to rewrite).")
+    print(f"{counts['propedit']} " + ("file only needs" if counts['propedit'] == 1 else "files only need") + " their attachments or default flags changed in place via mkvpropedit.")
+    print(f"{counts['skip']} " + ("file is" if counts['skip'] == 1 else "files are") + " already in the chosen order and will be left alone.")
+    print(f"Rewriting avoided: {format_size(sizes['propedit'] + sizes['skip'])}")
+    print(h_bar)
+
+def report_free_space(mkv_paths, reserve, rolling_replace=False, jobs_per_device=1):
+    # Warn about drives that can't hold the remuxed copies, without rolling_replace all of them exist at the same time
+    sizes = {} # device -> directory of a file on it and the sizes of its files
+    for mkv in mkv_paths:
+        try:
+            mkv_stat = os.stat(mkv)
+        except OSError:
+            continue
+        sizes.setdefault(mkv_stat.st_dev, (os.path.dirname(os.path.abspath(mkv)), []))[1].append(mkv_stat.st_size)
+    for dir_path, file_sizes in sizes.values():
+        needed = sum(sorted(file_sizes, reverse=True)[:jobs_per_device]) if rolling_replace else sum(file_sizes)
+        try:
+            free = shutil.disk_usage(dir_path).free - reserve
+        except OSError:
+            continue
+        if needed > free:
+            print(f"The drive of {dir_path} needs up to {format_size(needed)} for the remuxed files but only {format_size(max(free, 0))} can be used.")
+            print("Remuxes that don't fit will be skipped." if rolling_replace else
+                  "Remuxes that don't fit will be skipped, with --rolling_replace only the files that are remuxed at the same time need space.")
+
+def apply_header_edits(edits, cache=None, journal=None):
+    # Remove attachments and set default flags in place via mkvpropedit, only the header of the file is rewritten
+    edited_files = []
+    with tqdm(total = len(edits), desc="Editing ", unit="files", ncols=100) as pbar:
+        for mkv, edit_args in edits.items():
+            mkvpropedit_cmd = ["mkvpropedit", mkv] + edit_args
+            try:
+                subprocess.run(mkvpropedit_cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+                edited_files.append(mkv)
+                if journal is not None:
+                    journal.record("edited", mkv=mkv)
+                pbar.update(1)
+            except (subprocess.CalledProcessError, OSError):
+                print(f"Error while editing {mkv} via mkvpropedit.")
+    if cache is not None:
+        cache_invalidate(cache, edited_files)
+    return edited_files
+
+def build_mkvmerge_cmd(session, mkv, output_path, inputs_ids):
+    # Convert the track order from ["1", "2", "3", "4", "5"] to 0:0,0:1,0:2 etc. First add all video tracks as those are always kept
+    new_order = f'0:{inputs_ids["video_ids"][0]}'
+    if len(inputs_ids["video_ids"]) > 1:
+        for video_id in inputs_ids["video_ids"][1:]:
+            new_order = f'{new_order},0:{video_id}'
+    # Add the audio and video inputs to the track order
+    for track_id in inputs_ids["inputs"]:
+        new_order = f'{new_order},0:{track_id}'
+    
+    # Construct the mkvmerge command
+    mkvmerge_cmd = [
+        'mkvmerge', '--gui-mode',  # Machine readable progress, warnings and errors
+        '-o', output_path,  # Specify output file
+        "--track-order", new_order
+    ]
+    
+    # Remove all attachments from the files
+    if session.remove_attachments: mkvmerge_cmd.append("-M")
+    # Trim other tracks to the video length
+    if session.stop_after_video_ends: mkvmerge_cmd.append("--stop-after-video-ends")
+    # Only keep audio tracks chosen via input
+    if inputs_ids["audio_ids"]: mkvmerge_cmd.extend(["--audio-tracks", ",".join(inputs_ids["audio_ids"])])
+    # Only keep subtitle tracks chosen via input, if none are chosen, don't copy existing subtitles
+    mkvmerge_cmd.extend(["--subtitle-tracks", ",".join(inputs_ids["subtitle_ids"])]) if inputs_ids["subtitle_ids"] else mkvmerge_cmd.append("--no-subtitles")
+    # Default flags chosen by a rule
+    for track_id, is_default in inputs_ids.get("default_flags", {}).items():
+        mkvmerge_cmd.extend(["--default-track-flag", f"{track_id}:{int(is_default)}"])
+    # Input mkv file
+    mkvmerge_cmd.append(mkv)
+    return mkvmerge_cmd
+
+def build_remux_job(session, mkv, inputs_ids):
+    # A job for one file, tagged with the device it lives on so the scheduler can spread the load over all drives
+    # Construct the output file path by adding '_new' before the extension
+    output_path = mkv.replace('.mkv', '.new.mkv')
+    try:
+        mkv_stat = os.stat(mkv)
+        device, size = mkv_stat.st_dev, mkv_stat.st_size
+    except OSError:
+        device, size = None, 0
+    return {"mkv": mkv,
+            "output_path": output_path,
+            "inputs_ids": inputs_ids,
+            "cmd": build_mkvmerge_cmd(session, mkv, output_path, inputs_ids),
+            "device": device,
+            "size": size}
+
+def build_remux_jobs(session, category_inputs, category_dict):
+    return [build_remux_job(session, mkv, inputs_ids) for cat, inputs_ids in category_inputs.items() for mkv in category_dict[cat]]
+
+def unwritten(reservations):
+    # Bytes the reserved (path, estimated size) outputs still need, what has already been written is missing from the free space of the drive
+    needed = 0
+    for path, size in reservations:
+        try:
+            needed += max(size - os.path.getsize(path), 0)
+        except OSError:
+            needed += size
+    return needed
+
+class RemuxScheduler:
+    # Runs remux jobs on background threads, at most remux_jobs at once and at most jobs_per_device on the same device
+    # A job only starts once its output (estimated by the size of the source) fits on the drive without going below reserve bytes,
+    # jobs that can't fit even though nothing else is running on their drive and jobs whose run_job raised an error are handed to skip_job
+    # Jobs marked with "scratch" write to the scratch directory, ScratchStaging reserves their space there and the source drive is only read
+    def __init__(self, run_job, remux_jobs, jobs_per_device, reserve, skip_job=None):
+        self.run_job = run_job
+        self.jobs_per_device = jobs_per_device
+        self.reserve = reserve
+        self.skip_job = skip_job
+        self.condition = threading.Condition()
+        self.queues = {} # device: deque of jobs that haven't been started yet
+        self.active = {} # device: number of running jobs
+        self.reserved = {} # device: [(output path, estimated size)] of the running jobs and moves
+        self.closed = False
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(remux_jobs)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, job):
+        with self.condition:
+            self.queues.setdefault(job["device"], deque()).append(job)
+            self.active.setdefault(job["device"], 0)
+            self.reserved.setdefault(job["device"], [])
+            self.condition.notify()
+
+    def close(self):
+        # No more jobs will be submitted, the worker threads exit once the queues are empty
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def join(self):
+        self.close()
+        for thread in self.threads:
+            thread.join()
+
+    def _free_space(self, device, job):
+        try:
+            free = shutil.disk_usage(os.path.dirname(os.path.abspath(job["output_path"]))).free
+        except OSError:
+            # Unknown free space doesn't block the remux, mkvmerge fails on its own if the drive is full
+            return job["size"]
+        return free - unwritten(self.reserved[device]) - self.reserve
+
+    def _next_job(self):
+        for device, pending in self.queues.items():
+            if not pending or self.active[device] >= self.jobs_per_device:
+                continue
+            # The first waiting job that fits, so smaller files can go ahead of one that has to wait for space
+            free = self._free_space(device, pending[0])
+            for index, job in enumerate(pending):
+                if job.get("scratch") or job["size"] <= free:
+                    del pending[index]
+                    break
+            else:
+                if self.active[device]:
+                    # Running jobs on this drive may still free up space
+                    continue
+                job = pending.popleft()
+                job["no_space"] = True
+                return job
+            self.active[device] += 1
+            job["reserved"] = None if job.get("scratch") else (job["output_path"], job["size"])
+            if job["reserved"] is not None:
+                self.reserved[device].append(job["reserved"])
+            return job
+        return None
+
+    def reserve_space(self, device, path, size):
+        # Space taken up on a drive outside of the jobs' own reservations, like a scratch remux that is moved back next to its source
+        with self.condition:
+            self.reserved.setdefault(device, []).append((path, size))
+
+    def release_space(self, device, path, size):
+        with self.condition:
+            self.reserved[device].remove((path, size))
+            self.condition.notify_all()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                job = self._next_job()
+                while job is None:
+                    if self.closed and not any(self.queues.values()):
+                        return
+                    self.condition.wait()
+                    job = self._next_job()
+            if job.get("no_space"):
+                print(f"Not enough free space to remux {job['mkv']}, skipping it.")
+                self._skip(job)
+                continue
+            try:
+                self.run_job(job)
+            except Exception as e:
+                # Only this job fails, the thread goes on with the remaining ones
+                print(f"Error while remuxing {job['mkv']} ({e}).")
+                self._skip(job)
+            finally:
+                with self.condition:
+                    self.active[job["device"]] -= 1
+                    if job["reserved"] is not None:
+                        self.reserved[job["device"]].remove(job["reserved"])
+                    self.condition.notify_all()
+
+    def _skip(self, job):
+        if self.skip_job is not None:
+            try:
+                self.skip_job(job)
+            except Exception as e:
+                print(f"Error while recording {job['mkv']} as failed ({e}).")
+
+def remux_file(job, progress=None):
+    # Returns True if mkvmerge succeeded, a failed output file is deleted
+    # The progress mkvmerge reports in GUI mode is passed on as progress(job, bytes_done), its warnings and errors are kept in the job
+    written_path = job.get("scratch_path") or job["output_path"]
+    job["warnings"], job["errors"] = [], []
+    start = perf_counter()
+    try:
+        with subprocess.Popen(job["cmd"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding="utf8", errors="replace") as process:
+            for line in process.stdout:
+                line = line.rstrip()
+                if line.startswith("#GUI#progress ") and progress is not None:
+                    percent = line[len("#GUI#progress "):].rstrip("%")
+                    if percent.isdigit():
+                        progress(job, job["size"] * int(percent) // 100)
+                elif line.startswith("#GUI#warning "):
+                    job["warnings"].append(line[len("#GUI#warning "):])
+                elif line.startswith("#GUI#error "):
+                    job["errors"].append(line[len("#GUI#error "):])
+        # Exit code 1 means mkvmerge finished with warnings, the output is complete
+        if process.returncode not in (0, 1):
+            raise subprocess.CalledProcessError(process.returncode, job["cmd"])
+        seconds = perf_counter() - start
+        record_stat("remuxes", {"file": job["mkv"], "device": job["device"], "seconds": seconds, "ok": True,
+                                "bytes_in": job["size"], "bytes_out": os.path.getsize(written_path),
+                                "mb_per_s": job["size"] / max(seconds, 1e-6) / 1e6, "warnings": job["warnings"]})
+        return True
+    except (subprocess.CalledProcessError, OSError):
+        record_stat("remuxes", {"file": job["mkv"], "device": job["device"], "seconds": perf_counter() - start, "ok": False,
+                                "errors": job["errors"], "warnings": job["warnings"]})
+        print(f"Error while remuxing to {written_path}" + (f" ({' '.join(job['errors'])})" if job["errors"] else "") + ". Deleting failed output file.")
+        try:
+            os.remove(written_path)
+        except OSError:
+            pass
+        return False
+
+def describe_track(track):
+    return f"{type(track).__name__[:-5].lower()} {track.lang}/{track.name}/{track.codec}"
+
+def verify_remux(session, job, written_path):
+    # Probe the remuxed file and its source and check the result against the chosen track order
+    # Returns why the remuxed file doesn't match or None if it does
+    source_json, output_json = identify(session, job["mkv"]), identify(session, written_path)
+    if source_json is None or output_json is None:
+        return "could not be read"
+    source, output = get_track_info(session.config, source_json), get_track_info(session.config, output_json)
+    inputs_ids = job["inputs_ids"]
+    # mkvmerge numbers the tracks of the new file from 0 in the chosen order
+    source_tracks = {track.id: track for track in source.video + source.audio + source.subtitles}
+    expected_tracks = [source_tracks.get(int(track_id)) for track_id in inputs_ids["video_ids"] + inputs_ids["inputs"]]
+    output_tracks = sorted(output.video + output.audio + output.subtitles, key=lambda track: track.id)
+    if len(output_tracks) != len(expected_tracks):
+        return f"{len(output_tracks)} tracks instead of {len(expected_tracks)}"
+    flags = inputs_ids.get("default_flags", {})
+    for expected, track in zip(expected_tracks, output_tracks):
+        if expected is None or describe_track(track) != describe_track(expected):
+            return f"track {track.id} is {describe_track(track)} instead of " + (describe_track(expected) if expected is not None else "missing from the source")
+        if str(expected.id) in flags and bool(track.default) != flags[str(expected.id)]:
+            return f"track {track.id} has the wrong default flag"
+    expected_attachments = 0 if session.remove_attachments else len(source.attachments)
+    if len(output.attachments) != expected_attachments:
+        return f"{len(output.attachments)} attachments instead of {expected_attachments}"
+    # Durations in nanoseconds, trimming to the video length may shorten the file
+    source_duration = source_json.get("container", {}).get("properties", {}).get("duration")
+    output_duration = output_json.get("container", {}).get("properties", {}).get("duration")
+    if source_duration and output_duration:
+        difference = (output_duration - source_duration) / 1e9
+        tolerance = session.config.verify_tolerance
+        if difference > tolerance or difference < -tolerance and not session.stop_after_video_ends:
+            return f"{output_duration / 1e9:.1f} s long instead of {source_duration / 1e9:.1f} s"
+    return None
+
+def quarantine_file(written_path, reason):
+    # Keep a remuxed file that failed verification for inspection under a name that is neither scanned nor cleaned up
+    quarantine_path = written_path + ".unverified"
+    try:
+        os.replace(written_path, quarantine_path)
+        print(f"{written_path} failed verification ({reason}), moved it to {quarantine_path}.")
+    except OSError:
+        print(f"{written_path} failed verification ({reason}), could not move it to {quarantine_path}.")
+    return quarantine_path
+
+class ScratchStaging:
+    # mkvmerge writes to the scratch directory, so the source drive only has to read, and a background thread moves the results back
+    # A remux only starts on the scratch drive if its output fits there, the size of the source file is used as the estimate
+    def __init__(self, session, scratch_dir):
+        self.session = session
+        self.scratch_dir = scratch_dir
+        self.reserve = session.config.scratch_reserve
+        self.reserved = [] # (scratch path, estimated size) of the remuxes that are still running
+        self.queued_moves = 0
+        self.condition = threading.Condition()
+        self.moves = queue.Queue()
+        self.thread = threading.Thread(target=self._move_worker, daemon=True)
+        self.thread.start()
+
+    def stage(self, job):
+        # Wait until the output fits on the scratch drive and point the job there
+        # Returns False if it will never fit, the job then writes next to its source as usual
+        path_hash = hashlib.sha1(os.path.abspath(job["mkv"]).encode("utf8")).hexdigest()[:12]
+        scratch_path = os.path.join(self.scratch_dir, f"{path_hash}-{os.path.basename(job['output_path'])}")
+        with self.condition:
+            while True:
                 try:
-                    subprocess.run(mkvmerge_cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
-                    remuxed_files.append(mkv)
-                    pbar.update(1)
-                except subprocess.CalledProcessError:
-                    print(f"Error while remuxing to {output_path}. Deleting failed output file.")
-                    failed_files += 1
+                    free = shutil.disk_usage(self.scratch_dir).free - unwritten(self.reserved) - self.reserve
+                except OSError as e:
+                    print(f"Could not use the scratch directory {self.scratch_dir} ({e}), remuxing {job['mkv']} next to its source.")
+                    return False
+                if job["size"] <= free:
+                    self.reserved.append((scratch_path, job["size"]))
+                    break
+                if not self.reserved and self.queued_moves == 0:
+                    return False
+                self.condition.wait()
+        job["scratch_path"] = scratch_path
+        job["cmd"] = build_mkvmerge_cmd(self.session, job["mkv"], job["scratch_path"], job["inputs_ids"])
+        return True
+
+    def unstage(self, job):
+        # The remux is done, its output is now part of the used space of the scratch drive
+        with self.condition:
+            self.reserved.remove((job["scratch_path"], job["size"]))
+            self.condition.notify_all()
+
+    def move_back(self, job, on_done):
+        # Queue the output to be moved next to the source file, on_done(job, success) is called afterwards
+        with self.condition:
+            self.queued_moves += 1
+        self.moves.put((job, on_done))
+
+    def _move_worker(self):
+        while True:
+            job, on_done = self.moves.get()
+            try:
+                shutil.move(job["scratch_path"], job["output_path"])
+                success = True
+            except OSError:
+                print(f"Could not move {job['scratch_path']} to {job['output_path']}. Deleting it.")
+                success = False
+                for path in (job["scratch_path"], job["output_path"]):
                     try:
-                        os.remove(output_path)
+                        os.remove(path)
                     except OSError:
                         pass
-    return remuxed_files, failed_files
+            with self.condition:
+                self.queued_moves -= 1
+                self.condition.notify_all()
+            try:
+                on_done(job, success)
+            except Exception as e:
+                print(f"Error after moving {job['output_path']} ({e}).")
+            finally:
+                self.moves.task_done()
 
-def replace_original_files(remuxed_files):
-    with tqdm(total = len(remuxed_files), desc="Replacing ", unit="files", ncols=100) as pbar:
-        for mkv_path in remuxed_files:
-            output_path = mkv_path.replace('.mkv', '.new.mkv')
+    def join(self):
+        self.moves.join()
+
+def file_signature(file_path):
+    # Size and modification time, used to tell whether a file is still the one recorded in the journal
+    try:
+        file_stat = os.stat(file_path)
+        return [file_stat.st_size, file_stat.st_mtime_ns]
+    except OSError:
+        return None
+
+def fsync_path(path):
+    # Flush a file or directory to disk, directories can't be opened for this on Windows
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+class Journal:
+    # Append-only JSON lines file with the remux jobs of a run and the state of every file, so an interrupted run can be resumed
+    # States per file: job (pending), remuxed, failed, synced (flushed to disk right before the replace), replaced, edit (pending) and edited
+    # The check of verify_remux happens before "remuxed" is recorded, failed checks are recorded as failed
+    def __init__(self, journal_file, header=None, append=False):
+        self.journal_file = journal_file
+        self.header = header
+        self.append = append
+        self.file = None
+        self.lock = threading.Lock()
+
+    def record(self, event, **entry):
+        # Absolute paths, a resumed run may be started from another working directory
+        entry["mkv"] = os.path.abspath(entry["mkv"])
+        with self.lock:
+            if self.file is None:
+                # Opened on the first record, runs that don't change anything leave no journal behind
+                os.makedirs(os.path.dirname(os.path.abspath(self.journal_file)), exist_ok=True)
+                self.file = open(self.journal_file, "a" if self.append else "w", encoding="utf8")
+                if self.header is not None and not self.append:
+                    self.file.write(json.dumps(dict(self.header, event="run")) + "\n")
+            self.file.write(json.dumps(dict(entry, event=event)) + "\n")
+            # Flushed right away so the entry survives the process being killed, fsynced in batches via sync
+            self.file.flush()
+
+    def sync(self):
+        with self.lock:
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+
+    def finish(self):
+        # The run is complete, nothing is left to resume
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
             try:
-                if os.path.isfile(output_path):
-                    os.remove(mkv_path)
-                    os.rename(output_path, mkv_path)
-                    pbar.update(1)
-            except OSError:
-                print(f"Could not replace {mkv_path}.")
+                os.remove(self.journal_file)
+            except FileNotFoundError:
                 pass
 
+def journal_header(session, directories, single_folder, rolling_replace):
+    # The settings the remux commands and the replacement depend on, a resumed run continues with them instead of the current config
+    return {"directories": [os.path.abspath(root) for root in directories], "single_folder": single_folder, "rolling_replace": rolling_replace,
+            "remove_attachments": session.remove_attachments, "stop_after_video_ends": session.stop_after_video_ends}
+
+def load_journal(session, journal_file):
+    # Replay the journal of an interrupted run, returns None if there is none
+    # Journals written before the settings were part of the header continue with the ones of the session
+    run = {"directories": ["."], "single_folder": False, "rolling_replace": False, "remove_attachments": session.remove_attachments,
+           "stop_after_video_ends": session.stop_after_video_ends, "jobs": {}, "edits": {}, "states": {}}
+    try:
+        with open(journal_file, "r", encoding="utf8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may have been cut off by a crash
+                    continue
+                if entry["event"] == "run":
+                    run.update((key, entry[key]) for key in ("directories", "single_folder", "rolling_replace", "remove_attachments", "stop_after_video_ends") if key in entry)
+                elif entry["event"] == "job":
+                    run["jobs"][entry["mkv"]] = entry
+                    run["states"].pop(entry["mkv"], None)
+                elif entry["event"] == "edit":
+                    run["edits"][entry["mkv"]] = entry["args"]
+                else:
+                    run["states"][entry["mkv"]] = entry
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        print(f"Could not read the journal {journal_file} ({e}).")
+        return None
+    return run
+
+def remux_pbar():
+    # Byte weighted, so the bar moves during long remuxes and shows the throughput and a realistic ETA, RemuxBatch adds the sizes to the total
+    return tqdm(total=0, position=0, desc="Remuxing ", unit="B", unit_scale=True, unit_divisor=1024, ncols=100)
+
+def report_remux_issues(batch):
+    if batch.warnings:
+        print(f"mkvmerge reported warnings for {len(batch.warnings)} " + ("file:" if len(batch.warnings) == 1 else "files:"))
+        for mkv, lines in batch.warnings.items():
+            print(mkv)
+            for line in lines:
+                print(f"    {line}")
+    if batch.quarantined:
+        print(f"{len(batch.quarantined)} remuxed " + ("file" if len(batch.quarantined) == 1 else "files") + " failed verification, the originals are kept:")
+        for mkv, (quarantine_path, reason) in batch.quarantined.items():
+            print(f"{quarantine_path} ({reason})")
+
+class RemuxBatch:
+    # Remuxes files on background threads as they are added and keeps track of the results
+    def __init__(self, session, remux_jobs=None, jobs_per_device=None, pbar=None, scratch_dir=None, journal=None, rolling_replace=False, on_done=None):
+        self.session = session
+        self.journal = journal
+        # Called with the file and "replaced", "remuxed" or "failed" once a job is done
+        self.on_done = on_done
+        # Replace each original as soon as its remux has finished, so at most one extra copy per running job takes up space
+        self.rolling_replace = rolling_replace
+        self.replaced = set()
+        self.jobs = []
+        self.remuxed = set()
+        self.failed_files = 0
+        self.done_bytes = {} # mkv: bytes of it that are counted in the progress bar
+        self.warnings = {} # mkv: warnings mkvmerge printed while remuxing it
+        self.quarantined = {} # mkv: (quarantined remux, reason) of remuxes that failed verification
+        self.lock = threading.Lock()
+        self.pbar = pbar
+        self.scratch = ScratchStaging(session, scratch_dir) if scratch_dir else None
+        self.scheduler = RemuxScheduler(self._run_job, remux_jobs or session.config.remux_jobs, jobs_per_device or session.config.remux_jobs_per_device,
+                                        session.config.free_space_reserve, skip_job=lambda job: self._record(job, False))
+
+    def add(self, mkv_paths, inputs_ids):
+        for mkv in mkv_paths:
+            job = build_remux_job(self.session, mkv, inputs_ids)
+            job["scratch"] = self.scratch is not None
+            with self.lock:
+                self.jobs.append(job)
+                if self.pbar is not None:
+                    self.pbar.total += job["size"]
+                    self.pbar.refresh()
+            if self.journal is not None:
+                self.journal.record("job", mkv=mkv, inputs_ids=inputs_ids, source=file_signature(mkv),
+                                    links=[os.path.abspath(link_path) for link_path in sorted(self.session.known_links.get(mkv, ()))])
+            self.scheduler.submit(job)
+
+    def _run_job(self, job):
+        staged, success, reserved = False, False, False
+        try:
+            staged = self.scratch is not None and self.scratch.stage(job)
+            if job["scratch"] and not staged:
+                # Written next to its source after all, the scheduler didn't reserve space there
+                reserved = True
+                self.scheduler.reserve_space(job["device"], job["output_path"], job["size"])
+            success = remux_file(job, progress=self._progress)
+            if success and self.session.verify_remuxes:
+                # Checked right after the remux on the same worker thread, so the remuxed files are verified in parallel before anything is replaced
+                written_path = job.get("scratch_path") or job["output_path"]
+                reason = verify_remux(self.session, job, written_path)
+                if reason is not None:
+                    with self.lock:
+                        self.quarantined[job["mkv"]] = (quarantine_file(written_path, reason), reason)
+                    success = False
+        except Exception as e:
+            print(f"Error while remuxing {job['mkv']} ({e}).")
+            success = False
+        finally:
+            if staged:
+                self.scratch.unstage(job)
+            if reserved:
+                self.scheduler.release_space(job["device"], job["output_path"], job["size"])
+        if staged and success:
+            # Counted as remuxed once the output is back next to the source, which needs the space for it until then
+            self.scheduler.reserve_space(job["device"], job["output_path"], job["size"])
+            self.scratch.move_back(job, self._moved)
+            return
+        self._record(job, success)
+
+    def _moved(self, job, success):
+        self.scheduler.release_space(job["device"], job["output_path"], job["size"])
+        self._record(job, success)
+
+    def _progress(self, job, done):
+        with self.lock:
+            delta = min(done, job["size"]) - self.done_bytes.get(job["mkv"], 0)
+            if delta > 0:
+                self.done_bytes[job["mkv"]] = self.done_bytes.get(job["mkv"], 0) + delta
+                if self.pbar is not None:
+                    self.pbar.update(delta)
+
+    def _record(self, job, success):
+        # Every job is counted exactly once, errors while journaling or replacing count it as failed
+        if job.get("recorded"):
+            return
+        job["recorded"] = True
+        if job.get("warnings"):
+            with self.lock:
+                self.warnings[job["mkv"]] = job["warnings"]
+        replaced = False
+        try:
+            if self.journal is not None:
+                if success:
+                    self.journal.record("remuxed", mkv=job["mkv"], output=file_signature(job["output_path"]))
+                else:
+                    self.journal.record("failed", mkv=job["mkv"])
+            replaced = success and self.rolling_replace and replace_file(self.session, job["mkv"], journal=self.journal)
+            if replaced:
+                fsync_path(os.path.dirname(os.path.abspath(job["mkv"])))
+        except Exception as e:
+            print(f"Error after remuxing {job['mkv']} ({e}).")
+            success = False
+        # Failed and skipped files count as done as well, so the ETA only covers the files that are left
+        self._progress(job, job["size"])
+        with self.lock:
+            if replaced:
+                self.replaced.add(job["mkv"])
+            elif success:
+                self.remuxed.add(job["mkv"])
+            else:
+                self.failed_files += 1
+            if self.pbar is not None:
+                self.pbar.set_postfix_str(f"{len(self.remuxed) + len(self.replaced) + self.failed_files}/{len(self.jobs)} files", refresh=False)
+        if self.on_done is not None:
+            self.on_done(job["mkv"], "replaced" if replaced else "remuxed" if success else "failed")
+
+    def status(self):
+        with self.lock:
+            finished = len(self.remuxed) + len(self.replaced) + self.failed_files
+            return f"Remuxing in background: {finished}/{len(self.jobs)} files done, {self.failed_files} " + ("error." if self.failed_files == 1 else "errors.")
+
+    def finish(self, pbar=None):
+        # Wait for all jobs, a pbar passed here continues from the bytes that have already been remuxed
+        if pbar is not None:
+            with self.lock:
+                self.pbar = pbar
+                pbar.total = sum(job["size"] for job in self.jobs)
+                pbar.update(sum(self.done_bytes.values()))
+        self.scheduler.join()
+        if self.scratch is not None:
+            self.scratch.join()
+        # Keep the order in which the files were added regardless of which remux finished first
+        remuxed_files = [job["mkv"] for job in self.jobs if job["mkv"] in self.remuxed]
+        return remuxed_files, self.failed_files
+
+    def replaced_files(self):
+        # Files that have already been replaced via rolling_replace
+        return [job["mkv"] for job in self.jobs if job["mkv"] in self.replaced]
+
+def remux_files(session, category_inputs, category_dict, remux_jobs=None, jobs_per_device=None, scratch_dir=None, journal=None, rolling_replace=False):
+    # Returns the remuxed files that still have to be replaced, the number of failed remuxes and the files that have already been replaced
+    with remux_pbar() as pbar:
+        batch = RemuxBatch(session, remux_jobs=remux_jobs, jobs_per_device=jobs_per_device, pbar=pbar, scratch_dir=scratch_dir, journal=journal, rolling_replace=rolling_replace)
+        for cat, inputs_ids in category_inputs.items():
+            batch.add(category_dict[cat], inputs_ids)
+        remuxed_files, failed_files = batch.finish()
+    report_remux_issues(batch)
+    return remuxed_files, failed_files, batch.replaced_files()
+
+def replace_file(session, mkv_path, journal=None):
+    # os.replace swaps the files atomically, there is no moment without a file at the original path
+    # The new file is flushed to disk before the swap, returns True if the file has been replaced
+    output_path = mkv_path.replace('.mkv', '.new.mkv')
+    try:
+        if os.path.isfile(output_path):
+            fsync_path(output_path)
+            if journal is not None:
+                journal.record("synced", mkv=mkv_path, output=file_signature(output_path))
+            original_stat = os.stat(mkv_path)
+            os.replace(output_path, mkv_path)
+            if journal is not None:
+                journal.record("replaced", mkv=mkv_path)
+            if original_stat.st_nlink > 1:
+                handle_hardlinks(session, mkv_path, original_stat)
+            return True
+    except OSError:
+        print(f"Could not replace {mkv_path}.")
+    return False
+
+def handle_hardlinks(session, mkv_path, original_stat):
+    # The other hard links of a replaced file still point to the original, with "relink" the ones the scan found are pointed to the new file
+    # Links outside the scanned directories can't be found, they and the links that are left on the original are kept for report_hardlinks
+    if session.hardlink_policy == "leave":
+        return
+    other_links = []
+    for link_path in sorted(session.known_links.get(mkv_path, ())):
+        try:
+            link_stat = os.stat(link_path)
+        except OSError:
+            continue
+        if (link_stat.st_dev, link_stat.st_ino) == (original_stat.st_dev, original_stat.st_ino):
+            other_links.append(link_path)
+    stale = list(other_links)
+    if session.hardlink_policy == "relink":
+        for link_path in other_links:
+            # Linked under a temporary name first, so the path never disappears
+            temp_path = link_path + ".relink"
+            try:
+                os.link(mkv_path, temp_path)
+                os.replace(temp_path, link_path)
+                stale.remove(link_path)
+            except OSError as e:
+                print(f"Could not link {link_path} to the new {mkv_path} ({e}).")
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+    outside_links = original_stat.st_nlink - 1 - len(other_links)
+    if stale or outside_links > 0:
+        with session.lock:
+            session.stale_links[mkv_path] = (stale, outside_links)
+
+def report_skipped_links(session):
+    # Hard links of already found files are only scanned once
+    skipped = sum(len(link_paths) for link_paths in session.known_links.values())
+    if skipped:
+        print(f"Skipped {skipped} " + ("hard link" if skipped == 1 else "hard links") + " to files that were already found, hard links of replaced files: " + session.hardlink_policy + ".")
+
+def report_hardlinks(session):
+    # List the replaced files whose other hard links still point to the original version
+    stale_links = session.stale_links
+    if stale_links:
+        print(f"{len(stale_links)} replaced " + ("file has" if len(stale_links) == 1 else "files have") + " hard links that still point to the original version:")
+        for mkv_path, (stale, outside_links) in stale_links.items():
+            print(mkv_path)
+            for link_path in stale:
+                print(f"    {link_path}")
+            if outside_links > 0:
+                print(f"    {outside_links} " + ("link" if outside_links == 1 else "links") + " outside the scanned directories")
+        stale_links.clear()
+
+def replace_original_files(session, remuxed_files, cache=None, journal=None):
+    # Returns the files that have been replaced, the directories are flushed in batches after the files have been replaced
+    replaced_files = []
+    dirty_dirs = set()
+    with tqdm(total = len(remuxed_files), desc="Replacing ", unit="files", ncols=100) as pbar:
+        for count, mkv_path in enumerate(remuxed_files, start=1):
+            if replace_file(session, mkv_path, journal=journal):
+                replaced_files.append(mkv_path)
+                dirty_dirs.add(os.path.dirname(os.path.abspath(mkv_path)))
+                pbar.update(1)
+            if dirty_dirs and (count % 100 == 0 or count == len(remuxed_files)):
+                for dir_path in dirty_dirs:
+                    fsync_path(dir_path)
+                dirty_dirs.clear()
+                if journal is not None:
+                    journal.sync()
+    # The replaced files have new track information, drop their cache entries
+    if cache is not None:
+        cache_invalidate(cache, remuxed_files)
+    return replaced_files
+
 def clean_up(remuxed_files):
     with tqdm(total = len(remuxed_files), desc="Cleaning up ", unit="files", ncols=100) as pbar:
         for mkv_path in remuxed_files:
@@ -599,97 +2244,923 @@ def clean_up(remuxed_files):
             except OSError:
                 print(f"Could not remove {output_path}.")
                 pass
-        print("Cleanup done, exiting in 1 second.")
-        sleep(1)
-        sys.exit()
+
+def wanted_new_file(config, directory, file_path):
+    # The same files a scan would pick up, apart from the .new.mkv files written by mkvtrackr itself
+    name = os.path.basename(file_path)
+    if not name.endswith(".mkv") or name.endswith(".new.mkv") or re.match(config.pattern_unwanted, name):
+        return False
+    for root in scan_roots(directory):
+        try:
+            subdirs = os.path.relpath(os.path.dirname(file_path), root).split(os.sep)
+        except ValueError:
+            # On another drive than this root on Windows
+            continue
+        if subdirs[0] != "..":
+            return not any(subdir.lower() in config.ignore_dirs for subdir in subdirs)
+    return False
+
+class InotifyWatcher:
+    # Reports .mkv files that are created, written or moved into the watched directories, only available on Linux
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    event_header = struct.Struct("iIII")
+
+    def __init__(self, session, directory, single_folder=False):
+        import ctypes
+        self.session = session
+        self.directory = directory
+        self.single_folder = single_folder
+        self.ignore_dirs = session.config.ignore_dirs
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {} # watch descriptor -> directory
+        self.error = None # set once a new directory could not be watched, the caller switches to polling then
+        for root in scan_roots(directory):
+            self.add_tree(root)
+
+    def add_tree(self, top_dir):
+        # Watch a directory and all of its subdirectories, returns the .mkv files that are already in them
+        import ctypes
+        found_files = []
+        pending_dirs = [top_dir]
+        while pending_dirs:
+            current_dir = pending_dirs.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(current_dir), self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+            if wd < 0:
+                error_code = ctypes.get_errno()
+                if error_code in (errno.ENOENT, errno.ENOTDIR):
+                    # Deleted or renamed since it was listed
+                    continue
+                # Usually fs.inotify.max_user_watches is too low for the library
+                raise OSError(error_code, f"Could not watch {current_dir}")
+            self.watches[wd] = current_dir
+            try:
+                with os.scandir(current_dir) as dir_entries:
+                    for entry in dir_entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not self.single_folder and entry.name.lower() not in self.ignore_dirs:
+                                pending_dirs.append(entry.path)
+                        elif entry.name.endswith(".mkv"):
+                            found_files.append(entry.path)
+            except OSError:
+                continue
+        return found_files
+
+    def read(self, timeout):
+        # Wait up to timeout seconds and return the paths of the changed files
+        import select
+        changed = []
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        data = os.read(self.fd, 1024 * 64)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                # Events were lost, fall back to looking at everything once
+                print("Too many changes at once, scanning the whole library.")
+                changed.extend(iter_mkv_files(self.session, self.directory, self.single_folder))
+            elif wd in self.watches and name:
+                path = os.path.join(self.watches[wd], name)
+                if mask & self.IN_ISDIR:
+                    # A new or moved in directory may already contain files
+                    if not self.single_folder and mask & (self.IN_CREATE | self.IN_MOVED_TO) and name.lower() not in self.ignore_dirs:
+                        try:
+                            changed.extend(self.add_tree(path))
+                        except OSError as e:
+                            # Parts of the new directory are not watched, report what it contains now and let the caller switch to polling
+                            self.error = e
+                            changed.extend(iter_mkv_files(self.session, path))
+                else:
+                    changed.append(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    # Fallback that compares the size and modification time of all .mkv files every poll_interval seconds
+    def __init__(self, session, directory, single_folder=False, poll_interval=None):
+        self.session = session
+        self.directory = directory
+        self.single_folder = single_folder
+        self.poll_interval = poll_interval or session.config.watch_poll_interval
+        self.last_poll = monotonic()
+        self.known = self.snapshot()
+
+    def snapshot(self):
+        files = {}
+        for file_path in iter_mkv_files(self.session, self.directory, self.single_folder):
+            try:
+                file_stat = os.stat(file_path)
+                files[file_path] = (file_stat.st_size, file_stat.st_mtime_ns)
+            except OSError:
+                continue
+        return files
+
+    def read(self, timeout):
+        if monotonic() - self.last_poll < self.poll_interval:
+            sleep(timeout)
+            return []
+        self.last_poll = monotonic()
+        current = self.snapshot()
+        changed = [file_path for file_path, signature in current.items() if self.known.get(file_path) != signature]
+        self.known = current
+        return changed
+
+def process_new_files(session, file_paths, rules, decisions, probe_jobs, cache, remux_jobs, jobs_per_device, scratch_dir, run_mkvp):
+    # The categorise, select, remux, replace and mkvpropr steps of a normal run for a few new files, answered via saved track orders and rules
+    # Returns the files that have been rewritten
+    category_dict, mkv_files, failed_probes = {}, {}, []
+    index = CategoryIndex()
+    for file_path, mkvmerge_json in probe_files(session, file_paths, probe_jobs, cache=cache):
+        sort_mkv_file(session.config, file_path, mkvmerge_json, category_dict, mkv_files, failed_probes, index=index)
+    report_failed_probes(failed_probes)
+    category_inputs, remux_dict, plan, edits = {}, {}, {}, {}
+    for cat, mkv_paths in category_dict.items():
+        source, inputs_and_ids = auto_answer(mkv_files[mkv_paths[0]], mkv_paths[0], rules, decisions)
+        if inputs_and_ids is None:
+            print(f"No rule matches {mkv_paths[0]}" + (f" and {len(mkv_paths) - 1} similar files" if len(mkv_paths) > 1 else "") + ", left for an interactive run.")
+            continue
+        elif inputs_and_ids == "s":
+            continue
+        category_inputs[cat] = inputs_and_ids
+        remux_dict[cat] = plan_files(session, mkv_paths, inputs_and_ids, mkv_files, plan, edits)
+    changed_files = []
+    if any(remux_dict.values()):
+        remuxed_files, failed_files, _ = remux_files(session, category_inputs=category_inputs, category_dict=remux_dict,
+                                                     remux_jobs=remux_jobs, jobs_per_device=jobs_per_device, scratch_dir=scratch_dir)
+        changed_files += replace_original_files(session, remuxed_files=remuxed_files, cache=cache)
+        report_hardlinks(session)
+    if edits:
+        changed_files += apply_header_edits(edits, cache=cache)
+    # Before returning, watch_directory records the files as they are after mkvpropr so they aren't taken for new ones
+    if changed_files and run_mkvp:
+        run_mkvpropr(changed_files)
+    return changed_files
+
+def watch_directory(session, directory, single_folder, settle_seconds, process, poll=False):
+    # Collect new files until their size and modification time have been stable for settle_seconds, then process them together
+    watcher = None
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            watcher = InotifyWatcher(session, directory, single_folder)
+            print(f"Watching {', '.join(scan_roots(directory))} via inotify.")
+        except (OSError, AttributeError) as e:
+            print(f"Could not use inotify ({e}), falling back to polling.")
+    if watcher is None:
+        watcher = PollingWatcher(session, directory, single_folder)
+        print(f"Watching {', '.join(scan_roots(directory))}, looking for new files every {watcher.poll_interval} seconds.")
+    pending = {} # path -> (size, mtime_ns) and when that signature was first seen
+    own_files = {} # files rewritten by mkvtrackr itself, their events are ignored
+    while True:
+        for file_path in watcher.read(timeout=1):
+            if wanted_new_file(session.config, directory, file_path):
+                pending[file_path] = None
+        if getattr(watcher, "error", None) is not None:
+            print(f"Could not keep watching via inotify ({watcher.error}), falling back to polling.")
+            watcher.close()
+            watcher = PollingWatcher(session, directory, single_folder)
+            print(f"Watching {', '.join(scan_roots(directory))}, looking for new files every {watcher.poll_interval} seconds.")
+        now = monotonic()
+        ready = []
+        for file_path, last in list(pending.items()):
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                # Deleted or renamed before it was finished
+                del pending[file_path]
+                continue
+            signature = (file_stat.st_size, file_stat.st_mtime_ns)
+            if own_files.get(file_path) == signature:
+                del pending[file_path]
+            elif last is None or last[0] != signature:
+                pending[file_path] = (signature, now)
+            elif now - last[1] >= settle_seconds:
+                ready.append(file_path)
+                del pending[file_path]
+        if ready:
+            print(h_bar)
+            print(f"Processing {len(ready)} new " + ("file." if len(ready) == 1 else "files."))
+            for file_path in process(sorted(ready)):
+                try:
+                    file_stat = os.stat(file_path)
+                    own_files[file_path] = (file_stat.st_size, file_stat.st_mtime_ns)
+                except OSError:
+                    pass
+
+def run_mkvpropr(changed_files):
+    # mkvpropr only takes a directory, so instead of the whole library it runs once per directory with changed files, without its subdirectories
+    changed_dirs = sorted({os.path.dirname(os.path.abspath(mkv)) for mkv in changed_files})
+    # Only reached after files have been changed, so a missing mkvpropr is reported instead of ending the run
+    mkvp_path = shutil.which("mkvp.py")
+    if mkvp_path is None:
+        print(f"mkvp.py is not on PATH, mkvpropr was not run in the {len(changed_dirs)} " + ("directory" if len(changed_dirs) == 1 else "directories") + " with changed files.")
+        return
+    with stats_phase("mkvpropr"):
+        for changed_dir in changed_dirs:
+            try:
+                subprocess.run(["python", mkvp_path, "-d", changed_dir, "-s"], check=True)
+            except (subprocess.CalledProcessError, OSError):
+                print(f"Error while executing mkvpropr in {changed_dir}.")
+
+def finish_run(session, remuxed_files, failed_files, edits, run_mkvp, cache=None, journal=None, yes=False, replaced_files=()):
+    # Replace the originals, apply the in place edits and run mkvpropr after asking for confirmation
+    # replaced_files have already been replaced right after their remux via rolling_replace
+    if replaced_files and cache is not None:
+        cache_invalidate(cache, replaced_files)
+    changed_files = list(replaced_files)
+    if remuxed_files or edits:
+        question = "Replace original .mkv files with the remuxed .new.mkv ones"
+        if edits:
+            question += f" and edit {len(edits)} " + ("file" if len(edits) == 1 else "files") + " in place"
+        if yes:
+            print(f"{question}? Confirmed via --yes.")
+            user_input = "y"
+        else:
+            user_input = input(f"{question}?\nTHIS STEP IS DESTRUCTIVE! CHECK THE RESULTS BEFORE YOU CONTINUE!\n(y/n): ")
+        if user_input == "y":
+            with stats_phase("replacing"):
+                # Replace the original files with the .new.mkv versions
+                changed_files += replace_original_files(session, remuxed_files=remuxed_files, cache=cache, journal=journal)
+                # Files that only lose their attachments or change their default flags are edited in place
+                if edits:
+                    changed_files += apply_header_edits(edits, cache=cache, journal=journal)
+
+        elif user_input == "n":
+            user_input = input("Remove the leftover .new.mkv files?\n(y/n): ")
+            if user_input == "y":
+                if journal is not None:
+                    journal.finish()
+                clean_up(remuxed_files)
+                print("Cleanup done, exiting in 1 second.")
+                sleep(1)
+                return
+            else:
+                # The journal is kept, --resume can still replace the files later
+                print("Execution aborted. Exiting in 1 second.")
+                sleep(1)
+                return
+
+    # Also covers the files replaced via rolling_replace
+    report_hardlinks(session)
+    # The run is complete before mkvpropr starts, a failing mkvpropr must not leave an interrupted run behind
+    if journal is not None:
+        journal.finish()
+    if cache is not None:
+        cache.commit()
+        cache.close()
+    if changed_files and run_mkvp:
+        run_mkvpropr(changed_files)
+
+    exit_time = 1
+    remuxed_count = len(remuxed_files) + len(replaced_files)
+    print(f"Remuxed {remuxed_count} mkv " + ("file ." if remuxed_count == 1 else "files. ") +
+          f"{failed_files} " + ("error. " if failed_files == 1 else "errors. ") + 
+          f"Exiting in {exit_time} " + ("second." if exit_time == 1 else "seconds."))
+    sleep(exit_time)
+
+def resume_run(session, journal_file, cache, remux_jobs, jobs_per_device, scratch_dir, run_mkvp, yes=False):
+    # Continue an interrupted run from its journal, finished remuxes are kept and only the missing ones are redone
+    run = load_journal(session, journal_file)
+    if run is None:
+        raise MkvtError("There is no interrupted run to resume.")
+    # The remuxes are redone with the settings of the interrupted run
+    session.remove_attachments, session.stop_after_video_ends = run["remove_attachments"], run["stop_after_video_ends"]
+    journal = Journal(journal_file, append=True)
+    remuxed_files, redo = [], []
+    for mkv, job in run["jobs"].items():
+        if job.get("links"):
+            session.known_links[mkv] = set(job["links"])
+        state = run["states"].get(mkv, {})
+        output_path = mkv.replace('.mkv', '.new.mkv')
+        if state.get("event") == "replaced":
+            continue
+        elif state.get("event") in ("remuxed", "synced") and file_signature(output_path) == state["output"]:
+            remuxed_files.append(mkv)
+        elif state.get("event") in ("remuxed", "synced") and file_signature(mkv) == state["output"]:
+            # Replaced right before the interruption, the record of it didn't make it into the journal
+            journal.record("replaced", mkv=mkv)
+        elif file_signature(mkv) != job["source"]:
+            print(f"{mkv} has changed since the interrupted run, skipping it.")
+        else:
+            redo.append(job)
+    edits = {mkv: edit_args for mkv, edit_args in run["edits"].items() if run["states"].get(mkv, {}).get("event") != "edited"}
+    print(f"Resuming the run in {', '.join(run['directories'])}: {len(remuxed_files)} " + ("file was" if len(remuxed_files) == 1 else "files were") +
+          f" already remuxed, {len(redo)} still " + ("needs" if len(redo) == 1 else "need") + f" to be remuxed, {len(edits)} in place " + ("edit." if len(edits) == 1 else "edits."))
+    failed_files, replaced_files = 0, []
+    if redo:
+        with stats_phase("remuxing"), remux_pbar() as pbar:
+            batch = RemuxBatch(session, remux_jobs=remux_jobs, jobs_per_device=jobs_per_device, pbar=pbar, scratch_dir=scratch_dir, journal=journal,
+                               rolling_replace=run["rolling_replace"])
+            for job in redo:
+                batch.add([job["mkv"]], job["inputs_ids"])
+            redone_files, failed_files = batch.finish()
+            replaced_files = batch.replaced_files()
+        report_remux_issues(batch)
+        remuxed_files += redone_files
+    journal.sync()
+    finish_run(session, remuxed_files, failed_files, edits, run_mkvp, cache=cache, journal=journal, yes=yes, replaced_files=replaced_files)
+
+def plan_entry(path, roots):
+    # A path as the index of its root and the path below it with / separators, so the plan can be run where the roots are mounted elsewhere
+    for root_index, root in enumerate(roots):
+        try:
+            relative_path = os.path.relpath(os.path.abspath(path), root)
+        except ValueError:
+            # On another drive than this root on Windows
+            continue
+        if relative_path.split(os.sep)[0] != os.pardir:
+            return [root_index, relative_path.replace(os.sep, "/")]
+    return None
+
+def plan_entry_path(entry, roots):
+    root_index, relative_path = entry
+    return os.path.join(roots[root_index], *relative_path.split("/"))
+
+def write_plan_file(session, plan_file, directory, single_folder, plan, edits, category_inputs, remux_dict):
+    # Everything --execute needs to remux and edit the files later without prompts, together with the size and modification time of each source
+    roots = [os.path.abspath(root) for root in directory]
+    actions = [(mkv, {"action": "remux", "inputs_ids": category_inputs[cat]}) for cat, mkv_paths in remux_dict.items() for mkv in mkv_paths]
+    actions += [(mkv, {"action": "propedit", "edit_args": edit_args}) for mkv, edit_args in edits.items()]
+    files = []
+    for mkv, action in actions:
+        files.append(dict(action, file=plan_entry(mkv, roots), source=file_signature(mkv),
+                          links=[plan_entry(link_path, roots) for link_path in sorted(session.known_links.get(mkv, ()))]))
+    with open(plan_file, "w", encoding="utf8") as f:
+        json.dump({"version": 1, "roots": roots, "single_folder": single_folder,
+                   "remove_attachments": session.remove_attachments, "stop_after_video_ends": session.stop_after_video_ends, "files": files}, f, indent=1)
+    print(f"Wrote the plan for {len(files)} " + ("file" if len(files) == 1 else "files") + f" to {plan_file}, run it via --execute {plan_file}" +
+          " (with -d if the directories are mounted elsewhere there).")
+
+def same_source(signature, planned_signature):
+    # Network shares may round modification times, so they only have to match to the second
+    return signature is not None and signature[0] == planned_signature[0] and abs(signature[1] - planned_signature[1]) < 1e9
+
+def load_plan(session, plan_file, directory):
+    # Read a plan written by --plan_out, returns it and the directories its paths are relative to
+    try:
+        with open(plan_file, "r", encoding="utf8") as f:
+            run = json.load(f)
+    except (OSError, ValueError) as e:
+        raise MkvtError(f"Could not read the plan {plan_file} ({e}).")
+    # The directories given via -d replace the planned ones in the same order, e.g. a share that is mounted elsewhere on the NAS
+    roots = [os.path.abspath(root) for root in directory] if directory else run["roots"]
+    if len(roots) != len(run["roots"]):
+        raise MkvtError(f"The plan was made for {len(run['roots'])} " + ("directory" if len(run["roots"]) == 1 else "directories") +
+                        f" ({', '.join(run['roots'])}), -d has to give the same number of directories.")
+    # The plan was made with these settings, the mkvmerge commands have to match it
+    session.remove_attachments, session.stop_after_video_ends = run["remove_attachments"], run["stop_after_video_ends"]
+    return run, roots
+
+def execute_plan(session, plan_file, directory, cache, remux_jobs, jobs_per_device, scratch_dir, run_mkvp, rolling_replace=False):
+    # Remux and edit the files of a plan written by --plan_out without prompts, files that changed since the plan was written are skipped
+    run, roots = load_plan(session, plan_file, directory)
+    to_remux, edits, changed = [], {}, 0
+    for file_entry in run["files"]:
+        mkv = plan_entry_path(file_entry["file"], roots)
+        if not same_source(file_signature(mkv), file_entry["source"]):
+            print(f"{mkv} has changed or is missing since the plan was made, skipping it.")
+            changed += 1
+            continue
+        if file_entry["links"]:
+            session.known_links[mkv] = {plan_entry_path(link_entry, roots) for link_entry in file_entry["links"]}
+        if file_entry["action"] == "remux":
+            to_remux.append((mkv, file_entry["inputs_ids"]))
+        else:
+            edits[mkv] = file_entry["edit_args"]
+    print(f"Executing the plan {plan_file} in {', '.join(roots)}: {len(to_remux)} " + ("file" if len(to_remux) == 1 else "files") +
+          f" to remux, {len(edits)} in place " + ("edit" if len(edits) == 1 else "edits") + f", {changed} changed " + ("file" if changed == 1 else "files") + " skipped.")
+    if not to_remux and not edits:
+        print("Nothing left to do, exiting.")
+        return
+    report_free_space([mkv for mkv, inputs_ids in to_remux], session.config.free_space_reserve, rolling_replace=rolling_replace, jobs_per_device=jobs_per_device)
+    # Journaled like a normal run, so an interrupted execution can be continued via --resume
+    journal = Journal(session.config.journal_file, header=journal_header(session, roots, run["single_folder"], rolling_replace))
+    for mkv, edit_args in edits.items():
+        journal.record("edit", mkv=mkv, args=edit_args)
+    remuxed_files, failed_files, replaced_files = [], 0, []
+    if to_remux:
+        with stats_phase("remuxing"), remux_pbar() as pbar:
+            batch = RemuxBatch(session, remux_jobs=remux_jobs, jobs_per_device=jobs_per_device, pbar=pbar, scratch_dir=scratch_dir, journal=journal, rolling_replace=rolling_replace)
+            for mkv, inputs_ids in to_remux:
+                batch.add([mkv], inputs_ids)
+            remuxed_files, failed_files = batch.finish()
+            replaced_files = batch.replaced_files()
+        report_remux_issues(batch)
+    journal.sync()
+    finish_run(session, remuxed_files, failed_files, edits, run_mkvp, cache=cache, journal=journal, yes=True, replaced_files=replaced_files)
+
+class PlanClaims:
+    # Claims of the files of a plan in a directory on the shared filesystem, so several --worker processes on one or more hosts can work through it
+    # A file is claimed by creating <index>.lock exclusively and finished by writing <index>.done, held claims get a heartbeat by touching their lock
+    # A stale lock is taken over by whoever creates its <index>.lock.<inode>-<heartbeat>.takeover first
+    def __init__(self, claims_dir, stale_seconds):
+        import socket
+        self.claims_dir = claims_dir
+        self.stale_seconds = stale_seconds
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.held = set()
+        self.finished = set()
+        self.lock = threading.Lock()
+        os.makedirs(claims_dir, exist_ok=True)
+        self.measure_clock()
+
+    def path(self, index, kind):
+        return os.path.join(self.claims_dir, f"{index}.{kind}")
+
+    def is_done(self, index):
+        if index not in self.finished and os.path.exists(self.path(index, "done")):
+            self.finished.add(index)
+        return index in self.finished
+
+    def claim(self, index):
+        # Returns whether this worker now holds the file
+        if self.is_done(index):
+            return False
+        for attempt in range(2):
+            try:
+                fd = os.open(self.path(index, "lock"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if attempt or not self._reclaim(index):
+                    return False
+                continue
+            with os.fdopen(fd, "w", encoding="utf8") as f:
+                f.write(self.worker_id)
+            # It may have been finished by the worker whose stale claim was just taken over
+            if self.is_done(index):
+                self.release(index)
+                return False
+            with self.lock:
+                self.held.add(index)
+            return True
+        return False
+
+    def measure_clock(self):
+        # Lock ages are measured with the clock of the shared filesystem, read from a file touched right now, so the hosts' clocks don't have to agree
+        alive_path = os.path.join(self.claims_dir, f"{self.worker_id}.alive")
+        with open(alive_path, "w"):
+            pass
+        self.clock_offset = os.stat(alive_path).st_mtime - monotonic()
+        os.remove(alive_path)
+
+    def _shared_time(self):
+        return monotonic() + self.clock_offset
+
+    def _reclaim(self, index):
+        # Take over a claim whose heartbeat stopped
+        # The takeover of this particular lock (inode and last heartbeat) is itself claimed exclusively first, so of several workers that found the
+        # same stale lock only one moves it away, the others can't mistake the new lock of the worker that took it over for the stale one
+        lock_path = self.path(index, "lock")
+        try:
+            lock_stat = os.stat(lock_path)
+            if self._shared_time() - lock_stat.st_mtime < self.stale_seconds:
+                return False
+            with open(lock_path, "r", encoding="utf8") as f:
+                stale_worker = f.read()
+            takeover_path = f"{lock_path}.{lock_stat.st_ino}-{lock_stat.st_mtime_ns}.takeover"
+            os.close(os.open(takeover_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            stale_path = f"{lock_path}.{self.worker_id}.stale"
+            os.rename(lock_path, stale_path)
+        except OSError:
+            return False
+        try:
+            moved_stat = os.stat(stale_path)
+            with open(stale_path, "r", encoding="utf8") as f:
+                moved_worker = f.read()
+            if (moved_stat.st_ino, moved_stat.st_mtime_ns, moved_worker) != (lock_stat.st_ino, lock_stat.st_mtime_ns, stale_worker):
+                # The worker sent a heartbeat or released its claim in the meantime, its lock is put back and the file left alone
+                try:
+                    os.link(stale_path, lock_path)
+                except OSError:
+                    pass
+                return False
+        except OSError:
+            return False
+        finally:
+            try:
+                os.remove(stale_path)
+            except OSError:
+                pass
+        print(f"Taking over the claim of {stale_worker} on file {index} of the plan, it has not sent a heartbeat for {self.stale_seconds:.0f} seconds.")
+        return True
+
+    def heartbeat(self):
+        try:
+            self.measure_clock()
+        except OSError:
+            pass
+        with self.lock:
+            held = list(self.held)
+        for index in held:
+            try:
+                os.utime(self.path(index, "lock"))
+            except OSError:
+                pass
+
+    def finish(self, index, result, mkv):
+        # Written under a temporary name and renamed, so a .done file is always complete
+        done_path = self.path(index, "done")
+        with open(f"{done_path}.{self.worker_id}", "w", encoding="utf8") as f:
+            json.dump({"result": result, "mkv": mkv, "worker": self.worker_id}, f)
+        os.replace(f"{done_path}.{self.worker_id}", done_path)
+        self.finished.add(index)
+        self.release(index)
+
+    def release(self, index):
+        try:
+            os.remove(self.path(index, "lock"))
+        except OSError:
+            pass
+        with self.lock:
+            self.held.discard(index)
+
+    def results(self, count):
+        results = {}
+        for index in range(count):
+            try:
+                with open(self.path(index, "done"), "r", encoding="utf8") as f:
+                    results[index] = json.load(f)
+            except (OSError, ValueError):
+                pass
+        return results
+
+def run_worker(session, plan_file, directory, cache, remux_jobs, jobs_per_device, scratch_dir, run_mkvp):
+    # Work through a plan together with other --worker processes that use the same plan on the shared filesystem
+    # Each file is claimed before it is remuxed (and replaced right after) or edited, the last worker to finish runs mkvpropr
+    run, roots = load_plan(session, plan_file, directory)
+    files = run["files"]
+    claims = PlanClaims(plan_file + ".claims", session.config.worker_stale)
+    print(f"Working on the plan {plan_file} in {', '.join(roots)} as {claims.worker_id}, {len(files)} " + ("file" if len(files) == 1 else "files") + " in the plan.")
+    # Only as many files are claimed as can be remuxed right away, the rest stays available to the other workers
+    # Like RemuxScheduler at most remux_jobs at once and at most jobs_per_device on the same device
+    slots = threading.Semaphore(max(1, remux_jobs))
+    devices = {} # plan index: device of the file
+    device_active = {} # device: number of claimed files on it
+    device_lock = threading.Lock()
+    plan_indices = {}
+    results = {}
+    file_done = threading.Event()
+    def release_slot(index):
+        with device_lock:
+            device_active[devices[index]] -= 1
+        slots.release()
+    def done(mkv, result):
+        # A remux whose original could not be replaced counts as failed, the .new.mkv file is left next to it
+        result = "failed" if result == "remuxed" else result
+        results[mkv] = result
+        try:
+            claims.finish(plan_indices[mkv], result, mkv)
+        finally:
+            # The slot is freed even if the claims can't be written, the file is then claimed again once its lock goes stale
+            release_slot(plan_indices[mkv])
+            file_done.set()
+    stop_heartbeat = threading.Event()
+    def heartbeat():
+        while not stop_heartbeat.wait(claims.stale_seconds / 4):
+            claims.heartbeat()
+    threading.Thread(target=heartbeat, daemon=True).start()
+    try:
+        with stats_phase("remuxing"), remux_pbar() as pbar:
+            batch = RemuxBatch(session, remux_jobs=remux_jobs, jobs_per_device=jobs_per_device, pbar=pbar, scratch_dir=scratch_dir, rolling_replace=True, on_done=done)
+            while not all(claims.is_done(index) for index in range(len(files))):
+                claimed = False
+                for index, file_entry in enumerate(files):
+                    if index in claims.held or claims.is_done(index):
+                        continue
+                    mkv = plan_entry_path(file_entry["file"], roots)
+                    if index not in devices:
+                        try:
+                            devices[index] = os.stat(mkv).st_dev
+                        except OSError:
+                            devices[index] = None
+                    with device_lock:
+                        if device_active.get(devices[index], 0) >= jobs_per_device:
+                            # Left for later or for another worker, files on other drives go ahead
+                            continue
+                        device_active[devices[index]] = device_active.get(devices[index], 0) + 1
+                    slots.acquire()
+                    if not claims.claim(index):
+                        release_slot(index)
+                        continue
+                    claimed = True
+                    plan_indices[mkv] = index
+                    if not same_source(file_signature(mkv), file_entry["source"]):
+                        pbar.write(f"{mkv} has changed or is missing since the plan was made, skipping it.")
+                        done(mkv, "skipped")
+                        continue
+                    if file_entry["links"]:
+                        session.known_links[mkv] = {plan_entry_path(link_entry, roots) for link_entry in file_entry["links"]}
+                    if file_entry["action"] == "remux":
+                        batch.add([mkv], file_entry["inputs_ids"])
+                    else:
+                        done(mkv, "edited" if apply_header_edits({mkv: file_entry["edit_args"]}, cache=cache) else "failed")
+                if not claimed:
+                    # The remaining files are being worked on by this or other workers, their claims are taken over once they go stale
+                    file_done.wait(1)
+                    file_done.clear()
+            batch.finish()
+        report_remux_issues(batch)
+    finally:
+        stop_heartbeat.set()
+        # Interrupted remuxes can be claimed again right away
+        for index in list(claims.held):
+            claims.release(index)
+    replaced_files = [mkv for mkv, result in results.items() if result == "replaced"]
+    if replaced_files and cache is not None:
+        cache_invalidate(cache, replaced_files)
+    report_hardlinks(session)
+    counts = {result: list(results.values()).count(result) for result in ("replaced", "edited", "failed", "skipped")}
+    print(f"This worker remuxed {counts['replaced']}, edited {counts['edited']}, skipped {counts['skipped']} " +
+          ("file" if counts["skipped"] == 1 else "files") + f", {counts['failed']} " + ("error." if counts["failed"] == 1 else "errors."))
+    try:
+        # Only one worker gets to finish the plan
+        os.close(os.open(os.path.join(claims.claims_dir, "finished"), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return
+    plan_results = claims.results(len(files)).values()
+    changed_files = [result["mkv"] for result in plan_results if result["result"] in ("replaced", "edited")]
+    failed = sum(1 for result in plan_results if result["result"] == "failed")
+    print(f"The plan is done: {len(changed_files)} " + ("file was" if len(changed_files) == 1 else "files were") + f" changed by all workers, {failed} " +
+          ("error." if failed == 1 else "errors.") + f" Remove {claims.claims_dir} before running the plan again.")
+    if changed_files and run_mkvp:
+        run_mkvpropr(changed_files)
 
 def main(args):
-    args = parse_arguments()
-    directory = args.directory
+    # Returns the exit code, stages that can't continue raise MkvtError
+    config = get_config()
+    directory = args.directory or ["."]
     single_folder = args.single_folder
-    global remove_attachments
-    remove_attachments = True if args.remove_attachments or remove_attachments_cfg else False
-    global stop_after_video_ends
-    stop_after_video_ends = True if args.stop_after_video_ends or stop_after_video_ends_cfg else False
-    run_mkvp = True if args.run_mkvp or run_mkvp_cfg else False
+    session = Session(config, remove_attachments=True if args.remove_attachments or config.remove_attachments else False,
+                      stop_after_video_ends=True if args.stop_after_video_ends or config.stop_after_video_ends else False,
+                      probe_backend=args.probe_backend,
+                      verify_remuxes=False if args.no_verify or not config.verify_remux else True,
+                      hardlink_policy=args.hardlinks)
+    run_mkvp = True if args.run_mkvp or config.run_mkvp else False
+    probe_jobs = args.probe_jobs or config.probe_jobs
+    stream = True if args.stream or config.stream_scan else False
+    low_memory = True if args.low_memory or config.low_memory else False
+    decisions = load_decisions(config.decisions_file) if config.decisions and not args.no_decisions else None
+    auto = True if args.auto or args.watch else False
+    if auto:
+        # Rules from --rules replace the ones in the config
+        rules = compile_rules(config, load_rules(args.rules) if args.rules else config.rules)
+        if rules is None:
+            print("Fix the rules before running unattended, exiting.")
+            return 1
+    remux_early = True if args.remux_early or config.remux_early else False
+    remux_jobs = args.remux_jobs or config.remux_jobs
+    jobs_per_device = args.jobs_per_device or config.remux_jobs_per_device
+    scratch_dir = args.scratch_dir or config.scratch_dir
+    cache = open_probe_cache(config.probe_cache_file, rebuild=args.rebuild_cache) if config.probe_cache and not args.no_cache else None
+    stats_file = args.stats_file or config.stats_file
+    if args.stats or stats_file:
+        run_stats["enabled"] = True
+        # Registered at exit so the stats are also shown when the run ends early or is interrupted
+        atexit.register(report_stats, stats_file)
 
     # Check if the required external programs are available on PATH and abort if not
-    mkv_tools_on_path()
+    if not mkv_tools_on_path():
+        return 1
+    # Checked before any file is changed, a missing mkvpropr at the end of the run is only reported
+    if run_mkvp and not (args.dry_run or args.plan_out or args.validate_probe) and not mkvp_on_path():
+        return 1
+
+    if args.validate_probe:
+        return 1 if validate_probe_backends(session, directory, single_folder, probe_jobs=probe_jobs) else 0
 
-    category_dict, mkv_files = process_video_files(directory=directory, single_folder=single_folder, create_categories=True)
-    categories = list(category_dict.keys()) # Create a list of categories
+    if args.worker:
+        # Resumable through the claims next to the plan, the journal is not used
+        run_worker(session, args.worker, args.directory, cache, remux_jobs, jobs_per_device, scratch_dir, run_mkvp)
+        return 0
+
+    if args.resume:
+        resume_run(session, config.journal_file, cache, remux_jobs, jobs_per_device, scratch_dir, run_mkvp, yes=args.yes)
+        return 0
+    elif not args.watch and not args.dry_run and not args.plan_out and os.path.exists(config.journal_file):
+        print(f"An interrupted run was found in {config.journal_file}, use --resume to continue it.")
+        if args.yes or args.execute:
+            print("Starting a new run, the interrupted one is discarded.")
+        elif input("Start a new run and discard the interrupted one? (y/n): ") != "y":
+            return 0
+    rolling_replace = True if args.rolling_replace or config.rolling_replace else False
+    if args.execute:
+        execute_plan(session, args.execute, args.directory, cache, remux_jobs, jobs_per_device, scratch_dir, run_mkvp, rolling_replace=rolling_replace)
+        return 0
+    if rolling_replace and not args.dry_run and not args.plan_out and not args.yes and not args.watch:
+        # There is no confirmation after the remuxes in this mode, so it is asked for up front
+        user_input = input("Replace each original .mkv file as soon as its remux has finished?\nTHIS STEP IS DESTRUCTIVE! (y/n): ")
+        rolling_replace = user_input == "y"
+    # Records the remux jobs and the state of every file from the first job on
+    journal = Journal(config.journal_file, header=journal_header(session, directory, single_folder, rolling_replace)) if not args.dry_run and not args.plan_out else None
+
+    if args.watch:
+        # Unattended, new files are answered like --auto and replaced without asking
+        process = lambda file_paths: process_new_files(session, file_paths, rules, decisions, probe_jobs, cache, remux_jobs, jobs_per_device, scratch_dir, run_mkvp)
+        try:
+            watch_directory(session, directory, single_folder, config.watch_settle, process, poll=args.poll)
+        except KeyboardInterrupt:
+            print("Stopped watching.")
+            return 0
+
+    if stream:
+        # Prompt for each category as soon as it is discovered while the scan continues in the background
+        scan = BackgroundScan(session, directory=directory, single_folder=single_folder, probe_jobs=probe_jobs, cache=cache, low_memory=low_memory)
+        category_dict, mkv_files = scan.category_dict, scan.mkv_files
+        categories = iter(scan.next_category, None)
+    else:
+        with stats_phase("scan"):
+            category_dict, mkv_files = process_video_files(session, directory=directory, single_folder=single_folder, create_categories=True, probe_jobs=probe_jobs, cache=cache, low_memory=low_memory)
+        if category_dict == {}:
+            print(f"Found no .mkv files in {', '.join(directory)}, exiting.")
+            return 1
+        report_skipped_links(session)
+        if cache is not None:
+            report_cache_stats(session)
+        if session.probe_backend == "native":
+            report_backend_stats(session)
+        categories = list(category_dict.keys()) # Create a list of categories
     filter_active = False
-    filter_langs = dict(default_filter_langs)
+    filter_langs = dict(config.default_filter_langs)
     # Dictionary that has a category as it's key and the inputs as the value
     category_inputs = {}
 
-    with tqdm(total = len(categories), position=0, desc="Collecting category inputs", unit="cat", ncols=100) as pbar:
+    # Remux answered categories in the background while the remaining ones are being prompted
+    batch = RemuxBatch(session, remux_jobs=remux_jobs, jobs_per_device=jobs_per_device, scratch_dir=scratch_dir, journal=journal, rolling_replace=rolling_replace) if remux_early and not args.dry_run and not args.plan_out else None
+    # Planned action for every selected file, files that wouldn't change are not remuxed
+    plan = {}
+    # mkvpropedit arguments of the files that are only edited in place
+    edits = {}
+    if stream and batch is not None:
+        def remux_new_file(cat, file_path):
+            # Files the scan finds for an already answered category
+            if cat in category_inputs:
+                layout = mkv_files[category_dict[cat][0]]
+                batch.add(plan_files(session, [file_path], category_inputs[cat], mkv_files, plan, edits, layout=layout, journal=journal), category_inputs[cat])
+        scan.on_new_file = remux_new_file
+
+    # Saved inputs of earlier runs that are offered as the default when their group is prompted
+    saved_inputs = {}
+    if decisions is not None and not stream:
+        known_categories = {}
+        for cat in categories:
+            saved_input = lookup_decision(decisions, mkv_files[category_dict[cat][0]])
+            if saved_input is not None:
+                known_categories[cat] = saved_input
+        if not known_categories:
+            choice = "n"
+        elif auto:
+            print(f"Applying the saved track orders of {len(known_categories)} " + ("group." if len(known_categories) == 1 else "groups."))
+            choice = "y"
+        else:
+            choice = confirm_decisions(known_categories, category_dict)
+        if choice == "y":
+            # Known groups are resolved without prompting, only the new ones reach the loop below
+            for cat, saved_input in known_categories.items():
+                if saved_input == "s":
+                    continue
+                category_inputs[cat] = build_inputs_and_ids(mkv_files[category_dict[cat][0]], saved_input.split())
+                if batch is not None:
+                    batch.add(plan_files(session, category_dict[cat], category_inputs[cat], mkv_files, plan, edits, journal=journal), category_inputs[cat])
+            categories = [cat for cat in categories if cat not in known_categories]
+        elif choice == "r":
+            saved_inputs = known_categories
+
+    # Status lines of the background work shown above each prompt
+    status_sources = [source.status for source in (scan if stream else None, batch) if source is not None]
+    status = (lambda: "\n".join(source() for source in status_sources)) if status_sources else None
+
+    # Groups that no rule matched with --auto, they are left for an interactive run
+    deferred = []
+
+    with stats_phase("prompting"), tqdm(total = len(category_dict), position=0, desc="Collecting category inputs", unit="cat", ncols=100) as pbar:
+        # Groups resolved from saved inputs
+        pbar.update(len(category_dict) - len(categories) if not stream else 0)
         category_count = 0
         last_input = ""
         for cat in categories:
+            # New categories may still be added by the background scan
+            pbar.total = len(category_dict)
             movies_in_cat = [movie for movie in category_dict[cat]]
-            # Query user for track ids for reordering
-            inputs_and_ids, filter_active, last_input = getInput(mkv_files=mkv_files, 
-                                                 movies_in_cat=movies_in_cat,
-                                                 category_count=category_count,
-                                                 filter_active=filter_active,
-                                                 filter_langs=filter_langs,
-                                                 last_input=last_input)
+            if stream and decisions is not None:
+                saved_inputs[cat] = lookup_decision(decisions, mkv_files[movies_in_cat[0]])
+            if auto:
+                # No prompts, groups without a saved input or matching rule are skipped
+                source, inputs_and_ids = auto_answer(mkv_files[movies_in_cat[0]], movies_in_cat[0], rules, decisions)
+                if inputs_and_ids is None:
+                    deferred.append(cat)
+                    inputs_and_ids = "s"
+                elif inputs_and_ids != "s":
+                    pbar.write(f"{os.path.basename(movies_in_cat[0])[:60]} ({len(movies_in_cat)} files): {source}, track order {' '.join(inputs_and_ids['inputs']) or 'no tracks'}")
+            else:
+                # Query user for track ids for reordering
+                inputs_and_ids, filter_active, last_input = getInput(config, mkv_files=mkv_files, 
+                                                     movies_in_cat=movies_in_cat,
+                                                     category_count=category_count,
+                                                     filter_active=filter_active,
+                                                     filter_langs=filter_langs,
+                                                     last_input=last_input,
+                                                     status=status,
+                                                     saved_input=saved_inputs.get(cat))
+                if decisions is not None:
+                    record_decision(decisions, mkv_files[movies_in_cat[0]], inputs_and_ids)
             if inputs_and_ids == "s":
-                print("Skipping current category.")
+                if not auto:
+                    print("Skipping current category.")
                 pbar.update(1)
                 category_count += 1
                 continue
+            elif batch is not None and stream:
+                # Hold the scan lock so no file of this category slips through between the snapshot and remux_new_file
+                with scan.condition:
+                    category_inputs[cat]=inputs_and_ids
+                    batch.add(plan_files(session, list(category_dict[cat]), inputs_and_ids, mkv_files, plan, edits, journal=journal), inputs_and_ids)
+            elif batch is not None:
+                category_inputs[cat]=inputs_and_ids
+                batch.add(plan_files(session, category_dict[cat], inputs_and_ids, mkv_files, plan, edits, journal=journal), inputs_and_ids)
             else:
                 category_inputs[cat]=inputs_and_ids
             pbar.update(1)
             category_count += 1
 
+    if decisions is not None and not auto:
+        save_decisions(config.decisions_file, decisions)
+    if deferred:
+        print(f"{len(deferred)} " + ("group matched" if len(deferred) == 1 else "groups matched") + " no rule and " + ("was" if len(deferred) == 1 else "were") + " left for an interactive run:")
+        for cat in deferred:
+            print(f"{len(category_dict[cat]):5} " + ("file " if len(category_dict[cat]) == 1 else "files") + f" | {category_dict[cat][0]}")
+
+    if stream:
+        scan.wait()
+        report_failed_probes(scan.failed_probes)
+        if cache is not None:
+            report_cache_stats(session)
+        if session.probe_backend == "native":
+            report_backend_stats(session)
+        if category_dict == {}:
+            print(f"Found no .mkv files in {', '.join(directory)}, exiting.")
+            return 1
+        report_skipped_links(session)
+
     if not category_inputs:
         print("No changes needed, exiting in 1 second.")
         sleep(1)
-        sys.exit()
+        return 0
 
-    # Remux all selected mkv files in one go
-    remuxed_files, failed_files = remux_files(category_inputs=category_inputs, category_dict=category_dict)
-    
-    if remuxed_files:
-        user_input = input("Replace original .mkv files with the remuxed .new.mkv ones?\nTHIS STEP IS DESTRUCTIVE! CHECK THE RESULTS BEFORE YOU CONTINUE!\n(y/n): ")
-        if user_input == "y":
-            # Replace the original files with the .new.mkv versions
-            replace_original_files(remuxed_files=remuxed_files)
-            if run_mkvp:
-                mkvp_path = mkvp_on_path()
-                mkvp_cmd = ["python", mkvp_path, "-d", directory]
-                if single_folder:
-                    mkvp_cmd.append("-s")
-                try:
-                    subprocess.run(mkvp_cmd)
-                except subprocess.CalledProcessError:
-                    print(f"Error while executing mkvpropr.")
-
-        elif user_input == "n":
-            user_input = input("Remove the leftover .new.mkv files?\n(y/n): ")
-            if user_input == "y":
-                clean_up(remuxed_files)
-            else:
-                print("Execution aborted. Exiting in 1 second.")
-                sleep(1)
-                sys.exit()
+    if batch is None:
+        # Only files whose tracks are removed or reordered need a full remux
+        with stats_phase("planning"):
+            remux_dict = {cat: plan_files(session, category_dict[cat], inputs_ids, mkv_files, plan, edits, journal=journal) for cat, inputs_ids in category_inputs.items()}
+    report_plan(plan)
+    report_free_space([mkv for mkv, action in plan.items() if action == "remux"], config.free_space_reserve, rolling_replace=rolling_replace, jobs_per_device=jobs_per_device)
+    if args.plan_out:
+        write_plan_file(session, args.plan_out, directory, single_folder, plan, edits, category_inputs, remux_dict)
+        return 0
+    if args.dry_run:
+        print("Dry run, no files have been changed. Exiting in 1 second.")
+        sleep(1)
+        return 0
+    if all(action == "skip" for action in plan.values()):
+        print("No changes needed, exiting in 1 second.")
+        sleep(1)
+        return 0
 
-    exit_time = 1
-    print(f"Remuxed {len(remuxed_files)} mkv " + ("file ." if len(remuxed_files) == 1 else "files. ") +
-          f"{failed_files} " + ("error. " if failed_files == 1 else "errors. ") + 
-          f"Exiting in {exit_time} " + ("second." if exit_time == 1 else "seconds."))
-    sleep(exit_time)
-    sys.exit(0)
+    if batch is not None:
+        # Wait for the remuxes that are still running in the background
+        with stats_phase("remuxing (after prompting)"), remux_pbar() as pbar:
+            remuxed_files, failed_files = batch.finish(pbar=pbar)
+            replaced_files = batch.replaced_files()
+        report_remux_issues(batch)
+    else:
+        # Remux all selected mkv files in one go
+        with stats_phase("remuxing"):
+            remuxed_files, failed_files, replaced_files = remux_files(session, category_inputs=category_inputs, category_dict=remux_dict,
+                                                                      remux_jobs=remux_jobs, jobs_per_device=jobs_per_device, scratch_dir=scratch_dir,
+                                                                      journal=journal, rolling_replace=rolling_replace)
+    
+    if journal is not None:
+        journal.sync()
+    finish_run(session, remuxed_files, failed_files, edits, run_mkvp, cache=cache, journal=journal, yes=args.yes, replaced_files=replaced_files)
+    return 0
 
 if __name__ == "__main__":
     args = parse_arguments()
     try:
-        main(args)
+        sys.exit(main(args))
+    except MkvtError as e:
+        print(f"{e} Exiting.")
+        sys.exit(1)
     except KeyboardInterrupt:
-        print("Interrupted, exiting.")
+        print("Interrupted, exiting." + (" Use --resume to continue." if os.path.exists(get_config().journal_file) else ""))
         try:
             sys.exit(130)
         except SystemExit:
@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import stat
+import random
+import shutil
+import argparse
+import tempfile
+import platform
+from time import perf_counter
+
+import mkvt
+
+################################################### CONFIG ###################################################
+
+# Stub that replaces mkvmerge during the benchmark, answers -J with canned JSON after a configurable delay
+stub_source = '''#!{python}
+import json, os, sys, time, zlib
+with open({layouts_file!r}, "r", encoding="utf8") as f:
+    layouts = json.load(f)
+latency = float(os.environ.get("MKVT_BENCH_LATENCY", "0"))
+if latency:
+    time.sleep(latency / 1000)
+if sys.argv[1] == "-J":
+    name = os.path.basename(sys.argv[2])
+    layout = layouts[zlib.crc32(name.encode("utf8")) % len(layouts)]
+    print(json.dumps(dict(layout, file_name=sys.argv[2])))
+'''
+
+# Files that are created next to the episodes but must not be probed
+extra_files = ["poster.jpg", "movie.nfo", "subs.srt"]
+
+################################################## FUNCTIONS ##################################################
+
+def parse_arguments():
+    def size_list(value):
+        try:
+            return [int(size) for size in value.split(",")]
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"{value} is not a comma separated list of numbers")
+
+    parser = argparse.ArgumentParser(description='Benchmark mkvt against synthetic libraries and a stub mkvmerge.')
+    parser.add_argument('--sizes', type=size_list, default=[1000, 10000],
+                        help='Comma separated numbers of .mkv files per synthetic library. Default: 1000,10000')
+    parser.add_argument('--layouts', type=int, default=20,
+                        help='Number of different track layouts (and therefore categories) in the library. Default: 20')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Delay in milliseconds of every stub mkvmerge call. Default: 0')
+    parser.add_argument('--probe_jobs', type=int, default=mkvt.get_config().probe_jobs,
+                        help='Number of files probed at the same time. Default: probe_jobs from mkvt_config.yaml')
+    parser.add_argument('--output', default="bench_results.json",
+                        help='File the results are written to as JSON. Default: bench_results.json')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the synthetic libraries instead of deleting them afterwards.')
+
+    args: argparse.Namespace = parser.parse_args()
+
+    return args
+
+def create_layouts(count, seed=1):
+    # Canned mkvmerge -J output with realistic track counts, names and flags
+    rng = random.Random(seed)
+    audio_codecs = ["AC-3", "E-AC-3", "DTS", "DTS-HD Master Audio", "TrueHD Atmos", "AAC", "FLAC", "Opus"]
+    sub_codecs = ["SubRip/SRT", "SubStationAlpha", "HDMV PGS", "VobSub"]
+    langs = ["en", "de", "ja", "fr", "es", "it", "nl", "pl", "pt-BR", "zh", "ko", "ru", "sv", "fi"]
+    layouts = []
+    for _ in range(count):
+        tracks = [{"id": 0, "type": "video", "codec": "HEVC/H.265/MPEG-H", "properties": {"language": "und", "language_ietf": "und", "default_track": True}}]
+        for track_type, amount in (("audio", rng.randint(1, 6)), ("subtitles", rng.randint(0, 30))):
+            for index in range(amount):
+                properties = {"language_ietf": rng.choice(langs),
+                              "default_track": index == 0,
+                              "forced_track": track_type == "subtitles" and rng.random() < 0.1,
+                              "flag_hearing_impaired": track_type == "subtitles" and rng.random() < 0.1,
+                              "flag_commentary": rng.random() < 0.05}
+                if rng.random() < 0.7:
+                    properties["track_name"] = f"{track_type.title()} {index + 1}"
+                codec = rng.choice(audio_codecs if track_type == "audio" else sub_codecs)
+                tracks.append({"id": len(tracks), "type": track_type, "codec": codec, "properties": properties})
+        layouts.append({"container": {"recognized": True, "properties": {"duration": 1420000000000}}, "tracks": tracks, "attachments": []})
+    return layouts
+
+def install_stub(stub_dir, layouts):
+    # Write the layouts and a stub mkvmerge, then put it in front of the real one on PATH
+    layouts_file = os.path.join(stub_dir, "layouts.json")
+    with open(layouts_file, "w", encoding="utf8") as f:
+        json.dump(layouts, f)
+    stub_path = os.path.join(stub_dir, "mkvmerge")
+    with open(stub_path, "w", encoding="utf8") as f:
+        f.write(stub_source.format(python=sys.executable, layouts_file=layouts_file))
+    os.chmod(stub_path, os.stat(stub_path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ["PATH"] = stub_dir + os.pathsep + os.environ["PATH"]
+
+def create_library(library_dir, mkv_count, seed=1):
+    # Shows with seasons and movies with extras folders, trailers and samples, all files are empty
+    rng = random.Random(seed)
+    ignore_dirs = mkvt.get_config().ignore_dirs
+    ignored_dir = ignore_dirs[0] if ignore_dirs else "extras"
+    created = 0
+    show = 0
+    while created < mkv_count:
+        if rng.random() < 0.3:
+            # Movie folder with a trailer, a sample and an ignored extras folder
+            movie_dir = os.path.join(library_dir, "Movies", f"Movie {show} ({1950 + show % 75})")
+            os.makedirs(os.path.join(movie_dir, ignored_dir), exist_ok=True)
+            names = [f"Movie {show}.mkv", f"Movie {show}-trailer.mkv", f"Movie {show}-sample.mkv",
+                     os.path.join(ignored_dir, "Making of.mkv")] + extra_files
+            created += 1
+            for name in names:
+                open(os.path.join(movie_dir, name), "w").close()
+        else:
+            # Show with several seasons of episodes
+            for season in range(1, rng.randint(1, 8) + 1):
+                season_dir = os.path.join(library_dir, "Shows", f"Show {show}", f"Season {season:02}")
+                os.makedirs(season_dir, exist_ok=True)
+                for episode in range(1, rng.randint(6, 24) + 1):
+                    if created >= mkv_count:
+                        break
+                    open(os.path.join(season_dir, f"Show {show} S{season:02}E{episode:02}.mkv"), "w").close()
+                    created += 1
+                open(os.path.join(season_dir, extra_files[0]), "w").close()
+        show += 1
+
+def timed(results, name, function, *args, **kwargs):
+    start = perf_counter()
+    result = function(*args, **kwargs)
+    results[name] = round(perf_counter() - start, 6)
+    return result
+
+def run_benchmark(session, library_dir, mkv_count, layouts, probe_jobs):
+    results = {"mkv_files": mkv_count}
+    timed(results, "create_library_s", create_library, library_dir, mkv_count)
+
+    # Directory walk on its own
+    found = timed(results, "walk_s", lambda: sum(1 for _ in mkvt.iter_mkv_files(session, library_dir)))
+    results["found_files"] = found
+
+    # Full scan including the stub mkvmerge -J calls, without the probe cache
+    category_dict, mkv_files = timed(results, "process_video_files_s", mkvt.process_video_files, session,
+                                     directory=library_dir, single_folder=False, probe_jobs=probe_jobs, cache=None)
+    results["categories"] = len(category_dict)
+
+    # JSON to track info and track info to category without process startup
+    canned_json = [layouts[index % len(layouts)] for index in range(mkv_count)]
+    track_infos = timed(results, "get_track_info_s", lambda: [mkvt.get_track_info(session.config, mkvmerge_json) for mkvmerge_json in canned_json])
+    timed(results, "create_cat_s", lambda: [mkvt.create_cat(track_info) for track_info in track_infos])
+    index = mkvt.CategoryIndex()
+    timed(results, "category_index_s", lambda: [index.lookup(track_info) for track_info in track_infos])
+
+    # Command building for every file, keeping all audio and subtitle tracks in reverse order
+    category_inputs = {}
+    for cat, file_paths in category_dict.items():
+        track_info = mkv_files[file_paths[0]]
+        audio_ids = [str(track.id) for track in track_info.audio]
+        subtitle_ids = [str(track.id) for track in track_info.subtitles]
+        category_inputs[cat] = {"inputs": audio_ids[::-1] + subtitle_ids[::-1],
+                                "video_ids": [str(track.id) for track in track_info.video],
+                                "audio_ids": audio_ids[::-1],
+                                "subtitle_ids": subtitle_ids[::-1]}
+    timed(results, "build_remux_jobs_s", mkvt.build_remux_jobs, session, category_inputs, category_dict)
+
+    for key in ("process_video_files_s", "get_track_info_s", "create_cat_s", "category_index_s", "build_remux_jobs_s"):
+        results[key[:-2] + "_us_per_file"] = round(results[key] / max(mkv_count, 1) * 1e6, 2)
+    return results
+
+def main(args):
+    if sys.platform == "win32":
+        print("The stub mkvmerge is a python script with a shebang, the benchmark only runs on Linux and macOS.")
+        sys.exit(1)
+    # Settings that mkvt.main would set from the arguments
+    session = mkvt.Session()
+    os.environ["MKVT_BENCH_LATENCY"] = str(args.latency)
+
+    work_dir = tempfile.mkdtemp(prefix="mkvt_bench_")
+    layouts = create_layouts(args.layouts)
+    install_stub(work_dir, layouts)
+    report = {"python": platform.python_version(),
+              "platform": platform.platform(),
+              "cpu_count": os.cpu_count(),
+              "probe_jobs": args.probe_jobs,
+              "latency_ms": args.latency,
+              "layouts": args.layouts,
+              "runs": []}
+    try:
+        for mkv_count in args.sizes:
+            library_dir = os.path.join(work_dir, f"library_{mkv_count}")
+            os.makedirs(library_dir)
+            results = run_benchmark(session, library_dir, mkv_count, layouts, args.probe_jobs)
+            report["runs"].append(results)
+            print(json.dumps(results))
+            if not args.keep:
+                shutil.rmtree(library_dir)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w", encoding="utf8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main(parse_arguments())
@@ -0,0 +1,806 @@
+# Tests for the parts of mkvt that don't need mkvmerge
+# Run from the repository root via python -m pytest
+import json
+import multiprocessing
+import os
+import random
+import struct
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mkvt
+
+def probe_json(*tracks):
+    # mkvmerge -J output with the given (type, codec, language) tracks
+    return {"container": {"properties": {}}, "attachments": [],
+            "tracks": [{"id": track_id, "type": track_type, "codec": codec, "properties": {"language": language, "language_ietf": language,
+                                                                                          "default_track": False, "forced_track": False}}
+                       for track_id, (track_type, codec, language) in enumerate(tracks)]}
+
+def movie_track_info(attachments=()):
+    # A video, Japanese and English audio and English full and forced subtitles, the Japanese audio is the default track
+    return mkvt.TrackInfo(video=(mkvt.VideoTrack(0, "und", "empty", "AV1"),),
+                          audio=(mkvt.AudioTrack(1, "ja", "empty", "FLAC", True, False), mkvt.AudioTrack(2, "en", "empty", "AC-3", False, False)),
+                          subtitles=(mkvt.SubtitleTrack(3, "en", "Full", "ASS", False, False, False, False),
+                                     mkvt.SubtitleTrack(4, "en", "Signs", "ASS", True, False, False, False)),
+                          attachments=attachments)
+
+def test_probe_cache_is_invalidated_when_the_file_changes(tmp_path):
+    cache = mkvt.open_probe_cache(str(tmp_path / "cache" / "probe_cache.sqlite3"))
+    path = tmp_path / "movie.mkv"
+    path.write_bytes(bytes(100))
+    mkvmerge_json = probe_json(("video", "AVC/H.264/MPEG-4p10", "und"), ("audio", "AAC", "en"))
+    mkvt.cache_store(cache, str(path), os.stat(path), mkvmerge_json)
+    assert mkvt.cache_lookup(cache, str(path), os.stat(path)) == mkvt.slim_json(mkvmerge_json)
+
+    # Same size, other modification time
+    file_stat = os.stat(path)
+    os.utime(path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 10**9))
+    assert mkvt.cache_lookup(cache, str(path), os.stat(path)) is None
+
+    # Same modification time, other size
+    mkvt.cache_store(cache, str(path), os.stat(path), mkvmerge_json)
+    file_stat = os.stat(path)
+    with open(path, "ab") as f:
+        f.write(b"\0")
+    os.utime(path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+    assert mkvt.cache_lookup(cache, str(path), os.stat(path)) is None
+
+    # Rewritten files are forgotten
+    mkvt.cache_store(cache, str(path), os.stat(path), mkvmerge_json)
+    mkvt.cache_invalidate(cache, [str(path)])
+    assert mkvt.cache_lookup(cache, str(path), os.stat(path)) is None
+    cache.close()
+
+def test_probe_cache_is_dropped_on_rebuild_and_version_change(tmp_path):
+    cache_file = str(tmp_path / "probe_cache.sqlite3")
+    path = tmp_path / "movie.mkv"
+    path.write_bytes(bytes(100))
+    mkvmerge_json = probe_json(("video", "AV1", "und"))
+    cache = mkvt.open_probe_cache(cache_file)
+    mkvt.cache_store(cache, str(path), os.stat(path), mkvmerge_json)
+    cache.commit()
+    cache.close()
+    cache = mkvt.open_probe_cache(cache_file)
+    assert mkvt.cache_lookup(cache, str(path), os.stat(path)) == mkvt.slim_json(mkvmerge_json)
+    cache.execute(f"PRAGMA user_version = {mkvt.probe_cache_version - 1}")
+    cache.commit()
+    cache.close()
+    cache = mkvt.open_probe_cache(cache_file)
+    assert mkvt.cache_lookup(cache, str(path), os.stat(path)) is None
+    mkvt.cache_store(cache, str(path), os.stat(path), mkvmerge_json)
+    cache.commit()
+    cache.close()
+    cache = mkvt.open_probe_cache(cache_file, rebuild=True)
+    assert mkvt.cache_lookup(cache, str(path), os.stat(path)) is None
+    cache.close()
+
+def remux_job(tmp_path, name, size=1, device=1):
+    return {"mkv": str(tmp_path / name), "output_path": str(tmp_path / f"{name}.tmp"), "device": device, "size": size}
+
+def test_scheduler_limits_jobs_per_device(tmp_path):
+    running, most_running, finished = {}, {}, []
+    lock = threading.Lock()
+
+    def run_job(job):
+        with lock:
+            running[job["device"]] = running.get(job["device"], 0) + 1
+            most_running[job["device"]] = max(most_running.get(job["device"], 0), running[job["device"]])
+        time.sleep(0.02)
+        with lock:
+            running[job["device"]] -= 1
+            finished.append(job["mkv"])
+
+    scheduler = mkvt.RemuxScheduler(run_job, 6, 2, 0)
+    for index in range(12):
+        scheduler.submit(remux_job(tmp_path, f"{index}.mkv", device=index % 2))
+    scheduler.join()
+    assert len(finished) == 12
+    assert max(most_running.values()) <= 2
+    assert scheduler.active == {0: 0, 1: 0}
+
+def test_plan_file():
+    session = mkvt.Session(mkvt.Config(), remove_attachments=False, stop_after_video_ends=False)
+    track_info = movie_track_info()
+    assert mkvt.plan_file(session, track_info, mkvt.build_inputs_and_ids(track_info, ["1", "2", "3", "4"])) == "skip"
+    # Only the default flags change
+    inputs_ids = dict(mkvt.build_inputs_and_ids(track_info, ["1", "2", "3", "4"]), default_flags={"1": False, "3": True})
+    assert mkvt.plan_file(session, track_info, inputs_ids) == "propedit"
+    assert mkvt.header_edits(session, track_info, inputs_ids) == ["--edit", "track:2", "--set", "flag-default=0",
+                                                                  "--edit", "track:4", "--set", "flag-default=1"]
+    # A flag that is already set doesn't need an edit
+    inputs_ids = dict(mkvt.build_inputs_and_ids(track_info, ["1", "2", "3", "4"]), default_flags={"1": True})
+    assert mkvt.plan_file(session, track_info, inputs_ids) == "skip"
+    # Reordered and removed tracks
+    assert mkvt.plan_file(session, track_info, mkvt.build_inputs_and_ids(track_info, ["2", "1", "3", "4"])) == "remux"
+    assert mkvt.plan_file(session, track_info, mkvt.build_inputs_and_ids(track_info, ["1", "3"])) == "remux"
+
+def test_plan_file_attachments_and_trimming():
+    track_info = movie_track_info(attachments=(1, 2))
+    inputs_ids = mkvt.build_inputs_and_ids(track_info, ["1", "2", "3", "4"])
+    assert mkvt.plan_file(mkvt.Session(mkvt.Config(), remove_attachments=False, stop_after_video_ends=False), track_info, inputs_ids) == "skip"
+    session = mkvt.Session(mkvt.Config(), remove_attachments=True, stop_after_video_ends=False)
+    assert mkvt.plan_file(session, track_info, inputs_ids) == "propedit"
+    assert mkvt.header_edits(session, track_info, inputs_ids) == ["--delete-attachment", "1", "--delete-attachment", "2"]
+    # Whether trimming changes a file is only known after remuxing it
+    assert mkvt.plan_file(mkvt.Session(mkvt.Config(), remove_attachments=False, stop_after_video_ends=True), track_info, inputs_ids) == "remux"
+
+def test_plan_files_remuxes_hard_linked_files_instead_of_editing_them(tmp_path):
+    single, linked, reordered = (str(tmp_path / name) for name in ("single.mkv", "linked.mkv", "reordered.mkv"))
+    for path in (single, linked, reordered):
+        with open(path, "wb") as f:
+            f.write(bytes(10))
+    os.link(linked, str(tmp_path / "linked elsewhere.mkv"))
+    track_info = movie_track_info()
+    mkv_files = {single: track_info, linked: track_info, reordered: track_info}
+    inputs_ids = dict(mkvt.build_inputs_and_ids(track_info, ["1", "2", "3", "4"]), default_flags={"1": False})
+    for policy, linked_action in (("report", "remux"), ("leave", "remux"), ("relink", "propedit")):
+        session = mkvt.Session(mkvt.Config(), remove_attachments=False, stop_after_video_ends=False, hardlink_policy=policy)
+        plan, edits = {}, {}
+        to_remux = mkvt.plan_files(session, [single, linked], inputs_ids, mkv_files, plan, edits)
+        assert plan == {single: "propedit", linked: linked_action}
+        assert to_remux == ([linked] if linked_action == "remux" else [])
+        assert set(edits) == ({single} if linked_action == "remux" else {single, linked})
+    plan, edits = {}, {}
+    assert mkvt.plan_files(session, [reordered], mkvt.build_inputs_and_ids(track_info, ["2", "1"]), mkv_files, plan, edits) == [reordered]
+    assert (plan, edits) == ({reordered: "remux"}, {})
+
+def test_scheduler_continues_after_failed_jobs(tmp_path):
+    done, skipped = [], []
+    lock = threading.Lock()
+
+    def run_job(job):
+        if job["mkv"].endswith("bad.mkv"):
+            raise OSError("mkvmerge crashed")
+        with lock:
+            done.append(os.path.basename(job["mkv"]))
+
+    def skip_job(job):
+        with lock:
+            skipped.append(os.path.basename(job["mkv"]))
+        raise OSError("journal not writable")
+
+    scheduler = mkvt.RemuxScheduler(run_job, 2, 1, 0, skip_job=skip_job)
+    for name in ("a.mkv", "bad.mkv", "b.mkv", "c.mkv"):
+        scheduler.submit(remux_job(tmp_path, name))
+    scheduler.join()
+    # Neither the failed job nor the failing skip_job stop the remaining jobs
+    assert sorted(done) == ["a.mkv", "b.mkv", "c.mkv"]
+    assert skipped == ["bad.mkv"]
+    assert scheduler.active == {1: 0}
+    assert scheduler.reserved == {1: []}
+
+def test_category_index():
+    index = mkvt.CategoryIndex()
+    track_info = movie_track_info()
+    cat = index.lookup(track_info)
+    assert cat == mkvt.create_cat(track_info) == index.lookup(movie_track_info(attachments=(1,)))
+    renamed = track_info._replace(subtitles=(track_info.subtitles[0]._replace(name="Dialogue"), track_info.subtitles[1]))
+    assert index.lookup(renamed) != cat
+    # The fields of a track are kept apart, names that only differ in where they are split don't end up in the same category
+    first = track_info._replace(audio=(track_info.audio[0]._replace(name="a ja"), track_info.audio[1]._replace(name="b")))
+    second = track_info._replace(audio=(track_info.audio[0]._replace(name="a"), track_info.audio[1]._replace(name="ja b")))
+    assert mkvt.create_cat(first) != mkvt.create_cat(second)
+
+def test_category_index_resolves_digest_collisions(monkeypatch):
+    monkeypatch.setattr(mkvt, "fingerprint_digest", lambda fingerprint: "0123456789abcdef")
+    index = mkvt.CategoryIndex()
+    track_info = movie_track_info()
+    other = track_info._replace(audio=track_info.audio[:1])
+    third = track_info._replace(subtitles=())
+    assert [index.lookup(track_info), index.lookup(other), index.lookup(third)] == ["0123456789abcdef", "0123456789abcdef-2", "0123456789abcdef-3"]
+    # Every fingerprint keeps its category
+    assert [index.lookup(third), index.lookup(track_info), index.lookup(other)] == ["0123456789abcdef-3", "0123456789abcdef", "0123456789abcdef-2"]
+
+def test_decisions(tmp_path):
+    decisions_file = str(tmp_path / "data" / "decisions.json")
+    track_info = movie_track_info()
+    skipped = track_info._replace(audio=track_info.audio[:1])
+    decisions = mkvt.load_decisions(decisions_file)
+    assert decisions == {}
+    mkvt.record_decision(decisions, track_info, mkvt.build_inputs_and_ids(track_info, ["2", "1", "3"]))
+    mkvt.record_decision(decisions, skipped, "s")
+    mkvt.save_decisions(decisions_file, decisions)
+    decisions = mkvt.load_decisions(decisions_file)
+    assert mkvt.lookup_decision(decisions, track_info) == "2 1 3"
+    assert mkvt.lookup_decision(decisions, skipped) == "s"
+    # Still applies when the release renames its tracks
+    renamed = track_info._replace(audio=tuple(track._replace(name=f"{track.lang} 5.1") for track in track_info.audio),
+                                  subtitles=(track_info.subtitles[0]._replace(name="Dialogue"), track_info.subtitles[1]._replace(name="empty")))
+    assert mkvt.lookup_decision(decisions, renamed) == "2 1 3"
+    # Other languages or flags are other tracks
+    assert mkvt.lookup_decision(decisions, track_info._replace(audio=(track_info.audio[0]._replace(lang="de"), track_info.audio[1]))) is None
+    assert mkvt.lookup_decision(decisions, track_info._replace(subtitles=(track_info.subtitles[0]._replace(forced=True), track_info.subtitles[1]))) is None
+
+def test_decisions_ignore_digest_collisions(monkeypatch):
+    monkeypatch.setattr(mkvt, "fingerprint_digest", lambda fingerprint: "0123456789abcdef")
+    track_info = movie_track_info()
+    decisions = {}
+    mkvt.record_decision(decisions, track_info, mkvt.build_inputs_and_ids(track_info, ["1", "3"]))
+    # Same digest, but the stored fingerprint belongs to other tracks
+    assert mkvt.lookup_decision(decisions, track_info._replace(subtitles=())) is None
+    assert mkvt.lookup_decision(decisions, track_info) == "1 3"
+
+def test_unreadable_decisions_start_empty(tmp_path):
+    decisions_file = tmp_path / "decisions.json"
+    decisions_file.write_text('{"cut off')
+    assert mkvt.load_decisions(str(decisions_file)) == {}
+
+def rules_track_info():
+    return mkvt.TrackInfo(video=(mkvt.VideoTrack(0, "und", "empty", "HEVC"),),
+                          audio=(mkvt.AudioTrack(1, "en", "empty", "AC-3", True, False),
+                                 mkvt.AudioTrack(2, "en", "empty", "FLAC", False, False),
+                                 mkvt.AudioTrack(3, "ja", "empty", "AAC", False, False),
+                                 mkvt.AudioTrack(4, "en", "Commentary", "AAC", False, True),
+                                 mkvt.AudioTrack(5, "de", "empty", "AC-3", False, False)),
+                          subtitles=(mkvt.SubtitleTrack(6, "en", "SDH", "PGS", False, False, True, False),
+                                     mkvt.SubtitleTrack(7, "en", "Forced", "PGS", True, False, False, False),
+                                     mkvt.SubtitleTrack(8, "en", "Full", "SRT", False, True, False, False),
+                                     mkvt.SubtitleTrack(9, "en", "Full", "PGS", False, False, False, False),
+                                     mkvt.SubtitleTrack(10, "ja", "Commentary", "ASS", False, False, False, True)))
+
+def answer(raw_rules, track_info=None, file_path="/media/Movies/Movie.mkv", config=None):
+    rules = mkvt.compile_rules(config or mkvt.Config(), raw_rules)
+    return mkvt.apply_rules(rules, track_info or rules_track_info(), file_path)
+
+def test_rules_language_and_codec_priority():
+    name, inputs_ids = answer([{"name": "Japanese first", "audio": {"langs": ["ja", "en"], "codecs": ["FLAC", "AC-3"]},
+                                "subtitles": {"langs": ["en"], "codecs": ["SRT"]}}])
+    assert name == "Japanese first"
+    # Languages in the order of the rule, codecs by preference within a language, the German track is removed
+    assert inputs_ids["audio_ids"] == ["3", "2", "1"]
+    # Regular tracks before SDH and forced tracks of the same language
+    assert inputs_ids["subtitle_ids"] == ["8", "9", "6", "7"]
+    assert inputs_ids["inputs"] == ["3", "2", "1", "8", "9", "6", "7"]
+    assert "default_flags" not in inputs_ids
+    # Without codec preferences the file order decides
+    assert answer([{"audio": {"langs": ["en"]}}])[1]["audio_ids"] == ["1", "2"]
+
+def test_rules_max_per_lang():
+    _, inputs_ids = answer([{"audio": {"langs": ["en", "ja"], "codecs": ["FLAC"], "max_per_lang": 1, "commentary": True},
+                             "subtitles": {"langs": ["en"], "codecs": ["PGS"], "max_per_lang": 1}}])
+    # The limit only applies to regular tracks, the commentary, forced and SDH tracks are kept
+    assert inputs_ids["audio_ids"] == ["2", "4", "3"]
+    assert inputs_ids["subtitle_ids"] == ["9", "6", "7"]
+
+def test_rules_forced_sdh_and_commentary():
+    _, inputs_ids = answer([{"audio": {"langs": ["en"]}, "subtitles": {"langs": ["en", "ja"]}}])
+    # Forced and SDH tracks are kept and commentary tracks removed by default
+    assert inputs_ids["audio_ids"] == ["1", "2"]
+    assert inputs_ids["subtitle_ids"] == ["8", "9", "6", "7"]
+    _, inputs_ids = answer([{"audio": {"langs": ["en"], "commentary": True},
+                             "subtitles": {"langs": ["en", "ja"], "forced": False, "sdh": False, "commentary": True}}])
+    assert inputs_ids["audio_ids"] == ["1", "2", "4"]
+    assert inputs_ids["subtitle_ids"] == ["8", "9", "10"]
+
+def test_rules_default_flags():
+    def flags(audio, subtitles):
+        return answer([{"audio": {"langs": ["ja", "en"]}, "subtitles": {"langs": ["en"], "sdh": False},
+                        "default": {"audio": audio, "subtitles": subtitles}}])[1].get("default_flags")
+    assert flags("keep", "keep") is None
+    assert flags("first", "keep") == {"3": True, "1": False, "2": False}
+    assert flags("none", "keep") == {"3": False, "1": False, "2": False}
+    assert flags("keep", "first") == {"8": True, "9": False, "7": False}
+    assert flags("keep", "forced") == {"8": False, "9": False, "7": True}
+    assert flags("keep", "none") == {"8": False, "9": False, "7": False}
+    # No forced track to make the default
+    _, inputs_ids = answer([{"audio": {"langs": ["en"]}, "subtitles": {"langs": ["en"], "forced": False}, "default": {"subtitles": "forced"}}])
+    assert inputs_ids["default_flags"] == {"8": False, "9": False, "6": False}
+
+def test_rules_without_a_match_are_left_for_an_interactive_run():
+    track_info = rules_track_info()
+    rules = [{"name": "German", "match": {"audio_langs": ["de"], "path": "[/\\\\]Anime[/\\\\]"}, "audio": {"langs": ["de"]}},
+             {"name": "Korean subtitles", "match": {"subtitle_langs": ["ko"]}, "audio": {"langs": ["ja"]}},
+             # Would remove every audio track
+             {"name": "French", "audio": {"langs": ["fr"]}}]
+    assert answer(rules) == (None, None)
+    assert mkvt.auto_answer(track_info, "/media/Movies/Movie.mkv", mkvt.compile_rules(mkvt.Config(), rules)) == (None, None)
+    # The first matching rule wins
+    assert answer(rules + [{"name": "Fallback", "audio": {"langs": ["en"]}}, {"name": "Second", "audio": {"langs": ["ja"]}}])[0] == "Fallback"
+    assert answer(rules, file_path="/media/Anime/Show/ep01.mkv")[0] == "German"
+
+def test_rules_default_langs_and_invalid_rules():
+    config = mkvt.Config({"default_filter_langs": {"audio": ["ja"], "sub": ["en"]}})
+    _, inputs_ids = answer([{"audio": {"langs": "default"}, "subtitles": {"langs": "default", "forced": False, "sdh": False}}], config=config)
+    assert inputs_ids["inputs"] == ["3", "8", "9"]
+    assert mkvt.compile_rules(config, [{"default": {"audio": "loudest"}}]) is None
+    assert mkvt.compile_rules(config, [{"match": {"path": "["}}]) is None
+    assert mkvt.compile_rules(config, ["not a rule"]) is None
+
+def test_journal_resume(tmp_path):
+    journal_file = str(tmp_path / "journal.jsonl")
+    session = mkvt.Session(mkvt.Config(), remove_attachments=True, stop_after_video_ends=False)
+    journal = mkvt.Journal(journal_file, header=mkvt.journal_header(session, [str(tmp_path)], False, True))
+    first, second, third, fourth = (str(tmp_path / name) for name in ("a.mkv", "b.mkv", "c.mkv", "d.mkv"))
+    journal.record("job", mkv=first, inputs_ids={"inputs": ["2", "1"]}, source=[1, 2])
+    journal.record("remuxed", mkv=first, output=[3, 4])
+    journal.record("synced", mkv=first, output=[3, 4])
+    journal.record("job", mkv=second, inputs_ids={"inputs": ["1"]}, source=[5, 6])
+    journal.record("failed", mkv=second)
+    # A job recorded again starts over, e.g. when the run was resumed before
+    journal.record("job", mkv=second, inputs_ids={"inputs": ["1"]}, source=[5, 6])
+    journal.record("edit", mkv=third, args=["--edit", "track:2", "--set", "flag-default=0"])
+    journal.record("job", mkv=fourth, inputs_ids={"inputs": ["1"]}, source=[7, 8])
+    journal.record("remuxed", mkv=fourth, output=[9, 10])
+    journal.sync()
+    # The last line may be cut off when the process is killed
+    with open(journal_file, "a", encoding="utf8") as f:
+        f.write('{"event": "replaced", "mkv": ')
+
+    # The resumed run continues with the settings of the interrupted one, not the ones of the new session
+    run = mkvt.load_journal(mkvt.Session(mkvt.Config(), remove_attachments=False, stop_after_video_ends=True), journal_file)
+    assert (run["directories"], run["rolling_replace"]) == ([str(tmp_path)], True)
+    assert (run["remove_attachments"], run["stop_after_video_ends"]) == (True, False)
+    assert set(run["jobs"]) == {first, second, fourth}
+    assert run["jobs"][first]["inputs_ids"] == {"inputs": ["2", "1"]}
+    assert run["states"] == {first: {"event": "synced", "mkv": first, "output": [3, 4]},
+                             fourth: {"event": "remuxed", "mkv": fourth, "output": [9, 10]}}
+    assert run["edits"] == {third: ["--edit", "track:2", "--set", "flag-default=0"]}
+
+    # A finished run leaves nothing to resume
+    journal.finish()
+    assert mkvt.load_journal(session, journal_file) is None
+
+def test_replace_file_journals_the_replacement(tmp_path):
+    mkv_path = str(tmp_path / "movie.mkv")
+    with open(mkv_path, "wb") as f:
+        f.write(b"original")
+    with open(str(tmp_path / "movie.new.mkv"), "wb") as f:
+        f.write(b"remuxed file")
+    journal_file = str(tmp_path / "journal.jsonl")
+    journal = mkvt.Journal(journal_file)
+    session = mkvt.Session(mkvt.Config())
+    assert mkvt.replace_file(session, mkv_path, journal=journal)
+    assert open(mkv_path, "rb").read() == b"remuxed file"
+    assert not os.path.exists(str(tmp_path / "movie.new.mkv"))
+    journal.sync()
+    assert [json.loads(line)["event"] for line in open(journal_file, encoding="utf8")] == ["synced", "replaced"]
+    # Nothing to replace
+    assert not mkvt.replace_file(session, mkv_path, journal=journal)
+
+def test_free_space_reserves():
+    assert mkvt.Config({"free_space_reserve_gb": None, "scratch_reserve_gb": None}).free_space_reserve == 5 * 1024**3
+    assert mkvt.Config({"scratch_reserve_gb": None}).scratch_reserve == 5 * 1024**3
+    config = mkvt.Config({"free_space_reserve_gb": 0, "scratch_reserve_gb": 0.5})
+    assert (config.free_space_reserve, config.scratch_reserve) == (0, 512 * 1024**2)
+
+def test_scheduler_only_holds_back_what_running_jobs_still_write(tmp_path, monkeypatch):
+    # A 100 byte drive, the files in tmp_path take up its space
+    usage = type(mkvt.shutil.disk_usage(str(tmp_path)))
+    monkeypatch.setattr(mkvt.shutil, "disk_usage", lambda path: usage(100, 0, 100 - sum(entry.stat().st_size for entry in os.scandir(str(tmp_path)))))
+    first_written, second_started = threading.Event(), threading.Event()
+    overlapped = []
+
+    def run_job(job):
+        if job["mkv"].endswith("first.mkv"):
+            with open(job["output_path"], "wb") as f:
+                f.write(bytes(50))
+            first_written.set()
+            # Still running while the second job is scheduled
+            overlapped.append(second_started.wait(2))
+        else:
+            second_started.set()
+
+    scheduler = mkvt.RemuxScheduler(run_job, 2, 2, 0)
+    scheduler.submit(remux_job(tmp_path, "first.mkv", size=60))
+    assert first_written.wait(5)
+    # 50 bytes free, 10 of them still needed by the first job
+    assert scheduler.reserved == {1: [(str(tmp_path / "first.mkv.tmp"), 60)]}
+    assert mkvt.unwritten(scheduler.reserved[1]) == 10
+    scheduler.submit(remux_job(tmp_path, "second.mkv", size=30))
+    scheduler.join()
+    assert overlapped == [True]
+    assert scheduler.reserved == {1: []}
+
+def test_scheduler_skips_jobs_that_never_fit(tmp_path):
+    done, skipped = [], []
+    scheduler = mkvt.RemuxScheduler(lambda job: done.append(os.path.basename(job["mkv"])), 1, 1, 0,
+                                    skip_job=lambda job: skipped.append(os.path.basename(job["mkv"])))
+    for name, size in (("small.mkv", 1), ("huge.mkv", 2**62), ("other.mkv", 1)):
+        scheduler.submit(remux_job(tmp_path, name, size=size))
+    scheduler.join()
+    assert sorted(done) == ["other.mkv", "small.mkv"]
+    assert skipped == ["huge.mkv"]
+
+def ebml_size(size):
+    # Shortest EBML variable length integer for size, all ones is reserved for an unknown size
+    for length in range(1, 9):
+        if size < (1 << 7 * length) - 1:
+            return ((1 << 7 * length) | size).to_bytes(length, "big")
+    raise ValueError("Size too big for EBML")
+
+def element(element_id, *children):
+    data = b"".join(children)
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big") + ebml_size(len(data)) + data
+
+def uint(element_id, value, width=None):
+    return element(element_id, value.to_bytes(width or max(1, (value.bit_length() + 7) // 8), "big"))
+
+def string(element_id, value):
+    return element(element_id, value.encode("utf8"))
+
+def track_entry(number, track_type, codec_id, language=None, name=None, default=None):
+    children = [uint(0xD7, number), uint(0x83, track_type), string(0x86, codec_id)]
+    if language is not None:
+        children.append(string(0x22B59C, language))
+    if name is not None:
+        children.append(string(0x536E, name))
+    if default is not None:
+        children.append(uint(0x88, default))
+    return element(0xAE, *children)
+
+def write_mkv(path, tracks, attachments=0, tracks_behind_cluster=False, doc_type="matroska"):
+    # Minimal Matroska file: EBML header, Info with a duration of 1.5 seconds, Tracks, Attachments and one Cluster
+    ebml_header = element(0x1A45DFA3, string(0x4282, doc_type))
+    info = element(0x1549A966, uint(0x2AD7B1, 1000000), element(0x4489, struct.pack(">f", 1500.0)))
+    tracks_element = element(0x1654AE6B, *tracks)
+    attachments_element = element(0x1941A469, *[element(0x61A7, string(0x466E, f"font{index}.ttf")) for index in range(attachments)]) if attachments else b""
+    cluster = element(0x1F43B675, uint(0xE7, 0))
+    if tracks_behind_cluster:
+        # Only the SeekHead points to the Tracks, the SeekPosition has a fixed width so the size of the SeekHead is known up front
+        seek_head_size = len(element(0x114D9B74, element(0x4DBB, uint(0x53AB, 0x1654AE6B), uint(0x53AC, 0, width=4))))
+        tracks_position = seek_head_size + len(info) + len(attachments_element) + len(cluster)
+        seek_head = element(0x114D9B74, element(0x4DBB, uint(0x53AB, 0x1654AE6B), uint(0x53AC, tracks_position, width=4)))
+        segment = seek_head + info + attachments_element + cluster + tracks_element
+    else:
+        segment = info + tracks_element + attachments_element + cluster
+    with open(path, "wb") as f:
+        f.write(ebml_header + element(0x18538067, segment))
+
+def test_read_vint():
+    assert mkvt.read_vint(b"\x81", 0) == (1, 1)
+    assert mkvt.read_vint(b"\x40\x02", 0) == (2, 2)
+    assert mkvt.read_vint(b"\x1A\x45\xDF\xA3", 0, keep_marker=True) == (0x1A45DFA3, 4)
+    # All value bits set means the size is unknown
+    assert mkvt.read_vint(b"\xFF", 0) == (None, 1)
+    with pytest.raises(ValueError):
+        mkvt.read_vint(b"\x00", 0)
+    with pytest.raises(ValueError):
+        mkvt.read_vint(b"\x40", 0)
+
+def test_read_mkv_header(tmp_path):
+    path = tmp_path / "movie.mkv"
+    write_mkv(path, [track_entry(1, 1, "V_MPEG4/ISO/AVC"),
+                     track_entry(2, 2, "A_AAC/MPEG4/LC", language="jpn", name="Original", default=1),
+                     track_entry(3, 2, "A_AC3", default=0),
+                     track_entry(4, 17, "S_TEXT/UTF8", language="ger")], attachments=2)
+    mkvmerge_json = mkvt.read_mkv_header(str(path))
+    assert mkvmerge_json["container"]["properties"]["duration"] == 1500000000
+    assert mkvmerge_json["attachments"] == [{"id": 1}, {"id": 2}]
+    assert [(track["id"], track["type"], track["codec"]) for track in mkvmerge_json["tracks"]] == [
+        (0, "video", "AVC/H.264/MPEG-4p10"), (1, "audio", "AAC"), (2, "audio", "AC-3"), (3, "subtitles", "SubRip/SRT")]
+    audio, second_audio, subtitles = (track["properties"] for track in mkvmerge_json["tracks"][1:])
+    assert audio == {"language": "jpn", "language_ietf": "ja", "default_track": True, "forced_track": False, "track_name": "Original"}
+    # Tracks without a language are English and default tracks unless flagged otherwise
+    assert (second_audio["language_ietf"], second_audio["default_track"]) == ("en", False)
+    assert (subtitles["language_ietf"], subtitles["default_track"]) == ("de", True)
+
+def test_read_mkv_header_follows_seek_head(tmp_path):
+    path = tmp_path / "movie.mkv"
+    write_mkv(path, [track_entry(1, 1, "V_AV1"), track_entry(2, 2, "A_OPUS", language="eng")], tracks_behind_cluster=True)
+    mkvmerge_json = mkvt.read_mkv_header(str(path))
+    assert [track["codec"] for track in mkvmerge_json["tracks"]] == ["AV1", "Opus"]
+
+def test_read_mkv_header_leaves_unusual_files_to_mkvmerge(tmp_path):
+    # DTS is named after its bitstream by mkvmerge, so only mkvmerge can describe it
+    dts = tmp_path / "dts.mkv"
+    write_mkv(dts, [track_entry(1, 1, "V_MPEG4/ISO/AVC"), track_entry(2, 2, "A_DTS")])
+    assert mkvt.read_mkv_header(str(dts)) is None
+    other_doc_type = tmp_path / "other.mkv"
+    write_mkv(other_doc_type, [track_entry(1, 1, "V_VP9")], doc_type="other")
+    assert mkvt.read_mkv_header(str(other_doc_type)) is None
+    truncated = tmp_path / "truncated.mkv"
+    write_mkv(truncated, [track_entry(1, 1, "V_VP9"), track_entry(2, 2, "A_OPUS")])
+    truncated.write_bytes(truncated.read_bytes()[:60])
+    assert mkvt.read_mkv_header(str(truncated)) is None
+    not_mkv = tmp_path / "not.mkv"
+    not_mkv.write_text("not a Matroska file")
+    assert mkvt.read_mkv_header(str(not_mkv)) is None
+    assert mkvt.read_mkv_header(str(tmp_path / "missing.mkv")) is None
+
+def remux_json(tracks, attachments=0, seconds=None):
+    # mkvmerge -J output with (type, codec, language, name, default) tracks numbered in order
+    return {"container": {"properties": {} if seconds is None else {"duration": int(seconds * 1e9)}},
+            "attachments": [{"id": attachment_id} for attachment_id in range(1, attachments + 1)],
+            "tracks": [{"id": track_id, "type": track_type, "codec": codec,
+                        "properties": {"language_ietf": language, "track_name": name, "default_track": default}}
+                       for track_id, (track_type, codec, language, name, default) in enumerate(tracks)]}
+
+verify_source_tracks = [("video", "AV1", "und", "Video", True), ("audio", "FLAC", "ja", "Japanese", True), ("audio", "AC-3", "en", "English", False),
+                        ("subtitles", "SubStationAlpha", "en", "Full", False)]
+
+def verify(monkeypatch, output_json, inputs, default_flags=None, session=None, source_json=None):
+    probes = {"movie.mkv": source_json or remux_json(verify_source_tracks, attachments=2, seconds=1000), "movie.new.mkv": output_json}
+    monkeypatch.setattr(mkvt, "identify", lambda session, path: probes[path])
+    session = session or mkvt.Session(mkvt.Config(), remove_attachments=False, stop_after_video_ends=False)
+    track_info = mkvt.get_track_info(session.config, probes["movie.mkv"])
+    inputs_ids = mkvt.build_inputs_and_ids(track_info, inputs)
+    if default_flags:
+        inputs_ids["default_flags"] = default_flags
+    return mkvt.verify_remux(session, {"mkv": "movie.mkv", "inputs_ids": inputs_ids}, "movie.new.mkv")
+
+def test_verify_remux_track_order(monkeypatch):
+    video, japanese, english, subtitles = verify_source_tracks
+    assert verify(monkeypatch, remux_json([video, english, japanese, subtitles], attachments=2, seconds=1000), ["2", "1", "3"]) is None
+    assert verify(monkeypatch, remux_json([video, japanese, english, subtitles], attachments=2, seconds=1000), ["2", "1", "3"]) == \
+        "track 1 is audio ja/Japanese/FLAC instead of audio en/English/AC-3"
+    assert verify(monkeypatch, remux_json([video, english, subtitles], attachments=2, seconds=1000), ["2", "1", "3"]) == "3 tracks instead of 4"
+    assert verify(monkeypatch, remux_json([video, english], attachments=2, seconds=1000), ["2"]) is None
+
+def test_verify_remux_attachments(monkeypatch):
+    video, japanese, english, subtitles = verify_source_tracks
+    assert verify(monkeypatch, remux_json(verify_source_tracks, attachments=0, seconds=1000), ["1", "2", "3"]) == "0 attachments instead of 2"
+    session = mkvt.Session(mkvt.Config(), remove_attachments=True, stop_after_video_ends=False)
+    assert verify(monkeypatch, remux_json(verify_source_tracks, attachments=0, seconds=1000), ["1", "2", "3"], session=session) is None
+    assert verify(monkeypatch, remux_json(verify_source_tracks, attachments=2, seconds=1000), ["1", "2", "3"], session=session) == "2 attachments instead of 0"
+
+def test_verify_remux_default_flags(monkeypatch):
+    video, japanese, english, subtitles = verify_source_tracks
+    flags = {"1": False, "2": True, "3": False}
+    swapped = [video, japanese[:4] + (False,), english[:4] + (True,), subtitles]
+    assert verify(monkeypatch, remux_json(swapped, attachments=2, seconds=1000), ["1", "2", "3"], default_flags=flags) is None
+    assert verify(monkeypatch, remux_json(verify_source_tracks, attachments=2, seconds=1000), ["1", "2", "3"], default_flags=flags) == \
+        "track 1 has the wrong default flag"
+    # Flags that no rule set aren't checked
+    assert verify(monkeypatch, remux_json(swapped, attachments=2, seconds=1000), ["1", "2", "3"]) is None
+
+def test_verify_remux_duration(monkeypatch):
+    config = mkvt.Config({"verify_duration_tolerance": 2})
+    session = mkvt.Session(config, remove_attachments=False, stop_after_video_ends=False)
+    assert verify(monkeypatch, remux_json(verify_source_tracks, attachments=2, seconds=1001.5), ["1", "2", "3"], session=session) is None
+    assert verify(monkeypatch, remux_json(verify_source_tracks, attachments=2, seconds=998.5), ["1", "2", "3"], session=session) is None
+    assert verify(monkeypatch, remux_json(verify_source_tracks, attachments=2, seconds=1002.5), ["1", "2", "3"], session=session) == \
+        "1002.5 s long instead of 1000.0 s"
+    assert verify(monkeypatch, remux_json(verify_source_tracks, attachments=2, seconds=900), ["1", "2", "3"], session=session) == \
+        "900.0 s long instead of 1000.0 s"
+    # Trimming to the video length may only make the file shorter
+    trimming = mkvt.Session(config, remove_attachments=False, stop_after_video_ends=True)
+    assert verify(monkeypatch, remux_json(verify_source_tracks, attachments=2, seconds=900), ["1", "2", "3"], session=trimming) is None
+    assert verify(monkeypatch, remux_json(verify_source_tracks, attachments=2, seconds=1100), ["1", "2", "3"], session=trimming) == \
+        "1100.0 s long instead of 1000.0 s"
+    # Files that can't be probed are not trusted
+    assert verify(monkeypatch, None, ["1", "2", "3"]) == "could not be read"
+
+def test_failed_verification_is_quarantined(tmp_path, monkeypatch):
+    mkv = str(tmp_path / "movie.mkv")
+    with open(mkv, "wb") as f:
+        f.write(b"original")
+    source_json = remux_json(verify_source_tracks, attachments=2, seconds=1000)
+    # The remux keeps the source order although the English audio track was chosen first
+    probes = {mkv: source_json, str(tmp_path / "movie.new.mkv"): source_json}
+    monkeypatch.setattr(mkvt, "identify", lambda session, path: probes[path])
+
+    def remux_file(job, progress=None):
+        with open(job["output_path"], "wb") as f:
+            f.write(b"remuxed")
+        return True
+
+    monkeypatch.setattr(mkvt, "remux_file", remux_file)
+    session = mkvt.Session(mkvt.Config({"free_space_reserve_gb": 0}), remove_attachments=False, stop_after_video_ends=False, verify_remuxes=True)
+    batch = mkvt.RemuxBatch(session, remux_jobs=1, jobs_per_device=1)
+    batch.add([mkv], mkvt.build_inputs_and_ids(mkvt.get_track_info(session.config, source_json), ["2", "1", "3"]))
+    assert batch.finish() == ([], 1)
+    quarantine_path = str(tmp_path / "movie.new.mkv.unverified")
+    assert batch.quarantined == {mkv: (quarantine_path, "track 1 is audio ja/Japanese/FLAC instead of audio en/English/AC-3")}
+    assert sorted(os.listdir(tmp_path)) == ["movie.mkv", "movie.new.mkv.unverified"]
+    assert open(mkv, "rb").read() == b"original"
+
+def hard_linked_library(tmp_path):
+    # A download directory and a library that share one file via a hard link, the library also has a file of its own
+    downloads, library = tmp_path / "downloads", tmp_path / "library"
+    (downloads / "Movie").mkdir(parents=True)
+    (library / "Movies" / "Movie").mkdir(parents=True)
+    downloaded = str(downloads / "Movie" / "Movie.mkv")
+    with open(downloaded, "wb") as f:
+        f.write(b"original")
+    linked = str(library / "Movies" / "Movie" / "Movie.mkv")
+    os.link(downloaded, linked)
+    own = str(library / "Movies" / "Other.mkv")
+    with open(own, "wb") as f:
+        f.write(b"other")
+    return str(downloads), str(library), downloaded, linked, own
+
+def test_hard_linked_file_reached_from_two_roots(tmp_path):
+    downloads, library, downloaded, linked, own = hard_linked_library(tmp_path)
+    session = mkvt.Session(mkvt.Config())
+    assert list(mkvt.iter_mkv_files(session, [downloads, library])) == [downloaded, own]
+    assert session.known_links == {downloaded: {linked}}
+    # The same root twice and a root inside another one are only walked once
+    session = mkvt.Session(mkvt.Config())
+    assert list(mkvt.iter_mkv_files(session, [library, os.path.join(library, "Movies"), library])) == [own, linked]
+    assert session.known_links == {}
+
+def test_hard_links_of_replaced_files(tmp_path):
+    for policy in ("relink", "report", "leave"):
+        downloads, library, downloaded, linked, own = hard_linked_library(tmp_path / policy)
+        session = mkvt.Session(mkvt.Config(), hardlink_policy=policy)
+        list(mkvt.iter_mkv_files(session, [downloads, library]))
+        with open(downloaded.replace(".mkv", ".new.mkv"), "wb") as f:
+            f.write(b"remuxed")
+        assert mkvt.replace_file(session, downloaded)
+        assert open(downloaded, "rb").read() == b"remuxed"
+        if policy == "relink":
+            # Both paths point to the new file again
+            assert os.path.samefile(downloaded, linked)
+            assert session.stale_links == {}
+        else:
+            assert open(linked, "rb").read() == b"original"
+            assert session.stale_links == ({downloaded: ([linked], 0)} if policy == "report" else {})
+
+def test_hard_links_outside_the_scanned_directories_are_reported(tmp_path):
+    downloads, library, downloaded, linked, own = hard_linked_library(tmp_path)
+    session = mkvt.Session(mkvt.Config(), hardlink_policy="relink")
+    # Only the download directory is scanned, the library link can't be relinked
+    list(mkvt.iter_mkv_files(session, downloads))
+    with open(downloaded.replace(".mkv", ".new.mkv"), "wb") as f:
+        f.write(b"remuxed")
+    assert mkvt.replace_file(session, downloaded)
+    assert session.stale_links == {downloaded: ([], 1)}
+
+def test_plan_round_trip(tmp_path):
+    library = tmp_path / "library"
+    (library / "Show" / "Season 1").mkdir(parents=True)
+    remux_path = str(library / "Show" / "Season 1" / "ep01.mkv")
+    edit_path = str(library / "Show" / "Season 1" / "ep02.mkv")
+    link_path = str(library / "Show" / "ep01 link.mkv")
+    for path in (remux_path, edit_path):
+        with open(path, "wb") as f:
+            f.write(b"\x1A\x45\xDF\xA3" + bytes(100))
+    session = mkvt.Session(mkvt.Config(), remove_attachments=True, stop_after_video_ends=True)
+    session.known_links[remux_path] = {link_path}
+    inputs_ids = {"inputs": ["3", "2"], "video_ids": ["0"], "audio_ids": ["3"], "subtitle_ids": ["2"]}
+    edit_args = ["--edit", "track:2", "--set", "flag-default=0"]
+    plan_file = str(tmp_path / "plan.json")
+    mkvt.write_plan_file(session, plan_file, [str(library)], False, {remux_path: "remux", edit_path: "propedit"},
+                         {edit_path: edit_args}, {"cat": inputs_ids}, {"cat": [remux_path]})
+
+    # Executed where the library is mounted elsewhere, with the settings the plan was made with
+    moved = tmp_path / "moved"
+    os.rename(library, moved)
+    executing_session = mkvt.Session(mkvt.Config(), remove_attachments=False, stop_after_video_ends=False)
+    run, roots = mkvt.load_plan(executing_session, plan_file, [str(moved)])
+    assert roots == [str(moved)]
+    assert (executing_session.remove_attachments, executing_session.stop_after_video_ends) == (True, True)
+    remux_entry, edit_entry = run["files"]
+    assert (remux_entry["action"], remux_entry["inputs_ids"]) == ("remux", inputs_ids)
+    assert (edit_entry["action"], edit_entry["edit_args"]) == ("propedit", edit_args)
+    assert mkvt.plan_entry_path(remux_entry["file"], roots) == os.path.join(str(moved), "Show", "Season 1", "ep01.mkv")
+    assert [mkvt.plan_entry_path(entry, roots) for entry in remux_entry["links"]] == [os.path.join(str(moved), "Show", "ep01 link.mkv")]
+    moved_edit_path = mkvt.plan_entry_path(edit_entry["file"], roots)
+    assert mkvt.same_source(mkvt.file_signature(moved_edit_path), edit_entry["source"])
+    # A source that changed after the plan was written is not the planned one anymore
+    with open(moved_edit_path, "ab") as f:
+        f.write(b"\0")
+    assert not mkvt.same_source(mkvt.file_signature(moved_edit_path), edit_entry["source"])
+
+def test_load_plan_errors(tmp_path):
+    session = mkvt.Session(mkvt.Config())
+    with pytest.raises(mkvt.MkvtError):
+        mkvt.load_plan(session, str(tmp_path / "missing.json"), None)
+    plan_file = tmp_path / "plan.json"
+    plan_file.write_text(json.dumps({"version": 1, "roots": [str(tmp_path)], "single_folder": False,
+                                     "remove_attachments": False, "stop_after_video_ends": False, "files": []}))
+    with pytest.raises(mkvt.MkvtError):
+        mkvt.load_plan(session, str(plan_file), [str(tmp_path), str(tmp_path / "other")])
+
+# Workers are separate processes, so each has its own worker id, and they are started together to race for the same locks
+fork = pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+
+def claim_all(claims_dir, stale_seconds, count, start, results):
+    claims = mkvt.PlanClaims(claims_dir, stale_seconds)
+    # Each in its own order, so workers also arrive while others are in the middle of taking a lock over
+    indexes = list(range(count))
+    random.Random(os.getpid()).shuffle(indexes)
+    start.wait()
+    results.put(sorted(index for index in indexes if claims.claim(index)))
+
+def race_workers(claims_dir, stale_seconds, count, workers=6):
+    context = multiprocessing.get_context("fork")
+    start, results = context.Event(), context.Queue()
+    processes = [context.Process(target=claim_all, args=(claims_dir, stale_seconds, count, start, results)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    start.set()
+    claimed = [results.get(timeout=60) for _ in processes]
+    for process in processes:
+        process.join()
+    return claimed
+
+@fork
+def test_worker_claims_are_exclusive(tmp_path):
+    claimed = race_workers(str(tmp_path / "claims"), 60, 50)
+    assert sorted(index for indexes in claimed for index in indexes) == list(range(50))
+
+@fork
+def test_stale_claim_is_taken_over_by_one_worker(tmp_path):
+    claims_dir = tmp_path / "claims"
+    claims_dir.mkdir()
+    for round in range(5):
+        for index in range(20):
+            lock_path = claims_dir / f"{index}.lock"
+            lock_path.write_text("crashed-1")
+            os.utime(lock_path, (time.time() - 3600, time.time() - 3600))
+        claimed = race_workers(str(claims_dir), 60, 20)
+        assert sorted(index for indexes in claimed for index in indexes) == list(range(20))
+        # Their locks are fresh, so the next round's workers can't take them over
+        assert race_workers(str(claims_dir), 60, 20, workers=2) == [[], []]
+        for index in range(20):
+            (claims_dir / f"{index}.lock").unlink()
+
+def claim_after_takeover(claims_dir, saw_stale, taken_over, moved, retried, results):
+    # Finds the lock stale, then waits until another worker has taken it over before going on
+    stat, rename = os.stat, os.rename
+    def paused_stat(path, *args, **kwargs):
+        result = stat(path, *args, **kwargs)
+        if str(path).endswith(".lock") and not saw_stale.is_set():
+            saw_stale.set()
+            taken_over.wait(30)
+        return result
+    def paused_rename(source, destination):
+        rename(source, destination)
+        if str(destination).endswith(".stale"):
+            moved.set()
+            retried.wait(30)
+    os.stat, os.rename = paused_stat, paused_rename
+    results.put(mkvt.PlanClaims(claims_dir, 60).claim(0))
+
+@fork
+def test_stale_claim_taken_over_in_the_meantime_is_left_alone(tmp_path):
+    claims_dir = tmp_path / "claims"
+    claims_dir.mkdir()
+    lock_path = claims_dir / "0.lock"
+    lock_path.write_text("crashed-1")
+    os.utime(lock_path, (time.time() - 3600, time.time() - 3600))
+    context = multiprocessing.get_context("fork")
+    saw_stale, taken_over, moved, retried, results = context.Event(), context.Event(), context.Event(), context.Event(), context.Queue()
+    late = context.Process(target=claim_after_takeover, args=(str(claims_dir), saw_stale, taken_over, moved, retried, results))
+    late.start()
+    assert saw_stale.wait(30)
+    first = mkvt.PlanClaims(str(claims_dir), 60)
+    assert first.claim(0)
+    taken_over.set()
+    # A third worker that arrives while the late one would have the new lock moved away
+    third = mkvt.PlanClaims(str(claims_dir), 60)
+    third.worker_id = "third"
+    while late.is_alive() and not moved.wait(0.05):
+        pass
+    if moved.is_set():
+        assert not third.claim(0)
+        retried.set()
+    assert results.get(timeout=30) is False
+    late.join()
+    assert not third.claim(0)
+    assert lock_path.read_text() == first.worker_id
+
+def hold_claim(claims_dir, stale_seconds, seconds, claimed):
+    claims = mkvt.PlanClaims(claims_dir, stale_seconds)
+    assert claims.claim(0)
+    claimed.set()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        claims.heartbeat()
+        time.sleep(0.1)
+    # Exits without releasing its claim, like a crashed worker
+
+@fork
+def test_heartbeat_keeps_a_claim(tmp_path):
+    claims_dir = str(tmp_path / "claims")
+    context = multiprocessing.get_context("fork")
+    claimed = context.Event()
+    holder = context.Process(target=hold_claim, args=(claims_dir, 0.5, 2, claimed))
+    holder.start()
+    assert claimed.wait(30)
+    claims = mkvt.PlanClaims(claims_dir, 0.5)
+    while holder.is_alive():
+        assert not claims.claim(0)
+        time.sleep(0.05)
+    holder.join()
+    time.sleep(1)
+    assert claims.claim(0)
+    claims.finish(0, "done", None)
+    assert not mkvt.PlanClaims(claims_dir, 0.5).claim(0)
+    assert claims.results(1)[0]["result"] == "done"